@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""logdog的性能测试
+
+生成指定大小的模拟logcat日志，分别测量搜索（_search）、分析统计（make_bone）以及完整的命令行
+（logdog.py）的吞吐量和内存峰值，并以JSON格式输出测试结果，用于发现性能退化和评估硬件需求．
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import platform
+import subprocess
+from optparse import OptionParser
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from logdog import LogDog, WrapIter
+
+# 模拟日志中的包名、异常等，每种taste的bone从中随机组合，因此统计结果中会有重复的异常
+PACKAGES = ["com.android.development", "com.example.company.test_exception", "com.qiku.eyemode",
+            "com.google.android.gms.persistent", "com.tencent.mm", "com.android.phone"]
+EXCEPTIONS = [("java.lang.NullPointerException", "Attempt to invoke a virtual method on a null object reference"),
+              ("java.lang.RuntimeException", "Unable to start activity"),
+              ("java.lang.IllegalStateException", "Could not execute method for android:onClick")]
+FRAMES = ["android.view.View.performClick(View.java:5706)", "android.os.Handler.dispatchMessage(Handler.java:95)",
+          "android.os.Looper.loop(Looper.java:154)", "android.app.ActivityThread.main(ActivityThread.java:6246)",
+          "java.lang.reflect.Method.invoke(Native Method)",
+          "com.android.internal.os.ZygoteInit.main(ZygoteInit.java:806)"]
+REASONS = ["Input dispatching timed out (Waiting to send non-key event)",
+           "Broadcast of Intent { act=android.intent.action.SCREEN_OFF flg=0x50000010 }",
+           "executing service com.google.android.gms/com.google.android.location.reporting.service.DispatchingService"]
+SIGNALS = [("11 (SIGSEGV)", "1 (SEGV_MAPERR)"), ("6 (SIGABRT)", "-6 (SI_TKILL)"), ("13 (SIGPIPE)", "0 (SI_USER)")]
+LIBS = ["/system/lib64/libc.so", "/system/lib64/libutils.so", "/system/lib64/libbinder.so"]
+NOISE_TAGS = ["SettingsInterface", "PowerManagerService", "System.out", "WifiStateMachine", "InputReader"]
+
+TASTES = ["app-crash", "system-crash", "app-anr", "native-crash"]
+
+
+def printable(text):
+    """与logcat -v printable相同，把不可打印的字符转义为C风格的转义序列"""
+    out = []
+    for c in text:
+        if c == "\t":
+            out.append("\\t")
+        elif c < " " or c == "\x7f":
+            out.append("\\%03o" % ord(c))
+        else:
+            out.append(c)
+    return "".join(out)
+
+
+class LogGenerator:
+    """按固定的随机数种子生成模拟的logcat日志
+
+    fmt: threadtime, usec或printable（logcat -v printable，不可打印的字符转义为"\\t"、"\\033"等，
+    部分其他线程的日志中含有终端控制字符）
+    density: 每行日志是一个bone的开始的概率
+    mix: {taste名: 权重}，决定各种bone的比例
+    crlf: 是否使用"\\r\\n"换行
+    interleave: bone的各行之间插入其他线程日志的概率
+    """
+
+    def __init__(self, seed=0, fmt="threadtime", density=0.001, mix=None, crlf=False, interleave=0.0):
+        self.random = random.Random(seed)
+        self.fmt = fmt
+        self.density = density
+        self.mix = mix or {x: 1 for x in TASTES}
+        self.crlf = crlf
+        self.interleave = interleave
+        self.msec = 0
+        self.bones = {x: 0 for x in TASTES}
+        self.lines = 0
+
+    def _time(self):
+        self.msec += self.random.randint(0, 3)
+        sec, msec = divmod(self.msec, 1000)
+        minute, sec = divmod(sec, 60)
+        hour, minute = divmod(minute, 60)
+        stamp = "01-01 %02d:%02d:%02d" % (hour % 24, minute, sec)
+        if self.fmt == "usec":
+            return stamp + ".%06d" % (msec * 1000 + self.random.randint(0, 999))
+        return stamp + ".%03d" % msec
+
+    def _line(self, pid, tid, level, tag, msg):
+        self.lines += 1
+        if self.fmt == "printable":
+            msg = printable(msg)
+        return "%s %5d %5d %s %-8s: %s%s" % (self._time(), pid, tid, level, tag, msg, "\r\n" if self.crlf else "\n")
+
+    def _noise(self):
+        r = self.random
+        msg = "value = %d, name = %s" % (r.randint(0, 1 << 20), r.choice(PACKAGES))
+        if self.fmt == "printable" and r.random() < 0.1:
+            msg = "\x1b[1m%s\x1b[0m" % msg
+        return self._line(r.randint(100, 30000), r.randint(100, 30000), r.choice("DIVW"), r.choice(NOISE_TAGS), msg)
+
+    def _bone(self, taste):
+        r = self.random
+        pid = r.randint(1000, 30000)
+        pkg = r.choice(PACKAGES)
+        if taste in ("app-crash", "system-crash"):
+            ex_name, ex_desc = r.choice(EXCEPTIONS)
+            if taste == "app-crash":
+                msgs = ["FATAL EXCEPTION: main", "Process: %s, PID: %d" % (pkg, pid)]
+            else:
+                msgs = ["*** FATAL EXCEPTION IN SYSTEM PROCESS: android.display"]
+            msgs.append("%s: %s" % (ex_name, ex_desc))
+            msgs.extend("\tat " + x for x in FRAMES[:r.randint(2, len(FRAMES))])
+            return pid, pid, "E", "AndroidRuntime", msgs
+        if taste == "app-anr":
+            msgs = ["ANR in %s" % pkg, "PID: %d" % r.randint(1000, 30000), "Reason: %s" % r.choice(REASONS),
+                    "Load: 18.55 / 10.13 / 4.29", "CPU usage from 1322ms to -7055ms ago:"]
+            msgs.extend("  %d%% %d/%s: 0%% user + 1%% kernel" % (r.randint(0, 20), r.randint(100, 30000), x)
+                        for x in PACKAGES)
+            return 1364, 1380, "E", "ActivityManager", msgs
+        signal, code = r.choice(SIGNALS)
+        msgs = ["*** " * 15 + "***", "Build fingerprint: 'Android/sdk/generic:7.1.1/NYC/1:userdebug/test-keys'",
+                "Revision: '0'", "ABI: 'arm64'", "pid: %d, tid: %d, name: %s  >>> %s <<<" % (pid, pid, pkg[:15], pkg),
+                "signal %s, code %s, fault addr 0x%x" % (signal, code, r.randint(0, 1 << 32))]
+        msgs.extend("    x%-2d  %016x  x%-2d  %016x" % (i, r.getrandbits(64), i + 1, r.getrandbits(64))
+                    for i in range(0, 8, 2))
+        msgs.extend(["", "backtrace:"])
+        msgs.extend("    #%02d pc %016x  %s" % (i, r.getrandbits(24), r.choice(LIBS)) for i in range(r.randint(2, 8)))
+        return pid + 1, pid + 1, "F", "DEBUG", msgs
+
+    def _choose(self, items, weights):
+        x = self.random.uniform(0, sum(weights))
+        for item, weight in zip(items, weights):
+            x -= weight
+            if x < 0:
+                return item
+        return items[-1]
+
+    def write(self, fobj, size):
+        """向fobj（以二进制方式打开）写入约size字节的日志"""
+        tastes = sorted(self.mix)
+        weights = [self.mix[x] for x in tastes]
+        written = 0
+        while written < size:
+            if self.random.random() >= self.density:
+                data = self._noise()
+            else:
+                taste = self._choose(tastes, weights)
+                self.bones[taste] += 1
+                pid, tid, level, tag, msgs = self._bone(taste)
+                out = []
+                for msg in msgs:
+                    if self.interleave and self.random.random() < self.interleave:
+                        out.append(self._noise())
+                    out.append(self._line(pid, tid, level, tag, msg))
+                data = "".join(out)
+            data = data.encode("utf-8")
+            fobj.write(data)
+            written += len(data)
+        return written
+
+
+def peak_rss(who=None):
+    """返回内存峰值（KiB），不支持时返回None"""
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who is None else who)
+    # macOS上ru_maxrss的单位是字节
+    return usage.ru_maxrss // 1024 if sys.platform == "darwin" else usage.ru_maxrss
+
+
+def _rate(seconds, size, lines):
+    return {
+        "seconds": round(seconds, 4),
+        "lines_per_sec": round(lines / seconds, 1) if seconds else None,
+        "mb_per_sec": round(size / float(1 << 20) / seconds, 3) if seconds else None,
+    }
+
+
+def bench_search(logdog, fname, size, lines):
+    bones = []
+    start = time.time()
+    with open(fname, "rb") as f:
+        logdog._search(WrapIter(f), bones.append, binary=True)
+    result = _rate(time.time() - start, size, lines)
+    result["bones"] = len(bones)
+    return result, bones
+
+
+def bench_parse_bone(logdog, bones):
+    lines = sum(len(x[0]) for x in bones)
+    size = sum(len(line.encode("utf-8")) for x in bones for line in x[0])
+    start = time.time()
+    for bone_info in bones:
+        logdog.counter.put(logdog.make_bone(bone_info))
+    result = _rate(time.time() - start, size, lines)
+    result["bones_per_sec"] = round(len(bones) / result["seconds"], 1) if result["seconds"] else None
+    result["distinct_bones"] = len(logdog.counter.result())
+    return result
+
+
+def bench_main(fname, size, lines, args=()):
+    logdog_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logdog.py")
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        subprocess.check_call([sys.executable, logdog_py] + list(args) + [fname], stdout=devnull)
+        result = _rate(time.time() - start, size, lines)
+    result["args"] = list(args)
+    result["peak_rss_kb"] = peak_rss(resource.RUSAGE_CHILDREN) if resource is not None else None
+    return result
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(","):
+        name, _, weight = item.partition("=")
+        if name not in TASTES:
+            raise ValueError("unknown taste: %s" % name)
+        mix[name] = int(weight or 1)
+    return mix
+
+
+def parse_args():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-s", "--size", type="float", default=64, help="Size of the generated log in MiB, default is %default")
+    parser.add_option("--seed", type="int", default=0, help="Random seed, default is %default")
+    parser.add_option("--format", dest="fmt", type="choice", choices=["threadtime", "usec", "printable"],
+                      default="threadtime", help="Log format: threadtime, usec or printable, default is %default")
+    parser.add_option("--density", type="float", default=0.001,
+                      help="Probability that a line begins a bone, default is %default")
+    parser.add_option("--mix", default=",".join(TASTES),
+                      help="Taste mix as name=weight,..., default is %default")
+    parser.add_option("--crlf", action="store_true", default=False, help="Use CRLF line endings")
+    parser.add_option("--interleave", type="float", default=0.0,
+                      help="Probability of another thread's line between two lines of a bone, default is %default")
+    parser.add_option("--log", help="Write the generated log to LOG and keep it, default is a temporary file "
+                                    "that is removed afterwards")
+    parser.add_option("--skip-main", action="store_true", default=False, help="Do not benchmark the logdog.py command")
+    parser.add_option("-o", "--outfile", help="Write the results as JSON to OUTFILE, default is stdout")
+    return parser.parse_args()
+
+
+def main():
+    options, _ = parse_args()
+    if options.log:
+        fname = options.log
+    else:
+        fd, fname = tempfile.mkstemp(prefix="logdog_bench_", suffix=".txt")
+        os.close(fd)
+    generator = LogGenerator(options.seed, options.fmt, options.density, parse_mix(options.mix),
+                             options.crlf, options.interleave)
+    try:
+        with open(fname, "wb") as f:
+            size = generator.write(f, int(options.size * (1 << 20)))
+
+        logdog = LogDog("inline")
+        logdog.load_config()
+        results = {}
+        results["search"], bones = bench_search(logdog, fname, size, generator.lines)
+        results["parse_bone"] = bench_parse_bone(logdog, bones)
+        if not options.skip_main:
+            results["main"] = bench_main(fname, size, generator.lines)
+        results["peak_rss_kb"] = peak_rss()
+    finally:
+        if not options.log:
+            os.remove(fname)
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "generator": {
+            "seed": options.seed, "format": options.fmt, "density": options.density,
+            "mix": parse_mix(options.mix), "crlf": options.crlf, "interleave": options.interleave,
+            "size": size, "lines": generator.lines, "bones": generator.bones,
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=4, sort_keys=True)
+    if options.outfile:
+        with open(options.outfile, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,19 +4,28 @@
 config = {
     "server": {
         "ip": "192.168.1.3",
+        # 可选：端口（默认80），上传路径（默认/logdog/result），
+        # 无法连接服务器时暂存结果的目录（默认~/.logdog/spool）
+        # "port": 80,
+        # "path": "/logdog/result",
+        # "spool_dir": "",
         "auth_key": ""
     },
     "logtype": {
-        # 仅支持threadtime, printable, usec 格式的logcat日志
-        # logcat -v printable
+        # 支持threadtime(printable), usec, epoch, brief, long 格式的logcat日志
+        # type为auto时，根据每个输入文件开头的若干行自动识别其格式，也可以指定为其中一种格式
         # logcat -v threadtime
-        # example:
         # 11-17 16:27:00.050  1519  1519 D SettingsInterface:  from settings cache , name = time_12_24 , value = 24
         # logcat -v usec
-        # 11-17 16:27:00.050984  1519  1519 D SettingsInterfac  from settings cache , name = time_12_24 , value = 24
-        "type": "logcat-threadtime",
-        "charact": r"^\d\d-\d\d \d\d:\d\d:\d\d\.\d+ +\d+ +\d+ [FEWIDV] ",
-        "time": r"^\d\d-\d\d \d\d:\d\d:\d\d\.\d+"
+        # 11-17 16:27:00.050984  1519  1519 D SettingsInterface:  from settings cache , name = time_12_24 , value = 24
+        # logcat -v epoch
+        # 1479371220.050  1519  1519 D SettingsInterface:  from settings cache , name = time_12_24 , value = 24
+        # logcat -v brief，没有时间戳，相同的bone只计数一次
+        # D/SettingsInterface( 1519):  from settings cache , name = time_12_24 , value = 24
+        # logcat -v long
+        # [ 11-17 16:27:00.050  1519: 1519 D/SettingsInterface ]
+        #  from settings cache , name = time_12_24 , value = 24
+        "type": "auto"
     },
     "tastes": [
         {
@@ -37,6 +46,8 @@ config = {
             "begin_tag": r"(\*\*\* ){15}\*\*\*",
             "key_tag": r"pid:.*tid:.*name:.*>>>.*<<<",
             "line_tag": [r"DEBUG   :", r"AEE/AED :"],
+            # MTK的AEE在tombstone之后输出的记录（Count、Last exception time等每次都不同）不属于bone
+            "end_tag": r"AEE/AED : dashboard_record_update\(\)",
             "item": {
                 "re": [
                     r"pid:.*tid:.*name:.*>>> (?P<proc_name>.*) <<<",
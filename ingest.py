@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+"""多台设备的logcat日志接收服务
+
+设备农场中的每台手机通过一个TCP或者unix socket连接推送logcat日志，例如：
+
+    (echo "logdog-device: SERIAL"; adb -s SERIAL logcat -v threadtime) | nc HOST PORT
+
+连接的第一行为"logdog-device: 设备id"时以其作为设备id，否则以对方的地址作为设备id．
+所有连接在同一个asyncio事件循环中由BoneScanner逐块扫描，不需要为每台设备创建线程；找到的bone
+交给同一个LogDog的分析统计线程，以设备id作为bone的来源（source）统计到一个WindowCounter中，
+每台设备的bone分别统计，输出的每个bone都带有设备id．
+分析统计跟不上时，连接的处理会等待队列有空位，期间不再读取该连接的数据，
+由asyncio和TCP的流量控制使发送方减速．
+
+只支持asyncio，因此需要Python 3.5及以上．
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import signal
+import asyncio
+from queue import Full
+from optparse import OptionParser
+
+from logdog import LogDog, BoneScanner, WindowCounter, SnapshotReporter, TimeWindow, open_sink
+
+DEVICE_PREFIX = b"logdog-device:"
+
+
+def _current_task():
+    # asyncio.current_task需要Python 3.7，之前的版本只有Task.current_task
+    current_task = getattr(asyncio, "current_task", None) or asyncio.Task.current_task
+    return current_task()
+
+
+def run(coro):
+    """在新的事件循环中执行coro直到完成，与Python 3.7的asyncio.run相同"""
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+class IngestServer:
+    """接收多个日志流并统计bone
+
+    logdog必须使用thread模式的pipeline，并已经调用load_config()和start()．
+    idle秒没有收到数据时结束该连接正在收集的bone；没有换行符的行超过max_line字节时按一行处理．
+    """
+
+    def __init__(self, logdog, idle=2.0, chunk_size=1 << 16, max_line=1 << 20):
+        if logdog.pipeline != "thread":
+            raise ValueError("IngestServer needs the thread pipeline")
+        if logdog.log_format is not None and logdog.log_format.convert is not None:
+            raise ValueError("%s logs cannot be streamed, use threadtime, usec or epoch" % logdog.log_format.name)
+        self.logdog = logdog
+        self.idle = idle
+        self.chunk_size = chunk_size
+        self.max_line = max_line
+        self.servers = []
+        self.handlers = set()
+        self.writers = set()
+        self.connections = 0
+        self.bytes = 0
+
+    async def start_tcp(self, host, port):
+        server = await asyncio.start_server(self._handle, host, port)
+        self.servers.append(server)
+        return server
+
+    async def start_unix(self, path):
+        server = await asyncio.start_unix_server(self._handle, path)
+        self.servers.append(server)
+        return server
+
+    async def close(self, grace=0):
+        """停止接受新的连接，最多等待grace秒让已有的连接自行结束，然后关闭其余的连接
+
+        被关闭的连接读到EOF，统计已经收到的数据后结束，所有连接结束后返回．
+        """
+        for server in self.servers:
+            server.close()
+        if self.handlers and grace:
+            await asyncio.wait(list(self.handlers), timeout=grace)
+        for writer in list(self.writers):
+            writer.close()
+        if self.handlers:
+            await asyncio.wait(list(self.handlers))
+        for server in self.servers:
+            await server.wait_closed()
+
+    async def put(self, item):
+        """把(名字, 参数)放入分析统计线程的queue，queue已满时在线程池中等待，不阻塞事件循环"""
+        try:
+            self.logdog.q.put_nowait(item)
+        except Full:
+            await asyncio.get_event_loop().run_in_executor(None, self.logdog.put_control, item)
+
+    async def _put_bones(self, bones):
+        if bones:
+            batch = list(bones)
+            del bones[:]
+            await self.put(("BONES", batch))
+
+    async def _handle(self, reader, writer):
+        self.handlers.add(_current_task())
+        self.writers.add(writer)
+        self.connections += 1
+        bones = []
+        scanner = None
+        partial = b""
+        try:
+            while True:
+                try:
+                    data = await asyncio.wait_for(reader.read(self.chunk_size), self.idle)
+                except asyncio.TimeoutError:
+                    # 发送方暂时没有数据，结束正在收集的bone，不必等到下一行日志
+                    if scanner is not None:
+                        scanner.close()
+                        await self._put_bones(bones)
+                    continue
+                if not data:
+                    break
+                self.bytes += len(data)
+                lines = (partial + data).split(b"\n")
+                partial = lines.pop()
+                if len(partial) > self.max_line:
+                    lines.append(partial)
+                    partial = b""
+                if scanner is None and lines:
+                    scanner = BoneScanner(self.logdog, bones.append, self._device(lines, writer))
+                for line in lines:
+                    scanner.feed(line + b"\n")
+                await self._put_bones(bones)
+            if scanner is None:
+                scanner = BoneScanner(self.logdog, bones.append, self._device([partial], writer))
+            if partial:
+                scanner.feed(partial)
+            scanner.close()
+            await self._put_bones(bones)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            self.writers.discard(writer)
+            self.handlers.discard(_current_task())
+
+    def _device(self, lines, writer):
+        """由连接的第一行或者对方的地址得到设备id，第一行为设备id时将其从lines中删除"""
+        if lines[0].startswith(DEVICE_PREFIX):
+            return lines.pop(0)[len(DEVICE_PREFIX):].strip().decode("utf-8", "replace")
+        peer = writer.get_extra_info("peername")
+        if isinstance(peer, tuple):
+            return "%s:%d" % peer[:2]
+        return "unix-%d" % self.connections
+
+
+def parse_args():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("--tcp",
+                      action="store",
+                      help="Accept logcat streams on HOST:PORT"
+                      )
+    parser.add_option("--unix",
+                      action="store",
+                      help="Accept logcat streams on the unix socket UNIX"
+                      )
+    parser.add_option("-o", "--outfile",
+                      action="store",
+                      dest="outfile",
+                      help="Write results to OUTFILE, default is stdout"
+                      )
+    parser.add_option("--sink",
+                      action="append",
+                      dest="sinks",
+                      default=[],
+                      help="Also write the final result to a sink given as FORMAT:PATH, "
+                           "may be given more than once"
+                      )
+    parser.add_option("--interval",
+                      action="store",
+                      type="float",
+                      default=60,
+                      help="Report results every INTERVAL seconds, default is %default"
+                      )
+    parser.add_option("--delta",
+                      action="store_true",
+                      default=False,
+                      help="Report only the bones whose count changed"
+                      )
+    parser.add_option("--idle",
+                      action="store",
+                      type="float",
+                      default=2.0,
+                      help="End the bone being collected after IDLE seconds without data, default is %default"
+                      )
+    parser.add_option("--since",
+                      action="store",
+                      help="Only count bones logged at or after SINCE"
+                      )
+    parser.add_option("--until",
+                      action="store",
+                      help="Only count bones logged at or before UNTIL"
+                      )
+    return parser.parse_args()
+
+
+async def serve(server, options, report):
+    if options.tcp:
+        host, _, port = options.tcp.rpartition(":")
+        await server.start_tcp(host or None, int(port))
+    if options.unix:
+        await server.start_unix(options.unix)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_event_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    while True:
+        try:
+            await asyncio.wait_for(stop.wait(), options.interval)
+            break
+        except asyncio.TimeoutError:
+            await server.put(("SNAPSHOT", report))
+    await server.close()
+
+
+def main():
+    options, args = parse_args()
+    if not (options.tcp or options.unix):
+        print("one of --tcp and --unix is required", file=sys.stderr)
+        exit(1)
+
+    outfobj = sys.stdout if options.outfile is None else open(options.outfile, "w", encoding="utf-8")
+    try:
+        sinks = [open_sink(x) for x in options.sinks]
+    except Exception as ex:
+        print(ex, file=sys.stderr)
+        exit(1)
+
+    logdog = LogDog("thread")
+    logdog.load_config()
+    if options.since or options.until:
+        logdog.time_window = TimeWindow(options.since, options.until)
+    logdog.counter = WindowCounter(by_source=True)
+    try:
+        server = IngestServer(logdog, options.idle)
+    except ValueError as ex:
+        print(ex, file=sys.stderr)
+        exit(1)
+    logdog.start()
+    reporter = SnapshotReporter(outfobj, options.delta)
+    try:
+        run(serve(server, options, reporter))
+    finally:
+        logdog.stop()
+        if options.unix and os.path.exists(options.unix):
+            os.remove(options.unix)
+
+    reporter(logdog.counter)
+    for sink in sinks:
+        sink.write(logdog.counter)
+        sink.close()
+    print("connections = %d, bytes = %d" % (server.connections, server.bytes), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
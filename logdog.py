@@ -3,17 +3,39 @@
 
 from __future__ import print_function
 
+import os
 import sys
 import re
-import array
+import time
+import json
+import gzip
+import zlib
+import socket
+import heapq
+import hashlib
+import tarfile
+import zipfile
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
 from optparse import OptionParser
-from collections import defaultdict
+from collections import deque, OrderedDict
+from itertools import chain, islice, groupby
 from operator import methodcaller
-from threading import Thread
+from binascii import hexlify, unhexlify
+from array import array
+from bisect import bisect_left
+from threading import Thread, Event
+try:
+    from queue import Queue, Full
+except ImportError:
+    from Queue import Queue, Full
 try:
-    from queue import Queue
+    from http.client import HTTPConnection, HTTPException
 except ImportError:
-    from Queue import Queue
+    from httplib import HTTPConnection, HTTPException
+from io import BytesIO
 from codecs import open
 
 
@@ -52,26 +74,1854 @@ class WrapIter:
             return x
 
 
+def _line_start(mm, pos):
+    """返回不小于pos的第一个行首位置"""
+    if pos <= 0:
+        return 0
+    if pos >= len(mm):
+        return len(mm)
+    if mm[pos - 1:pos] == b"\n":
+        return pos
+    nl = mm.find(b"\n", pos)
+    return len(mm) if nl < 0 else nl + 1
+
+
+class RangeIter(WrapIter):
+    """按字节范围读取内存映射的日志文件
+
+    范围的起止位置都会对齐到行首．范围内的行in_range为True；读到范围结束位置之后，
+    迭代器仍然会继续返回后面的行（in_range为False），以便把跨越范围边界的bone的续行读完．
+    与以二进制方式打开的文件一样，返回以b"\\n"切分的bytes．
+    """
+
+    def __init__(self, mm, start, end):
+        self.mm = mm
+        self.end = _line_start(mm, end)
+        self.mm.seek(_line_start(mm, start))
+        self.in_range = True
+        self.line = None
+
+    def __next__(self):
+        if self.line is not None:
+            x, self.line = self.line, None
+            return x
+
+        pos = self.mm.tell()
+        x = self.mm.readline()
+        if not x:
+            raise StopIteration
+        self.in_range = pos < self.end
+        return x
+
+    next = __next__
+
+
+class FollowIter:
+    """持续读取一个不断增长的日志文件（类似tail -f）
+
+    读到文件末尾时等待新数据，不完整的行会被缓存到读到换行符为止．
+    文件被截断或被替换（日志轮转）时重新从头读取新文件．
+    超过idle秒没有新数据时返回一个空行，使正在收集的bone结束，不必等到下一行日志写入．
+    调用close()后迭代结束．
+    """
+
+    def __init__(self, fname, poll=1.0, idle=2.0):
+        self.fname = fname
+        self.poll = poll
+        self.idle = idle
+        self.fobj = None
+        self.ino = None
+        self.partial = b""
+        self.idle_since = None
+        self.flushed = True
+        self.closed = False
+        self._reopen()
+
+    def _reopen(self):
+        """文件被截断或替换时重新打开文件，返回是否重新打开了文件"""
+        try:
+            st = os.stat(self.fname)
+        except OSError:
+            # 日志轮转过程中文件可能暂时不存在
+            return False
+        if self.fobj is not None and st.st_ino == self.ino and st.st_size >= self.fobj.tell():
+            return False
+        if self.fobj is not None:
+            self.fobj.close()
+        self.fobj = open(self.fname, "rb")
+        self.ino = st.st_ino
+        self.partial = b""
+        return True
+
+    def close(self):
+        self.closed = True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        while not self.closed:
+            line = self.fobj.readline() if self.fobj is not None else b""
+            if line:
+                self.idle_since = None
+                self.flushed = False
+                if not line.endswith(b"\n"):
+                    self.partial += line
+                    continue
+                if self.partial:
+                    line, self.partial = self.partial + line, b""
+                return line
+
+            if self._reopen():
+                continue
+            now = time.time()
+            if self.idle_since is None:
+                self.idle_since = now
+            elif not self.flushed and now - self.idle_since >= self.idle:
+                self.flushed = True
+                return b""
+            time.sleep(self.poll)
+
+        if self.fobj is not None:
+            self.fobj.close()
+        raise StopIteration
+
+    next = __next__
+
+
+# 日志级别
+LEVELS = frozenset("VDIWEFSA")
+
+
+class LogFormat:
+    """logcat日志的格式
+
+    match(line)判断原始的一行日志是否符合该格式，用于识别输入的格式；
+    split(line)不使用正则表达式，把一行日志切分为(时间戳, 去掉时间戳/pid/tid/level前缀后的文本)，
+    不符合格式时返回None．
+    taste是按threadtime格式的"level tag: 消息"编写的，brief和long格式的日志在扫描时
+    由convert()转换为threadtime格式（见FormatIter），其他格式不需要转换．
+    """
+
+    name = None
+    convert = None
+
+    def split(self, line):
+        raise NotImplementedError
+
+    def match(self, line):
+        return self.split(line) is not None
+
+    def time_of(self, line):
+        """返回原始的一行日志中的时间戳，没有时间戳时返回None"""
+        parts = self.split(line)
+        return None if parts is None else parts[0]
+
+
+class ThreadtimeFormat(LogFormat):
+    """logcat -v threadtime（或printable）
+
+    11-17 16:27:00.050  1519  1519 D SettingsInterface:  from settings cache
+    """
+
+    name = "threadtime"
+    time_width = 12
+
+    def split(self, line):
+        parts = line.split(None, 5)
+        if len(parts) == 6 and parts[4] in LEVELS and parts[0][2:3] == "-" and parts[1][2:3] == ":":
+            return parts[0] + " " + parts[1], parts[5]
+        return None
+
+    def match(self, line):
+        parts = self.split(line)
+        return parts is not None and len(parts[0]) == 6 + self.time_width
+
+
+class UsecFormat(ThreadtimeFormat):
+    """logcat -v usec，时间精确到微秒，其余与threadtime格式相同
+
+    11-17 16:27:00.050984  1519  1519 D SettingsInterface:  from settings cache
+    """
+
+    name = "usec"
+    time_width = 15
+
+
+class EpochFormat(LogFormat):
+    """logcat -v epoch，时间为从1970年开始的秒数
+
+    1479371220.050  1519  1519 D SettingsInterface:  from settings cache
+    """
+
+    name = "epoch"
+
+    def split(self, line):
+        parts = line.split(None, 4)
+        if len(parts) == 5 and parts[3] in LEVELS and parts[1].isdigit():
+            return parts[0], parts[4]
+        return None
+
+    def match(self, line):
+        parts = self.split(line)
+        return parts is not None and parts[0].replace(".", "", 1).isdigit()
+
+
+class BriefFormat(EpochFormat):
+    """logcat -v brief，没有时间戳
+
+    D/SettingsInterface( 1519):  from settings cache
+
+    转换后的行以NO_STAMP作为时间戳（格式与epoch相同），其bone没有时间戳，
+    相同的bone无论出现多少次都只计数一次．
+    """
+
+    name = "brief"
+    NO_STAMP = "-"
+
+    def _parse(self, line):
+        if line[0:1] not in LEVELS or line[1:2] != "/":
+            return None
+        i = line.find("(", 2)
+        j = line.find("):", i)
+        if i < 0 or j < 0 or not line[i + 1:j].strip().isdigit():
+            return None
+        msg = line[j + 2:]
+        if msg[:1] == " ":
+            msg = msg[1:]
+        return line[0], line[2:i], line[i + 1:j].strip(), msg
+
+    def match(self, line):
+        return self._parse(line) is not None
+
+    def time_of(self, line):
+        return None
+
+    def convert(self, lines):
+        for _, line, in_range in lines:
+            parsed = self._parse(line)
+            if parsed is None:
+                yield line, in_range
+                continue
+            level, tag, pid, msg = parsed
+            yield "%s %5s %5s %s %s: %s" % (self.NO_STAMP, pid, pid, level, tag, msg), in_range
+
+
+class LongFormat(ThreadtimeFormat):
+    """logcat -v long，每条日志由头部、若干行消息和一个空行组成
+
+    [ 11-17 16:27:00.050  1519: 1519 D/SettingsInterface ]
+     from settings cache
+
+    转换后每行消息都加上头部中的时间戳、pid、tid等，成为threadtime格式的行．
+    一条日志属于哪个字节范围由其头部的位置决定，范围开头属于上一条日志的消息会被跳过．
+    """
+
+    name = "long"
+
+    def _parse_header(self, line):
+        line = line.strip()
+        if not (line.startswith("[ ") and line.endswith(" ]")):
+            return None
+        parts = line[2:-2].split()
+        if len(parts) < 4:
+            return None
+        pid, _, tid = "".join(parts[2:-1]).partition(":")
+        level, _, tag = parts[-1].partition("/")
+        if level not in LEVELS or not pid.isdigit() or not tid.isdigit():
+            return None
+        return parts[0] + " " + parts[1], pid, tid, level, tag
+
+    def match(self, line):
+        return self._parse_header(line) is not None
+
+    def time_of(self, line):
+        header = self._parse_header(line)
+        return None if header is None else header[0]
+
+    def convert(self, lines):
+        prefix = None
+        held = None
+        for offset, line, in_range in lines:
+            if not line:
+                # FollowIter在没有新数据时返回的空行
+                yield line, in_range
+                continue
+            header = self._parse_header(line)
+            if header is not None:
+                prefix = "%s %5s %5s %s %-8s: " % header
+                record_in_range = in_range
+                held = None
+                continue
+            if prefix is None:
+                continue
+            # 空行可能是日志之间的分隔，也可能是空的消息，到下一行才能确定
+            if held is not None:
+                yield prefix + held, record_in_range
+                held = None
+            if not line.strip():
+                held = line
+            else:
+                yield prefix + line, record_in_range
+
+
+_FORMATS = (ThreadtimeFormat(), UsecFormat(), EpochFormat(), BriefFormat(), LongFormat())
+LOG_FORMATS = {x.name: x for x in _FORMATS}
+# logcat -v printable的输出与threadtime相同
+LOG_FORMAT_ALIASES = {"printable": "threadtime"}
+
+# 经过FormatIter转换后，bone中的行只可能是这两种格式之一
+BONE_FORMATS = (LOG_FORMATS["threadtime"], LOG_FORMATS["epoch"])
+
+# 识别格式时读取的日志开头的字节数或行数
+SNIFF_SIZE = 8192
+SNIFF_LINES = 64
+
+
+def sniff_format(sample):
+    """根据日志开头的一段内容（bytes或str）识别日志格式，返回匹配行数最多的LogFormat，无法识别时返回None"""
+    if isinstance(sample, bytes):
+        sample = sample.decode("utf-8", "replace")
+    lines = sample.split("\n")
+    if len(lines) > 1:
+        # 最后一行可能不完整
+        lines.pop()
+    best, count = None, 0
+    for fmt in _FORMATS:
+        n = sum(1 for line in lines if fmt.match(line))
+        if n > count:
+            best, count = fmt, n
+    return best
+
+
+class FormatIter(WrapIter):
+    """把brief、long格式的日志行转换为threadtime格式（见LogFormat.convert）
+
+    按字节范围扫描时，in_range取决于转换后的行所属日志的位置．
+    与被包装的迭代器一样返回bytes或str．
+    """
+
+    def __init__(self, fobj, fmt, offset=0):
+        self.fobj = fobj
+        self.line = None
+        self.in_range = getattr(fobj, "in_range", None)
+        self.binary = None
+        self.lines = fmt.convert(self._raw_lines(offset))
+
+    def _raw_lines(self, offset):
+        for line in self.fobj:
+            if self.binary is None:
+                self.binary = isinstance(line, bytes)
+            size = len(line)
+            # 以latin-1解码可以无损地还原为原来的bytes
+            if self.binary:
+                line = line.decode("latin-1")
+            yield offset, line, getattr(self.fobj, "in_range", None)
+            offset += size
+
+    def __next__(self):
+        if self.line is not None:
+            x, self.line = self.line, None
+            return x
+
+        x, self.in_range = next(self.lines)
+        return x.encode("latin-1") if self.binary else x
+
+    next = __next__
+
+
+class TimeWindow:
+    """--since和--until指定的时间范围（包括两端）
+
+    时间的写法与日志中的时间戳相同：threadtime、usec和long格式为"MM-DD HH:MM:SS.mmm"，
+    可以省略后面的部分；epoch格式为从1970年开始的秒数．时间戳的写法不同而无法比较的bone
+    （例如brief格式的日志）总是保留．
+    assume_sorted为True时假定日志按时间排序，二分查找要扫描的字节范围（见find_time_range），
+    否则逐行扫描并按时间过滤．少量的抽样无法可靠地判断日志是否有序，因此需要由用户指定．
+    """
+
+    date_co = re.compile(r"\d\d-\d\d(?: \d\d(?::\d\d(?::\d\d(?:\.\d{1,6})?)?)?)?$")
+    template = "01-01 00:00:00"
+
+    def __init__(self, since=None, until=None, assume_sorted=False):
+        self.since = self._parse(since)
+        self.until = self._parse(until)
+        self.assume_sorted = assume_sorted
+        if self.since is not None and self.until is not None and \
+                isinstance(self.since, float) != isinstance(self.until, float):
+            raise ValueError("--since and --until must be written in the same form")
+        self.epoch = isinstance(self.until if self.since is None else self.since, float)
+
+    def _parse(self, text):
+        if text is None:
+            return None
+        key = self.key(text.strip())
+        if key is None:
+            raise ValueError("bad time %r, expected MM-DD[ HH:MM[:SS[.mmm]]] or seconds since the epoch" % text)
+        return key
+
+    @classmethod
+    def key(cls, stamp):
+        """把时间戳转换为可以比较大小的值：补全为"MM-DD HH:MM:SS.uuuuuu"的字符串或者秒数，无法识别时返回None"""
+        if stamp is None:
+            return None
+        if cls.date_co.match(stamp):
+            date, _, frac = stamp.partition(".")
+            return date + cls.template[len(date):] + "." + frac.ljust(6, "0")
+        try:
+            return float(stamp)
+        except ValueError:
+            return None
+
+    def comparable(self, key):
+        return key is not None and isinstance(key, float) == self.epoch
+
+    def contains(self, stamp):
+        key = self.key(stamp)
+        if not self.comparable(key):
+            return True
+        return (self.since is None or key >= self.since) and (self.until is None or key <= self.until)
+
+
+# 二分查找得到的时间范围两端外检查局部乱序的字节数
+TIME_SLACK = 1 << 18
+
+
+def _time_at(mm, fmt, window, pos):
+    """返回从行首pos开始第一个有时间戳的行的(位置, 时间)，没有时返回(文件大小, None)"""
+    size = len(mm)
+    while pos < size:
+        nl = mm.find(b"\n", pos)
+        end = size if nl < 0 else nl + 1
+        key = window.key(fmt.time_of(mm[pos:end].decode("latin-1")))
+        if key is not None:
+            return pos, key
+        pos = end
+    return size, None
+
+
+def _last_time(mm, fmt, window):
+    """返回最后一个有时间戳的行的时间，没有时返回None"""
+    end = len(mm)
+    while end > 0:
+        start = mm.rfind(b"\n", 0, end - 1) + 1
+        key = window.key(fmt.time_of(mm[start:end].decode("latin-1")))
+        if key is not None:
+            return key
+        end = start
+    return None
+
+
+def _iter_keys(mm, fmt, window, start, end):
+    """依次返回[start, end)中每一行的(位置, 下一行的位置, 时间)"""
+    pos = start
+    while pos < end:
+        nl = mm.find(b"\n", pos, end)
+        next_pos = end if nl < 0 else nl + 1
+        yield pos, next_pos, window.key(fmt.time_of(mm[pos:next_pos].decode("latin-1")))
+        pos = next_pos
+
+
+def _widen_time_range(mm, fmt, window, start, end, slack):
+    """范围外slack字节内还有时间在window内的行时扩展范围，直到两端外slack字节内都没有这样的行"""
+    if window.since is not None:
+        while start > 0:
+            early = [pos for pos, _, key in _iter_keys(mm, fmt, window, _line_start(mm, start - slack), start)
+                     if window.comparable(key) and key >= window.since]
+            if not early:
+                break
+            start = early[0]
+    if window.until is not None:
+        while end < len(mm):
+            late = [next_pos for _, next_pos, key in _iter_keys(mm, fmt, window, end, _line_start(mm, end + slack))
+                    if window.comparable(key) and key <= window.until]
+            if not late:
+                break
+            end = late[-1]
+    return start, end
+
+
+def find_time_range(mm, fmt, window, probes=64, slack=TIME_SLACK):
+    """在按时间排序的日志（mmap对象）中二分查找window的起止位置，返回字节范围(start, end)
+
+    范围内开始的bone与逐行扫描并按时间过滤得到的bone相同．先在均匀分布的probes个位置及最后一个有时间戳的行
+    检查时间是否单调不减，不是时（例如跨年的日志，或者由多个日志拼接而成）或者日志没有可以比较的时间戳时返回None．
+    抽样检查不能发现所有的乱序，因此只在用户指定日志有序（TimeWindow.assume_sorted）时使用．
+    logcat -b all等日志中各个缓冲区的行会有局部的乱序，二分查找后再检查两端外slack字节内的行，
+    其中有时间在window内的行时扩展范围，见_widen_time_range．
+    """
+    size = len(mm)
+    keys = [_time_at(mm, fmt, window, _line_start(mm, size * i // probes))[1] for i in range(probes)]
+    keys = [x for x in keys + [_last_time(mm, fmt, window)] if x is not None]
+    if not keys or not all(window.comparable(x) for x in keys) or any(a > b for a, b in zip(keys, keys[1:])):
+        return None
+
+    def bisect(pred):
+        lo, hi = 0, size
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key = _time_at(mm, fmt, window, _line_start(mm, mid))[1]
+            if key is None or pred(key):
+                hi = mid
+            else:
+                lo = mid + 1
+        return _time_at(mm, fmt, window, _line_start(mm, lo))[0]
+
+    start = 0 if window.since is None else bisect(lambda x: x >= window.since)
+    end = size if window.until is None else bisect(lambda x: x > window.until)
+    return _widen_time_range(mm, fmt, window, start, max(start, end), slack)
+
+
+def file_time_range(fname, window, log_format=None):
+    """返回日志文件中位于window内的字节范围，见find_time_range
+
+    window.assume_sorted为False时返回None，由调用者逐行扫描并过滤．
+    """
+    import mmap
+
+    if not window.assume_sorted:
+        return None
+
+    with open(fname, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return 0, 0
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            fmt = log_format or sniff_format(mm[:SNIFF_SIZE]) or LOG_FORMATS["threadtime"]
+            return find_time_range(mm, fmt, window)
+        finally:
+            mm.close()
+
+
+def archive_type(fname):
+    """按扩展名识别压缩的日志及bugreport归档，返回"gzip"、"zip"、"tar"，不是压缩文件时返回None"""
+    name = fname.lower()
+    if name.endswith(".zip"):
+        return "zip"
+    if name.endswith((".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")):
+        return "tar"
+    if name.endswith(".gz"):
+        return "gzip"
+    return None
+
+
+def _member_source(fname, member):
+    """归档中的一个文件作为bone的来源时的名字"""
+    return "%s!%s" % (fname, member)
+
+
+def _gunzip_lines(fobj):
+    """逐行返回gzip压缩的fobj解压后的内容
+
+    只顺序读取fobj，Python 2的GzipFile需要seek，不能用于zip和tar中的文件．
+    """
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    tail = b""
+    for chunk in iter(lambda: fobj.read(1 << 16), b""):
+        data = d.decompress(chunk)
+        # 由多个gzip成员拼接而成
+        while d.unused_data:
+            unused, d = d.unused_data, zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data += d.decompress(unused)
+        lines = (tail + data).split(b"\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line + b"\n"
+    if tail:
+        yield tail
+
+
+def _decompress_member(member, fobj):
+    # bugreport中轮转的日志常常单独压缩过
+    return _gunzip_lines(fobj) if member.lower().endswith(".gz") else fobj
+
+
+def zip_members(fname):
+    """返回zip文件中所有普通文件的名字，只读取zip末尾的目录"""
+    with zipfile.ZipFile(fname) as z:
+        return [x.filename for x in z.infolist() if not x.filename.endswith("/")]
+
+
+def open_zip_member(fname, member):
+    """以流的方式打开zip文件中的一个文件，返回(zip文件, 以二进制方式逐行读取的file对象)，使用后需要关闭zip文件"""
+    z = zipfile.ZipFile(fname)
+    try:
+        return z, _decompress_member(member, z.open(member))
+    except Exception:
+        z.close()
+        raise
+
+
+def iter_archive(fname):
+    """依次返回压缩文件或归档中每个文件的(来源名, 以二进制方式逐行读取的file对象)
+
+    边读边解压，不解压到磁盘，内存占用与压缩文件的大小无关．tar只能按顺序读取，
+    zip中的文件可以用open_zip_member分别打开．file对象只在取得下一个文件之前有效．
+    """
+    kind = archive_type(fname)
+    if kind == "gzip":
+        with gzip.open(fname, "rb") as f:
+            yield fname, f
+    elif kind == "zip":
+        for member in zip_members(fname):
+            z, f = open_zip_member(fname, member)
+            try:
+                yield _member_source(fname, member), f
+            finally:
+                f.close()
+                z.close()
+    elif kind == "tar":
+        # "r|*"以流的方式读取，不需要在归档中seek
+        with tarfile.open(fname, "r|*") as t:
+            for info in t:
+                if info.isfile():
+                    f = _decompress_member(info.name, t.extractfile(info))
+                    yield _member_source(fname, info.name), f
+
+
+# 重叠检测以连续这么多行作为一块
+OVERLAP_BLOCK = 32
+# 记录每隔这么多字节之前的换行符个数，用于由行号计算位置
+_CHECKPOINT = 1 << 16
+# hash()的结果是Py_ssize_t，Python 2的array没有"q"，此时与C long相同
+try:
+    _HASH_TYPE = array("q").typecode
+except ValueError:
+    _HASH_TYPE = "l"
+# Python 2的array没有tobytes
+_array_bytes = getattr(array, "tobytes", None) or array.tostring
+
+
+def _line_table(fname):
+    """读取日志文件，返回(每一行的hash, 每隔_CHECKPOINT字节之前的换行符个数)"""
+    hashes, checkpoints = array(_HASH_TYPE), array(_HASH_TYPE)
+    newlines, tail = 0, b""
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(_CHECKPOINT), b""):
+            checkpoints.append(newlines)
+            newlines += chunk.count(b"\n")
+            lines = (tail + chunk).split(b"\n")
+            tail = lines.pop()
+            hashes.extend(map(hash, lines))
+    if tail:
+        # 没有换行符的最后一行与其他文件中完整的行不同
+        hashes.append(hash((tail,)))
+    return hashes, checkpoints
+
+
+def _line_offset(mm, checkpoints, x):
+    """返回第x行（从0开始）的起始位置，x为行数时返回文件大小"""
+    if x == 0:
+        return 0
+    c = bisect_left(checkpoints, x) - 1
+    pos, count = c * _CHECKPOINT, checkpoints[c]
+    while count < x:
+        pos = mm.find(b"\n", pos)
+        if pos < 0:
+            return len(mm)
+        pos += 1
+        count += 1
+    return pos
+
+
+def _common_length(a, i, b, j, limit, backward=False):
+    """比较a、b中分别从i、j开始（backward为True时为之前）的最多limit个元素，返回相同的个数"""
+    n, step = 0, 4096
+    while step:
+        if n + step <= limit and (a[i - n - step:i - n] == b[j - n - step:j - n] if backward
+                                  else a[i + n:i + n + step] == b[j + n:j + n + step]):
+            n += step
+        else:
+            step //= 2
+    return n
+
+
+def _same_bytes(mm1, start1, mm2, start2, size):
+    step = 1 << 20
+    for pos in range(0, size, step):
+        n = min(step, size - pos)
+        if mm1[start1 + pos:start1 + pos + n] != mm2[start2 + pos:start2 + pos + n]:
+            return False
+    return True
+
+
+def _subtract_ranges(start, end, ranges):
+    """返回[start, end)中不属于ranges（按顺序排列，互不重叠）的各段"""
+    pieces = []
+    for s, e in ranges:
+        if e <= start or s >= end:
+            continue
+        if s > start:
+            pieces.append((start, s))
+        start = max(start, e)
+    if start < end:
+        pieces.append((start, end))
+    return pieces
+
+
+def _shrink_to_boundary(mm, start, end, boundary):
+    """把[start, end)字节范围的两端收缩到boundary(line)为True的行之后
+
+    返回(新的start, 新的end, 开头去掉的行数, 末尾去掉的行数)，收缩后为空时返回None．
+    """
+    pos, head = start, 0
+    while pos < end:
+        nl = mm.find(b"\n", pos, end)
+        next_pos = end if nl < 0 else nl + 1
+        head += 1
+        if boundary(mm[pos:next_pos]):
+            break
+        pos = next_pos
+    else:
+        return None
+    start = next_pos
+
+    pos, tail = end, 0
+    while pos > start:
+        prev = max(mm.rfind(b"\n", start, pos - 1) + 1, start)
+        if boundary(mm[prev:pos]):
+            return start, pos, head, tail
+        pos = prev
+        tail += 1
+    return None
+
+
+def find_overlaps(fnames, boundary=None, block=OVERLAP_BLOCK):
+    """找出每个日志文件中与之前的文件重复的部分，返回{文件名: [(start, end), ...]}，为可以跳过的字节范围
+
+    轮转的logcat、logcat.1以及bugreport中的副本往往大段重复．先计算每一行的hash，以hash为block的倍数的行
+    作为锚点，锚点开始的block行作为一块．锚点只由行的内容决定，因此重复的内容在各个文件中有相同的锚点和块，
+    对之后的文件只需要查找其锚点处的块是否在之前的文件中出现过．找到后向前后扩展到所有相同的行，
+    并逐字节比较确认．之前的文件中被跳过的部分不作为重复的依据，因此重复的内容总在最早出现的位置被扫描．
+
+    boundary(line)为True的行之后一定没有正在收集的bone．重复部分的两端会收缩到这样的行之后，
+    使跳过的部分中开始的bone也都在其中结束，与之前的文件中相应的bone完全相同，
+    不会因为重复部分之外的内容不同而改变bone的文本．没有指定boundary时不收缩．
+    """
+    import mmap
+
+    index = {}
+    tables, skipped, files, result = [], [], [], {}
+    try:
+        for fi, fname in enumerate(fnames):
+            hashes, checkpoints = _line_table(fname)
+            f = open(fname, "rb")
+            files.append(f)
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if hashes else None
+            tables.append((hashes, checkpoints, mm))
+            n = len(hashes)
+            anchors = [i for i, h in enumerate(hashes) if h % block == 0 and i + block <= n]
+
+            # 找出与之前的文件相同的各段，以行号表示
+            matches = []
+            prev_end = 0
+            for i in anchors:
+                if i < prev_end:
+                    continue
+                found = index.get(hash(_array_bytes(hashes[i:i + block])))
+                if found is None:
+                    continue
+                fa, la = found
+                a_hashes, a_checkpoints, a_mm = tables[fa]
+                if a_hashes[la:la + block] != hashes[i:i + block]:
+                    continue
+                before = _common_length(hashes, i, a_hashes, la, min(i - prev_end, la), backward=True)
+                after = _common_length(hashes, i + block, a_hashes, la + block,
+                                       min(n - i, len(a_hashes) - la) - block)
+                start, a_start, end = i - before, la - before, i + block + after
+                offset, a_offset = _line_offset(mm, checkpoints, start), _line_offset(a_mm, a_checkpoints, a_start)
+                size = _line_offset(mm, checkpoints, end) - offset
+                if not _same_bytes(mm, offset, a_mm, a_offset, size):
+                    continue
+                # 之前的文件中被跳过的部分没有被扫描过
+                for s, e in _subtract_ranges(a_start, a_start + end - start, skipped[fa]):
+                    matches.append((start + s - a_start, start + e - a_start))
+                prev_end = end
+
+            ranges = []
+            for start, end in matches:
+                piece = _line_offset(mm, checkpoints, start), _line_offset(mm, checkpoints, end)
+                if boundary is not None:
+                    piece = _shrink_to_boundary(mm, piece[0], piece[1], boundary)
+                    if piece is None:
+                        continue
+                    start, end = start + piece[2], end - piece[3]
+                ranges.append((start, end))
+                result.setdefault(fname, []).append(piece[:2])
+            skipped.append(ranges)
+
+            # 被跳过的部分与之前的文件相同，不需要加入索引
+            for i in anchors:
+                if _subtract_ranges(i, i + block, ranges) == [(i, i + block)]:
+                    index.setdefault(hash(_array_bytes(hashes[i:i + block])), (fi, i))
+    finally:
+        for hashes, checkpoints, mm in tables:
+            if mm is not None:
+                mm.close()
+        for f in files:
+            f.close()
+    return result
+
+
+def _compile(pattern, binary=False):
+    """编译正则表达式，binary为True时编译为匹配bytes的正则表达式"""
+    if binary:
+        pattern = pattern.encode("utf-8")
+    return re.compile(pattern)
+
+
+def _required_literal(co):
+    """从正则表达式中提取一段任何匹配都必然包含的字面字符串
+
+    只分析顶层的顺序结构：连续的字面字符、纯字面内容的分组以及固定次数的重复会被拼接起来，
+    其他结构（字符集、分支、可变重复等）会打断拼接．返回最长的一段，无法提取时返回None．
+    """
+    if co.flags & re.IGNORECASE:
+        return None
+
+    def literal_of(seq):
+        # seq全部由字面字符构成时返回对应字符串，否则返回None
+        chars = []
+        for op, av in seq:
+            if op == sre_parse.LITERAL:
+                chars.append(chr(av))
+            elif op == sre_parse.SUBPATTERN and not any(av[1:-1]):
+                sub = literal_of(av[-1])
+                if sub is None:
+                    return None
+                chars.append(sub)
+            elif op == sre_parse.MAX_REPEAT or op == sre_parse.MIN_REPEAT:
+                lo, hi, sub = av
+                sub = literal_of(sub)
+                if sub is None or lo != hi:
+                    return None
+                chars.append(sub * lo)
+            else:
+                return None
+        return "".join(chars)
+
+    try:
+        seq = sre_parse.parse(co.pattern)
+    except Exception:
+        return None
+
+    best = ""
+    run = []
+    for op, av in seq:
+        if op == sre_parse.AT:
+            # 零宽断言不影响前后字面字符的相邻关系
+            continue
+        lit = literal_of([(op, av)])
+        if lit is not None:
+            run.append(lit)
+            continue
+        if op == sre_parse.MAX_REPEAT or op == sre_parse.MIN_REPEAT:
+            # 至少重复lo次时，前lo次的内容仍然是必需的，但之后的内容不再相邻
+            lo, hi, sub = av
+            sub = literal_of(sub)
+            if sub is not None and lo > 0:
+                run.append(sub * lo)
+        best = max(best, "".join(run), key=len)
+        run = []
+    best = max(best, "".join(run), key=len)
+    return best or None
+
+
+class TasteMatcher:
+    """在一次扫描中判断一行文本是否是某个taste的begin_tag
+
+    绝大多数日志行不会匹配任何taste，因此先用各begin_tag的必需字面字符串做子串预过滤，
+    只有通过预过滤的行才会执行合并后的正则表达式（各begin_tag以命名分组组成的分支）．
+    合并正则返回的是最左侧的匹配，为了与逐个taste匹配的优先级保持一致，
+    命中后还会检查排在其前面的taste．
+
+    binary为True时，匹配的是未解码的bytes行．
+    """
+
+    # 共享前缀不短于此长度的字面字符串会被合并为其公共前缀，以减少预过滤的子串查找次数
+    MIN_LITERAL = 8
+
+    def __init__(self, tastes, binary=False):
+        self.tastes = tastes
+        self.begin_cos = [_compile(t["begin_tag"], binary) for t in tastes]
+        self.literals = self._build_literals([_required_literal(t["begin_tag_co"]) for t in tastes])
+        if binary and self.literals is not None:
+            self.literals = tuple(x.encode("utf-8") for x in self.literals)
+
+        try:
+            self.combined_co = _compile("|".join(
+                "(?P<_taste%d>%s)" % (i, t["begin_tag"]) for i, t in enumerate(tastes)), binary)
+        except re.error:
+            # begin_tag之间存在同名分组等冲突时，退化为逐个匹配
+            self.combined_co = None
+
+    def _build_literals(self, literals):
+        if not literals or None in literals:
+            return None
+        literals = sorted(set(literals))
+        # 包含其他字面字符串的字面字符串是多余的
+        literals = [x for x in literals if not any(y != x and y in x for y in literals)]
+        merged = []
+        for lit in literals:
+            if merged:
+                prefix = os.path.commonprefix([merged[-1], lit])
+                if len(prefix) >= self.MIN_LITERAL:
+                    merged[-1] = prefix
+                    continue
+            merged.append(lit)
+        return tuple(merged)
+
+    def search(self, line):
+        """返回line匹配到的第一个taste，没有匹配时返回None"""
+        if self.literals is not None:
+            for lit in self.literals:
+                if lit in line:
+                    break
+            else:
+                return None
+
+        if self.combined_co is None:
+            for t, co in zip(self.tastes, self.begin_cos):
+                if co.search(line):
+                    return t
+            return None
+
+        match = self.combined_co.search(line)
+        if match is None:
+            return None
+        index = int(match.lastgroup[len("_taste"):])
+        for i in range(index):
+            if self.begin_cos[i].search(line):
+                return self.tastes[i]
+        return self.tastes[index]
+
+
+class LineClassifier:
+    """判定一行文本与某个taste正在收集的bone之间的关系
+
+    对每个taste在load_config时构建一次：所有line_tag合并为一个正则，新bone的判定复用
+    TasteMatcher的预过滤，因此无论有多少line_tag和taste，每行最多执行三次正则匹配．
+
+    返回值：
+    NONE: 不是该taste的续行
+    CONTINUE: 是该taste的续行
+    END: 匹配了end_tag，bone到此结束（该行不属于bone）
+    NEW: 匹配了某个taste的begin_tag，是新bone的开始
+
+    binary为True时，begin_matcher也必须是匹配bytes的TasteMatcher．
+    """
+
+    NONE, CONTINUE, END, NEW = range(4)
+
+    def __init__(self, taste, begin_matcher, binary=False):
+        self.line_co = _compile("|".join("(?:%s)" % x for x in taste["line_tag"]), binary)
+        self.end_co = _compile(taste["end_tag"], binary) if "end_tag" in taste else None
+        self.begin_matcher = begin_matcher
+
+    def classify(self, line):
+        if not self.line_co.search(line):
+            return self.NONE
+        if self.end_co is not None and self.end_co.search(line):
+            return self.END
+        if self.begin_matcher.search(line) is not None:
+            return self.NEW
+        return self.CONTINUE
+
+
+class ChipRemover:
+    """把bone文本中随机变化的片段（pid、地址等）替换为"<分组名>"
+
+    对每个taste在load_config时构建一次．先在原始文本上收集所有item_repl正则中命名分组的位置，
+    再一次拼接出替换后的文本，而不是每个正则都复制一遍文本．
+    如果某个正则的匹配范围与之前的替换位置重叠，或者分组之间相互嵌套，
+    则退化为逐个正则依次替换，保证结果与依次替换相同．
+    没有参与匹配的分组不做替换．
+    """
+
+    def __init__(self, cos):
+        # [(正则, [(分组序号, "<分组名>"), ...]), ...]
+        self.cos = [(co, sorted((i, u"<" + name + u">") for name, i in co.groupindex.items())) for co in cos]
+
+    def remove(self, text):
+        spans = []
+        for co, groups in self.cos:
+            match = co.search(text)
+            if match is None:
+                continue
+            start, end = match.span()
+            if any(s < end and start < e for s, e, _ in spans):
+                return self._remove_each(text)
+            for i, placeholder in groups:
+                s, e = match.span(i)
+                if s >= 0:
+                    spans.append((s, e, placeholder))
+        if not spans:
+            return text
+
+        spans.sort()
+        pieces = []
+        pos = 0
+        for s, e, placeholder in spans:
+            if s < pos:
+                return self._remove_each(text)
+            pieces.append(text[pos:s])
+            pieces.append(placeholder)
+            pos = e
+        pieces.append(text[pos:])
+        return u"".join(pieces)
+
+    def _remove_each(self, text):
+        for co, groups in self.cos:
+            match = co.search(text)
+            if match is None:
+                continue
+            for i, placeholder in reversed(groups):
+                s, e = match.span(i)
+                if s >= 0:
+                    text = text[:s] + placeholder + text[e:]
+        return text
+
+
+class NativeCrashNormalizer:
+    """把native-crash日志中随机变化的地址替换为占位符，保留各行（尤其是backtrace的栈帧）的结构
+
+    寄存器的值替换为"<reg>"，backtrace中的pc替换为"<pc>"，
+    栈内容中的地址、vdso的加载地址以及"0x"开头的地址替换为"<addr>"．
+    寄存器、backtrace和栈内容都是由连续的缩进行组成的段落，先用以字面字符串开头的正则
+    一次找出所有段落，再按段落的第一行判断其类型，对整个段落做替换；
+    "0x"开头的地址可能出现在任何行中，只在文本中含有"0x"时再替换一次．
+    """
+
+    # tag之后缩进4个以上空格的连续行
+    block_co = re.compile(r":     +([^\n]*)(?:\n[^\n:]*:     [^\n]*)*")
+    # "#00 pc 00078d17  /system/lib/libc.so (kill+23)"
+    frame_co = re.compile(r"#\d+ pc ")
+    pc_co = re.compile(r" pc [0-9a-f]+")
+    # "eax 00000000  ebx 00000e60"、"x0   ffffffffffffffe0  x1   0000007fb101e000"
+    reg_co = re.compile(r"(?:[a-z][a-z0-9]{1,5} +[0-9a-f]{8,16}(?: +|$))+$")
+    # "#00  bfb81610  a82db424  [vdso]"、"bfb815d0  00000000"
+    stack_co = re.compile(r"(?:#\d+ +)?[0-9a-f]{8,16}  ")
+    # 以空格开头，以便用字面字符快速查找
+    word_co = re.compile(r" [0-9a-f]{8,16}\b")
+    vdso_co = re.compile(r"\[vdso:[0-9a-f]+\]")
+    addr_co = re.compile(r"0x[0-9a-fA-F]+")
+
+    def normalize(self, text):
+        text = self.block_co.sub(self._repl, text)
+        if "0x" in text:
+            text = self.addr_co.sub(u"<addr>", text)
+        return text
+
+    def _repl(self, match):
+        block, first = match.group(0, 1)
+        if self.frame_co.match(first):
+            block = self.pc_co.sub(u" pc <pc>", block)
+            if "[vdso:" in block:
+                block = self.vdso_co.sub(u"[vdso:<addr>]", block)
+            return block
+        if self.reg_co.match(first):
+            return self.word_co.sub(u" <reg>", block)
+        if self.stack_co.match(first):
+            return self.word_co.sub(u" <addr>", block)
+        return block
+
+
 class Counter:
     '''对扫描到的异常信息(Bone对象)进行数量统计
 
     如果一个异常在日志中出现N次，那么其异常信息是相同的，但每次的时间戳是不一样的，其统计次数为N．
     如果由于某中原因出现了异常信息及时间戳完全一样的bone（日志重复），则只应该统计1次．
-    所有异常文本相同的bone对应一个列表，列表中保存了这些bone的时间戳，去除重复的时间戳后的个数，
-    即为统计结果．
+    异常文本相同的bone以文本的摘要为key，只保存第一个bone作为代表，以及这些bone的时间戳的集合
+    和来源文件的集合，时间戳集合的大小即为统计结果．因此内存只随不同异常的个数及不同时间戳的个数增长．
     '''
 
     def __init__(self):
-        self.dict = defaultdict(list)
+        self.clear()
+
+    @staticmethod
+    def digest(bone):
+        return hashlib.md5(bone.text.encode("utf-8")).digest()
 
     def put(self, obj):
-        self.dict[obj].append(obj.time_stamp)
+        key = self.digest(obj)
+        entry = self.dict.get(key)
+        if entry is None:
+            # [代表bone, 时间戳集合, 来源文件集合]
+            self.dict[key] = [obj, set([obj.time_stamp]), set([obj.source])]
+        else:
+            entry[1].add(obj.time_stamp)
+            entry[2].add(obj.source)
 
     def clear(self):
-        self.dict = defaultdict(list)
+        self.dict = {}
+
+    def merge(self, other):
+        """合并另一个Counter的统计数据，合并后仍按去重后的时间戳个数计数"""
+        for key, (bone, stamps, sources) in other.dict.items():
+            entry = self.dict.get(key)
+            if entry is None:
+                self.dict[key] = [bone, set(stamps), set(sources)]
+            else:
+                entry[1] |= stamps
+                entry[2] |= sources
+
+    def result(self):
+        return {entry[0]: len(entry[1]) for entry in self.dict.values()}
+
+    def items(self):
+        """依次返回(key, 代表bone, 计数)，与result()不同，by_source时相同文本的bone也不会合并"""
+        for key, entry in self.dict.items():
+            yield key, entry[0], len(entry[1])
+
+    def _record(self, bone, count, stamps, sources):
+        return {
+            "text": bone.text,
+            "taste": bone.taste,
+            "proc_name": bone.proc_name,
+            "ex_name": bone.ex_name,
+            "ex_desc": bone.ex_desc,
+            "count": count,
+            "stamps": sorted(stamps, key=lambda x: (x is not None, x)),
+            "sources": sorted(x for x in sources if x is not None),
+        }
+
+    def to_records(self):
+        """导出统计数据，每个bone对应一条可以序列化为JSON的记录"""
+        for bone, stamps, sources in self.dict.values():
+            yield self._record(bone, len(stamps), stamps, sources)
+
+    @classmethod
+    def from_records(cls, records, source=None):
+        """由to_records导出的记录还原Counter，指定source时所有bone的来源文件都替换为source"""
+        counter = cls()
+        for r in records:
+            stamps = r["stamps"]
+            sources = [source] if source is not None else r.get("sources", [])
+            bone = Bone(r["text"], stamps[0] if stamps else None, r["proc_name"], r["ex_name"], r["ex_desc"],
+                        r.get("taste"), sources[0] if sources else None)
+            counter.dict[cls.digest(bone)] = [bone, set(stamps), set(sources)]
+        return counter
+
+
+class WindowCounter(Counter):
+    '''内存有界的Counter，用于长时间运行的--follow模式
+
+    每个bone只保留最近window个时间戳用于去除重复的日志，计数在时间戳到达时累加，
+    因此内存只随不同异常的个数增长，而不随异常出现的次数增长．
+    by_source为True时，不同来源（例如ingest.py中的设备）的相同bone分别统计，
+    此时result()中相同文本的bone会合并，需要使用items()或to_records()．
+    '''
+
+    def __init__(self, window=1024, by_source=False):
+        self.window = window
+        self.by_source = by_source
+        Counter.__init__(self)
+
+    def put(self, obj):
+        key = self.digest(obj)
+        if self.by_source:
+            key = hashlib.md5(("%s\0" % obj.source).encode("utf-8") + key).digest()
+        entry = self.dict.get(key)
+        if entry is None:
+            # [代表bone, 最近的时间戳(set), 计数, 最近的时间戳(deque), 来源文件集合]
+            entry = self.dict[key] = [obj, set(), 0, deque(), set()]
+        entry[4].add(obj.source)
+        if obj.time_stamp in entry[1]:
+            return
+        entry[1].add(obj.time_stamp)
+        entry[2] += 1
+        entry[3].append(obj.time_stamp)
+        if len(entry[3]) > self.window:
+            entry[1].discard(entry[3].popleft())
+
+    def merge(self, other):
+        raise NotImplementedError("WindowCounter does not keep all time stamps and cannot be merged")
 
     def result(self):
-        return {key: len(set(value)) for key, value in self.dict.items()}
+        return {entry[0]: entry[2] for entry in self.dict.values()}
+
+    def items(self):
+        for key, entry in self.dict.items():
+            yield key, entry[0], entry[2]
+
+    def to_records(self):
+        """导出统计数据，只包含最近window个时间戳"""
+        for bone, stamps, count, _, sources in self.dict.values():
+            yield self._record(bone, count, stamps, sources)
+
+
+class BoneClusterer:
+    """把统计结果中相似的bone聚为一类
+
+    Counter按归一化后的异常文本完全相同来合并bone，只有行号、混淆后的方法名或者路径不同的异常仍是不同的bone．
+    聚类时把bone的文本切分为标识符（忽略数字和标点），以连续shingle个标识符作为一个shingle，
+    用一次置换的MinHash（One Permutation Hashing）计算num_bins个值的签名，签名分为bands段，
+    任意一段完全相同（且taste相同）的bone互为候选，估计的Jaccard相似度不小于threshold的候选合并为一类．
+    同一段的bone过多时（例如大量异常共有的框架调用栈），只与其中最近的bucket_size个比较，
+    因此计算量只随bone的个数线性增长，不需要两两比较．
+    """
+
+    token_co = re.compile(r"[A-Za-z_$][\w$]*")
+
+    def __init__(self, threshold=0.8, num_bins=128, bands=16, shingle=3, bucket_size=16):
+        if num_bins % bands:
+            raise ValueError("num_bins must be a multiple of bands")
+        self.threshold = threshold
+        self.num_bins = num_bins
+        self.bands = bands
+        self.rows = num_bins // bands
+        self.shingle = shingle
+        self.bucket_size = bucket_size
+        self.token_ids = {}
+
+    def signature(self, text):
+        ids = self.token_ids
+        tokens = []
+        for token in self.token_co.findall(text):
+            h = ids.get(token)
+            if h is None:
+                h = ids[token] = zlib.crc32(token.encode("utf-8"))
+            tokens.append(h)
+        n = self.shingle
+        shingles = zip(*[tokens[i:] for i in range(n)]) if len(tokens) >= n else [tuple(tokens)]
+        k = self.num_bins
+        # 整数元组的hash值与PYTHONHASHSEED无关，因此聚类结果是确定的．
+        # 按hash值从大到小写入，每个bin最终保留其中最小的hash值
+        bins = {h % k: h for h in sorted([hash(x) & 0xffffffffffffffff for x in shingles], reverse=True)}
+        sig = [bins.get(i) for i in range(k)]
+        if len(bins) < k:
+            # 空的bin（循环地）使用右侧第一个非空bin的值，加上距离作为偏移，使不同的bin借用的值可以区分
+            first = min(bins)
+            last, value = first + k, bins[first]
+            for i in range(k - 1, -1, -1):
+                if sig[i] is None:
+                    sig[i] = value + ((last - i) << 64)
+                else:
+                    last, value = i, sig[i]
+        return sig
+
+    def pack(self, sig):
+        """只保留签名中每个值的最低8位，打包为一个整数（b-bit MinHash），用于快速估计相似度"""
+        return int(hexlify(bytearray(v & 0xff for v in sig)), 16)
+
+    def similarity(self, packed1, packed2):
+        """由两个pack()的结果估计Jaccard相似度"""
+        k = self.num_bins
+        same = unhexlify("%0*x" % (2 * k, packed1 ^ packed2)).count(b"\0") / float(k)
+        # 不同的值的最低8位也有1/256的概率相同
+        return (same - 1 / 256.0) / (1 - 1 / 256.0)
+
+    def cluster(self, result):
+        """对{bone: 计数}进行聚类
+
+        返回[(代表bone, 总计数, [(bone, 计数), ...]), ...]，按总计数从大到小排列，
+        每一类中计数最大的bone作为代表．
+        """
+        items = sorted(result.items(), key=lambda x: (x[0].taste or "", x[0].text))
+        sigs = [self.signature(bone.text) for bone, _ in items]
+        packed = [self.pack(x) for x in sigs]
+        parent = list(range(len(items)))
+
+        def find(i):
+            while parent[i] != i:
+                parent[i] = parent[parent[i]]
+                i = parent[i]
+            return i
+
+        buckets = {}
+        for i, sig in enumerate(sigs):
+            taste = items[i][0].taste
+            candidates = set()
+            for band in range(self.bands):
+                key = (taste, band, tuple(sig[band * self.rows:(band + 1) * self.rows]))
+                bucket = buckets.get(key)
+                if bucket is None:
+                    bucket = buckets[key] = deque(maxlen=self.bucket_size)
+                candidates.update(bucket)
+                bucket.append(i)
+            for j in sorted(candidates):
+                if find(i) != find(j) and self.similarity(packed[i], packed[j]) >= self.threshold:
+                    parent[find(i)] = find(j)
+
+        groups = {}
+        for i, item in enumerate(items):
+            groups.setdefault(find(i), []).append(item)
+        clusters = []
+        for members in groups.values():
+            members.sort(key=lambda x: -x[1])
+            clusters.append((members[0][0], sum(x[1] for x in members), members))
+        clusters.sort(key=lambda x: -x[1])
+        return clusters
+
+
+class SnapshotReporter:
+    '''--follow模式下定期输出统计结果
+
+    delta为False时每次输出全部统计结果，为True时只输出自上次输出以来计数有变化的bone．
+    由分析统计线程调用，因此看到的总是一致的统计结果．
+    '''
+
+    def __init__(self, fobj, delta=False):
+        self.fobj = fobj
+        self.delta = delta
+        self.last = {}
+
+    def __call__(self, counter):
+        items = list(counter.items())
+        changed = [x for x in items if x[2] != self.last.get(x[0], 0)]
+        by_source = getattr(counter, "by_source", False)
+        print("#" * 100, file=self.fobj)
+        print("snapshot at", time.strftime("%Y-%m-%d %H:%M:%S"), "bones =", len(items),
+              "changed =", len(changed), file=self.fobj)
+        for key, bone, value in (changed if self.delta else items):
+            print_bone(self.fobj, bone, value, value - self.last.get(key, 0) if self.delta else None,
+                       bone.source if by_source else None)
+        self.last = {key: value for key, _, value in items}
+        self.fobj.flush()
+
+
+class TextSink:
+    """以文本格式输出统计结果，与print_result相同"""
+
+    def __init__(self, fobj):
+        self.fobj = fobj
+
+    def write(self, counter):
+        by_source = getattr(counter, "by_source", False)
+        for _, bone, value in counter.items():
+            print_bone(self.fobj, bone, value, source=bone.source if by_source else None)
+        self.fobj.flush()
+
+    def close(self):
+        if self.fobj not in (sys.stdout, sys.stderr):
+            self.fobj.close()
+
+
+class JsonLinesSink:
+    """以JSON Lines格式输出统计结果，每个bone一行
+
+    每行包含taste、proc_name等字段、去重后的时间戳（stamps）、来源文件（sources）以及本次输出的时间，
+    逐条写入，不需要在内存中构造整个结果．多次输出（--follow模式的每次快照）会依次追加．
+    """
+
+    def __init__(self, fobj):
+        self.fobj = fobj
+
+    def write(self, counter):
+        now = time.strftime("%Y-%m-%d %H:%M:%S")
+        for record in counter.to_records():
+            record["time"] = now
+            self.fobj.write(json.dumps(record, sort_keys=True, ensure_ascii=False))
+            self.fobj.write("\n")
+        self.fobj.flush()
+
+    def close(self):
+        if self.fobj not in (sys.stdout, sys.stderr):
+            self.fobj.close()
+
+
+class SqliteSink:
+    """把统计结果批量写入SQLite数据库
+
+    每次输出作为runs表中的一次运行，bone写入bones表（按proc_name、ex_name、taste建立索引），
+    时间戳和来源文件分别写入stamps表和sources表，每次输出在一个事务中完成．
+    数据库可以被多次运行追加，直接用SQL查询历史结果．
+    """
+
+    SCHEMA = [
+        "CREATE TABLE IF NOT EXISTS runs (id INTEGER PRIMARY KEY, time TEXT)",
+        "CREATE TABLE IF NOT EXISTS bones (id INTEGER PRIMARY KEY, run_id INTEGER, taste TEXT, proc_name TEXT, "
+        "ex_name TEXT, ex_desc TEXT, count INTEGER, text TEXT)",
+        "CREATE TABLE IF NOT EXISTS stamps (bone_id INTEGER, stamp TEXT)",
+        "CREATE TABLE IF NOT EXISTS sources (bone_id INTEGER, source TEXT)",
+        "CREATE INDEX IF NOT EXISTS bones_run_id ON bones (run_id)",
+        "CREATE INDEX IF NOT EXISTS bones_proc_name ON bones (proc_name)",
+        "CREATE INDEX IF NOT EXISTS bones_ex_name ON bones (ex_name)",
+        "CREATE INDEX IF NOT EXISTS bones_taste ON bones (taste)",
+        "CREATE INDEX IF NOT EXISTS stamps_bone_id ON stamps (bone_id)",
+        "CREATE INDEX IF NOT EXISTS sources_bone_id ON sources (bone_id)",
+    ]
+
+    def __init__(self, path):
+        import sqlite3
+
+        # --follow模式下由分析统计线程写入
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            for sql in self.SCHEMA:
+                self.db.execute(sql)
+
+    def write(self, counter):
+        with self.db:
+            run_id = self.db.execute("INSERT INTO runs (time) VALUES (?)",
+                                     (time.strftime("%Y-%m-%d %H:%M:%S"),)).lastrowid
+            # bone的id在本次运行中连续分配，时间戳和来源文件可以一次批量插入
+            start = (self.db.execute("SELECT MAX(id) FROM bones").fetchone()[0] or 0) + 1
+            records = list(counter.to_records())
+            self.db.executemany(
+                "INSERT INTO bones (id, run_id, taste, proc_name, ex_name, ex_desc, count, text) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                ((start + i, run_id, r["taste"], r["proc_name"], r["ex_name"], r["ex_desc"], r["count"], r["text"])
+                 for i, r in enumerate(records)))
+            self.db.executemany("INSERT INTO stamps (bone_id, stamp) VALUES (?, ?)",
+                                ((start + i, x) for i, r in enumerate(records) for x in r["stamps"]))
+            self.db.executemany("INSERT INTO sources (bone_id, source) VALUES (?, ?)",
+                                ((start + i, x) for i, r in enumerate(records) for x in r["sources"]))
+
+    def close(self):
+        self.db.close()
+
+
+SINKS = {"text": TextSink, "jsonl": JsonLinesSink, "sqlite": SqliteSink}
+
+
+def open_sink(spec):
+    """按"格式:路径"创建输出，路径为"-"时输出到标准输出（sqlite只能输出到文件）"""
+    name, _, path = spec.partition(":")
+    if name not in SINKS or not path:
+        raise ValueError("bad sink %r, expected one of %s followed by :PATH" % (spec, ", ".join(sorted(SINKS))))
+    if name == "sqlite":
+        if path == "-":
+            raise ValueError("bad sink %r, sqlite cannot write to stdout" % spec)
+        return SqliteSink(path)
+    return SINKS[name](sys.stdout if path == "-" else open(path, "w", encoding="utf-8"))
+
+
+# 部分结果文件的格式名和版本号，格式改变时需要增加版本号
+PARTIAL_FORMAT = "logdog-partial"
+PARTIAL_VERSION = 1
+
+
+def partial_records(counter):
+    """把Counter转换为部分结果的记录，按bone文本的摘要排序
+
+    每条记录包含bone的文本、taste、proc_name等字段、去重后的时间戳和来源文件，计数由时间戳集合得到，不单独保存．
+    """
+    records = []
+    for r in counter.to_records():
+        del r["count"]
+        r["digest"] = hashlib.md5(r["text"].encode("utf-8")).hexdigest()
+        records.append(r)
+    records.sort(key=lambda r: r["digest"])
+    return records
+
+
+def write_partial(fname, records, fingerprint=None):
+    """把按摘要排序的记录写入部分结果文件
+
+    部分结果文件是gzip压缩的JSON Lines，第一行为格式名、版本号及taste配置的指纹．
+    记录逐条写入，可以直接写入merge_partials()的结果．
+    """
+    tmp_file = "%s.%d.tmp" % (fname, os.getpid())
+    with gzip.open(tmp_file, "wb") as f:
+        header = {"format": PARTIAL_FORMAT, "version": PARTIAL_VERSION, "fingerprint": fingerprint}
+        f.write((json.dumps(header, sort_keys=True) + "\n").encode("utf-8"))
+        for r in records:
+            f.write((json.dumps(r, sort_keys=True, ensure_ascii=False) + "\n").encode("utf-8"))
+    os.rename(tmp_file, fname)
+
+
+def read_partial(fname):
+    """读取部分结果文件，返回(文件头, 记录的迭代器)"""
+    f = gzip.open(fname, "rb")
+    header = json.loads(f.readline().decode("utf-8") or "{}")
+    if header.get("format") != PARTIAL_FORMAT:
+        f.close()
+        raise ValueError("%s is not a logdog partial result" % fname)
+    if header.get("version") != PARTIAL_VERSION:
+        f.close()
+        raise ValueError("%s is a version %s partial result, expected version %d"
+                         % (fname, header.get("version"), PARTIAL_VERSION))
+
+    def records():
+        last = ""
+        with f:
+            for line in f:
+                r = json.loads(line.decode("utf-8"))
+                if r["digest"] <= last:
+                    raise ValueError("%s is not sorted by digest" % fname)
+                last = r["digest"]
+                yield r
+
+    return header, records()
+
+
+def merge_partials(fnames):
+    """合并多个部分结果文件，返回(taste配置的指纹, 按摘要的顺序逐条返回合并后的记录的迭代器)
+
+    对各个文件做多路归并，同一个bone的时间戳集合和来源文件集合取并集，
+    因此重复出现在多个文件中的日志只计数一次．内存只与文件的个数及单个bone的时间戳个数有关．
+    taste配置的指纹不同时输出警告（它们的bone文本可能不是以同样的方式归一化的），返回的指纹为None．
+    """
+    streams = []
+    fingerprints = set()
+    for i, fname in enumerate(fnames):
+        header, records = read_partial(fname)
+        fingerprints.add(header.get("fingerprint"))
+        streams.append(((r["digest"], i, r) for r in records))
+    if len(fingerprints) > 1:
+        print("warning: merging partial results of different taste configs", file=sys.stderr)
+
+    def merged():
+        for _, group in groupby(heapq.merge(*streams), key=lambda x: x[0]):
+            record = None
+            for _, _, r in group:
+                if record is None:
+                    record = r
+                    stamps, sources = set(r["stamps"]), set(r["sources"])
+                else:
+                    stamps.update(r["stamps"])
+                    sources.update(r["sources"])
+            record["stamps"] = sorted(stamps, key=lambda x: (x is not None, x))
+            record["sources"] = sorted(sources)
+            yield record
+
+    return fingerprints.pop() if len(fingerprints) == 1 else None, merged()
+
+
+def merge_main(argv):
+    """logdog.py merge：合并多个节点的部分结果，输出最终的统计结果或者新的部分结果"""
+    parser = OptionParser(usage="%prog merge [options] partial.json.gz ...")
+    parser.add_option("-o", "--outfile",
+                      action="store",
+                      dest="outfile",
+                      help="Write result to OUTFILE, default is stdout"
+                      )
+    parser.add_option("--save-partial",
+                      action="store",
+                      dest="save_partial",
+                      help="Write the merged partial result to SAVE_PARTIAL instead of the text result"
+                      )
+    options, args = parser.parse_args(argv)
+    if not args:
+        parser.error("no partial result files")
+
+    try:
+        fingerprint, merged = merge_partials(args)
+        if options.save_partial:
+            write_partial(options.save_partial, merged, fingerprint)
+            return
+        outfobj = sys.stdout if options.outfile is None else open(options.outfile, mode="w", encoding="utf-8")
+        for r in merged:
+            bone = Bone(r["text"], None, r["proc_name"], r["ex_name"], r["ex_desc"], r["taste"])
+            print_bone(outfobj, bone, len(r["stamps"]))
+        if outfobj is not sys.stdout:
+            outfobj.close()
+    except Exception as ex:
+        print(ex, file=sys.stderr)
+        exit(1)
+
+
+class Uploader:
+    """在后台线程中把统计结果上传到服务器
+
+    put()只把Counter转换为记录放入队列，不会阻塞扫描；后台线程把队列中的记录凑成不超过batch_size条的一批，
+    以gzip压缩的JSON通过同一个HTTP连接POST到服务器．连接出错或服务器返回5xx时重新连接，
+    并按backoff * 2 ** n秒的间隔重试retries次．重试失败后，本批以及之后的数据都写入spool_dir，
+    成功上传一批后（包括下次运行时）再补传spool_dir中的数据．
+    服务器返回4xx时请求本身有误，重试和补传都不会成功，这一批写入spool_dir中以REJECTED_SUFFIX结尾的文件，
+    不再补传，也不影响之后的上传．
+    """
+
+    # _post的结果：上传成功，暂时无法上传（可以重试），被服务器拒绝
+    SENT, FAILED, REJECTED = range(3)
+    REJECTED_SUFFIX = ".rejected"
+
+    def __init__(self, host, port=80, path="/logdog/result", auth_key="", spool_dir=None,
+                 batch_size=500, retries=4, backoff=1.0, timeout=10):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.auth_key = auth_key
+        self.spool_dir = spool_dir
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.q = Queue()
+        self.conn = None
+        self.offline = False
+        self.spool_seq = 0
+        self.uploaded = 0
+        self.spooled = 0
+        self.rejected = 0
+
+    @classmethod
+    def from_config(cls, server, **kwargs):
+        spool_dir = server.get("spool_dir") or os.path.join(os.path.expanduser("~"), ".logdog", "spool")
+        return cls(server["ip"], server.get("port", 80), server.get("path", "/logdog/result"),
+                   server.get("auth_key", ""), spool_dir, **kwargs)
+
+    def start(self):
+        self.thr = Thread(target=self._run)
+        self.thr.daemon = True
+        self.thr.start()
+
+    def put(self, counter):
+        self.q.put(list(counter.to_records()))
+
+    def close(self):
+        """等待所有数据上传完成（或写入spool_dir）"""
+        self.q.put(None)
+        self.thr.join()
+        if self.conn is not None:
+            self.conn.close()
+
+    def _run(self):
+        self._send_spooled()
+        records = []
+        while True:
+            item = self.q.get()
+            if item is None:
+                break
+            records.extend(item)
+            while len(records) >= self.batch_size:
+                self._upload(self._payload(records[:self.batch_size]))
+                records = records[self.batch_size:]
+            # 上传期间放入队列的数据会合并为一批，队列中暂时没有数据时不再等待凑满一批
+            if records and self.q.empty():
+                self._upload(self._payload(records))
+                records = []
+        if records:
+            self._upload(self._payload(records))
+
+    def _payload(self, records):
+        data = json.dumps({"hostname": socket.gethostname(), "records": records}, sort_keys=True)
+        buf = BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+            f.write(data.encode("utf-8"))
+        return buf.getvalue()
+
+    def _upload(self, payload):
+        if not self.offline:
+            result = self._post(payload)
+            if result == self.SENT:
+                self.uploaded += 1
+                self._send_spooled()
+                return
+            if result == self.REJECTED:
+                self.rejected += 1
+                self._spool(payload, self.REJECTED_SUFFIX)
+                return
+        self.offline = True
+        if self._spool(payload):
+            self.spooled += 1
+
+    def _post(self, payload):
+        """上传一批数据，返回SENT、FAILED或REJECTED"""
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                if self.conn is None:
+                    self.conn = HTTPConnection(self.host, self.port, timeout=self.timeout)
+                self.conn.request("POST", self.path, payload, {
+                    "Content-Type": "application/json",
+                    "Content-Encoding": "gzip",
+                    "X-Auth-Key": self.auth_key,
+                })
+                response = self.conn.getresponse()
+                response.read()
+            except (IOError, OSError, HTTPException) as ex:
+                print("upload failed:", ex, file=sys.stderr)
+                if self.conn is not None:
+                    self.conn.close()
+                    self.conn = None
+                continue
+            if response.status < 300:
+                return self.SENT
+            print("upload failed: HTTP %d %s" % (response.status, response.reason), file=sys.stderr)
+            if response.status < 500:
+                # 请求本身有误，重试也不会成功
+                return self.REJECTED
+        return self.FAILED
+
+    def _spool(self, payload, suffix=""):
+        """把一批数据写入spool_dir，返回是否成功"""
+        if not self.spool_dir:
+            print("upload failed, result is dropped", file=sys.stderr)
+            return False
+        try:
+            if not os.path.isdir(self.spool_dir):
+                os.makedirs(self.spool_dir)
+            self.spool_seq += 1
+            name = "%d-%d-%d.json.gz%s" % (int(time.time() * 1000), os.getpid(), self.spool_seq, suffix)
+            tmp_file = os.path.join(self.spool_dir, name + ".tmp")
+            with open(tmp_file, "wb") as f:
+                f.write(payload)
+            os.rename(tmp_file, os.path.join(self.spool_dir, name))
+            return True
+        except (IOError, OSError) as ex:
+            print("spool failed:", ex, file=sys.stderr)
+            return False
+
+    def _send_spooled(self):
+        """按写入的顺序补传spool_dir中的数据，暂时无法上传时停止，被拒绝的数据改名后跳过"""
+        if not self.spool_dir or not os.path.isdir(self.spool_dir):
+            return
+        names = sorted((x for x in os.listdir(self.spool_dir) if x.endswith(".json.gz")),
+                       key=lambda x: [int(n) for n in x.split(".")[0].split("-")])
+        for name in names:
+            fname = os.path.join(self.spool_dir, name)
+            try:
+                with open(fname, "rb") as f:
+                    payload = f.read()
+            except (IOError, OSError):
+                continue
+            result = self._post(payload)
+            if result == self.FAILED:
+                self.offline = True
+                return
+            try:
+                if result == self.SENT:
+                    os.remove(fname)
+                else:
+                    os.rename(fname, fname + self.REJECTED_SUFFIX)
+            except OSError as ex:
+                print("spool failed:", ex, file=sys.stderr)
+            if result == self.SENT:
+                self.uploaded += 1
+            else:
+                self.rejected += 1
+
+
+class ResultCache:
+    """保存在磁盘上的扫描结果缓存
+
+    以日志文件的内容（或文件的大小、修改时间及inode）和taste配置的指纹作为key，
+    保存每个文件的统计结果（Counter对象）．再次扫描未改变的文件时直接读取缓存．
+    超过max_age秒未被使用的缓存会被删除，缓存总大小超过max_size字节时，删除最久未使用的缓存．
+    """
+
+    # 缓存格式或扫描结果的计算方法改变时需要增加版本号，使旧的缓存失效
+    VERSION = 4
+
+    def __init__(self, path, fingerprint, max_size=1 << 30, max_age=30 * 86400, content_hash=False):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_size = max_size
+        self.max_age = max_age
+        self.content_hash = content_hash
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _key(self, fname):
+        h = hashlib.sha1()
+        h.update(("%d\0%s\0" % (self.VERSION, self.fingerprint)).encode("utf-8"))
+        if self.content_hash:
+            with open(fname, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    h.update(block)
+        else:
+            st = os.stat(fname)
+            h.update(("%s\0%d\0%r\0%d" % (os.path.abspath(fname), st.st_size, st.st_mtime, st.st_ino)).encode("utf-8"))
+        return h.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".json.gz")
+
+    def get(self, fname):
+        """返回fname缓存的Counter对象，没有缓存时返回None"""
+        try:
+            cache_file = self._file(self._key(fname))
+            with gzip.open(cache_file, "rb") as f:
+                data = json.loads(f.read().decode("utf-8"))
+            # 更新访问时间，用于淘汰最久未使用的缓存
+            os.utime(cache_file, None)
+        except (IOError, OSError, ValueError):
+            return None
+        if data.get("version") != self.VERSION:
+            return None
+        # 按内容识别时，缓存可能来自内容相同的其他文件，把来源中的文件名换成fname，
+        # 归档中的文件仍然以"归档!文件"作为来源
+        cached_name = data["fname"]
+        for r in data["records"]:
+            r["sources"] = [fname + x[len(cached_name):] if x == cached_name or x.startswith(cached_name + "!") else x
+                            for x in r["sources"]]
+        return Counter.from_records(data["records"])
+
+    def put(self, fname, counter):
+        try:
+            cache_file = self._file(self._key(fname))
+        except (IOError, OSError):
+            return
+        data = {"version": self.VERSION, "fingerprint": self.fingerprint, "fname": fname,
+                "records": list(counter.to_records())}
+        # 先写入临时文件再改名，避免并发运行时读到不完整的缓存
+        tmp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+        # 与get相同，缓存只是尽力而为，磁盘已满、没有权限等错误不影响扫描
+        try:
+            with gzip.open(tmp_file, "wb") as f:
+                f.write(json.dumps(data).encode("utf-8"))
+            os.rename(tmp_file, cache_file)
+        except (IOError, OSError):
+            self._remove(tmp_file)
+
+    @staticmethod
+    def _remove(fname):
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
+
+    def evict(self):
+        entries = []
+        now = time.time()
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+        for name in names:
+            cache_file = os.path.join(self.path, name)
+            try:
+                st = os.stat(cache_file)
+            except OSError:
+                continue
+            if now - st.st_mtime > self.max_age:
+                self._remove(cache_file)
+            else:
+                entries.append((st.st_mtime, st.st_size, cache_file))
+
+        total = sum(x[1] for x in entries)
+        for mtime, size, cache_file in sorted(entries):
+            if total <= self.max_size:
+                break
+            # 已被其他进程删除时同样不再占用空间
+            self._remove(cache_file)
+            total -= size
+
+
+class NormalizeCache:
+    """bone规范化结果的LRU缓存
+
+    应用反复崩溃时，日志中会出现大量除了时间戳以外完全相同的bone．以(taste名, 去掉时间戳的文本)为key，
+    保存去掉随机字符串后的文本及从中解析出的item，最多保存size项，超过时淘汰最久未使用的一项．
+    不是线程安全的，只能在一个线程中使用．
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """返回key对应的(文本, item)，没有缓存时返回None"""
+        value = self.entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        # 重新插入到末尾，末尾为最近使用的一项
+        self.entries[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        if self.size <= 0:
+            return
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
 
 
 class LogDog:
@@ -80,11 +1930,45 @@ class LogDog:
     由两个线程构成，搜索线程（主线程）和分析统计线程．
     搜索线程根据taste提供的特征进行日志中搜索taste，将搜索到的异常信放入queue中
     分析统计线程从queue中取得异常信息，进行更为精确的匹配和统计．
+
+    pipeline决定搜索到的异常信息如何交给分析统计：
+    inline: 在搜索线程中直接分析统计，没有线程切换的开销
+    thread: 每batch_size个异常信息作为一批放入queue，由分析统计线程处理（默认）
+    process: 每batch_size个异常信息作为一批，由jobs个进程进行精确匹配，结果在主进程中统计
+    queue中最多有max_pending批异常信息（process模式下为正在处理的批数），
+    超过时搜索线程会等待，避免日志中bone很多时占用过多内存．
     """
 
-    def __init__(self):
-        self.q = Queue()
+    PIPELINES = ("inline", "thread", "process")
+
+    # load_config在每个taste中生成的对象
+    COMPILED_KEYS = ("line_classifier", "line_classifier_b", "chip_remover", "native_normalizer")
+
+    # demux模式下，bone超过这么多行没有续行时结束
+    DEMUX_TIMEOUT = 1000
+
+    # 规范化结果缓存的默认项数
+    NORMALIZE_CACHE_SIZE = 1024
+
+    def __init__(self, pipeline="thread", batch_size=1, jobs=None, max_pending=1024):
+        self.pipeline = pipeline
+        self.batch_size = batch_size
+        self.jobs = jobs
+        self.max_pending = max_pending
+        self.q = Queue(max_pending)
+        self.batch = []
+        self.pending = deque()
+        self.pool = None
         self.counter = Counter()
+        self.cache = None
+        self.uploader = None
+        self.time_window = None
+        self.demux = False
+        self.normalize_cache = NormalizeCache(self.NORMALIZE_CACHE_SIZE)
+        # 文件名 -> 与之前的文件重复、不需要扫描的字节范围，见find_overlaps
+        self.skip_ranges = {}
+        # --stats时由Stats.instrument设置，process模式的pipeline据此收集工作进程中的统计信息
+        self.stats = None
 
         # import json
         # print(json.dumps(self.config, indent=4, default=lambda x: repr(x)))
@@ -94,8 +1978,20 @@ class LogDog:
         from config import config
 
         logtype = config["logtype"]
-        logtype["charact_co"] = re.compile(logtype["charact"])
-        logtype["time_co"] = re.compile(logtype["time"])
+        name = logtype.get("type", "auto")
+        if name.startswith("logcat-"):
+            name = name[len("logcat-"):]
+        # printable与threadtime的格式相同
+        name = LOG_FORMAT_ALIASES.get(name, name)
+        if name != "auto" and name not in LOG_FORMATS:
+            raise ValueError("unknown log type: %s" % name)
+        # 为None时自动识别每个输入的格式
+        self.log_format = LOG_FORMATS.get(name)
+        # 旧版本的配置用正则表达式描述日志格式，现在已不再使用
+        ignored = sorted(k for k in ("charact", "time") if k in logtype)
+        if ignored:
+            print("warning: logtype %s ignored, the log format is given by type" % "/".join(ignored),
+                  file=sys.stderr)
 
         tastes = config["tastes"]
         for t in tastes:
@@ -105,51 +2001,348 @@ class LogDog:
             t["item"]["re_co"] = [re.compile(x) for x in t["item"]["re"]]
             t["item_repl_co"] = [re.compile(x) for x in t["item_repl"]]
 
+        self._taste_index = {id(t): i for i, t in enumerate(tastes)}
+        self.begin_matcher = TasteMatcher(tastes)
+        self.begin_matcher_b = TasteMatcher(tastes, binary=True)
+        for t in tastes:
+            t["line_classifier"] = LineClassifier(t, self.begin_matcher)
+            t["line_classifier_b"] = LineClassifier(t, self.begin_matcher_b, binary=True)
+            t["chip_remover"] = ChipRemover(t["item_repl_co"])
+            t["native_normalizer"] = NativeCrashNormalizer()
         self.config = config
         return True
 
+    def fingerprint(self):
+        """taste配置的指纹，配置改变时指纹随之改变"""
+        def source(obj):
+            # 去掉load_config中生成的正则表达式等对象，只保留配置本身
+            if isinstance(obj, dict):
+                return {k: source(v) for k, v in obj.items() if not k.endswith("_co") and k not in self.COMPILED_KEYS}
+            if isinstance(obj, list):
+                return [source(x) for x in obj]
+            return obj
+
+        parts = [source(self.config["logtype"]), source(self.config["tastes"])]
+        if self.time_window is not None:
+            # 时间范围不同时，同一个日志文件的统计结果也不同
+            parts.append([self.time_window.since, self.time_window.until])
+        if self.demux:
+            parts.append("demux")
+        text = json.dumps(parts, sort_keys=True)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
     def start(self):
-        # 启动分析统计线程
-        self.thr = Thread(target=self.parse_bone)
-        self.thr.start()
+        if self.pipeline == "thread":
+            # 启动分析统计线程
+            self.thr = Thread(target=self.parse_bone)
+            self.thr.start()
+        elif self.pipeline == "process":
+            from multiprocessing import Pool
+            self.pool = Pool(self.jobs, initializer=_init_worker, initargs=(None, False, self.stats is not None))
 
     def stop(self):
-        # 日志文件搜索结束,请求分析统计线程退出
-        self.q.put(("QUIT", None))
-        self.thr.join()
+        self._flush()
+        if self.pipeline == "thread":
+            # 日志文件搜索结束,请求分析统计线程退出
+            self.put_control(("QUIT", None))
+            self.thr.join()
+        elif self.pipeline == "process":
+            self._drain(0)
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def _flush(self):
+        """把当前这一批异常信息交给分析统计"""
+        if not self.batch:
+            return
+        batch, self.batch = self.batch, []
+        if self.pipeline == "thread":
+            self.put_control(("BONES", batch))
+        else:
+            index = self._taste_index
+            batch = [(info[0], index[id(info[1])]) + tuple(info[2:]) for info in batch]
+            self.pending.append(self.pool.apply_async(_make_bones_worker, (batch,)))
+            self._drain(self.max_pending)
+
+    def _drain(self, limit):
+        """按提交的顺序统计工作进程的处理结果，直到正在处理的批数不超过limit"""
+        while len(self.pending) > limit:
+            bones, stats = self.pending.popleft().get()
+            for bone in bones:
+                if bone is not None:
+                    self.counter.put(bone)
+            if stats is not None:
+                self.stats.merge(stats)
+
+    def put_control(self, item):
+        """把(名字, 参数)放入分析统计线程的queue
+
+        queue已满时等待，但分析统计线程已经退出时不再等待，抛出RuntimeError，避免扫描永远阻塞．
+        """
+        while True:
+            try:
+                self.q.put(item, timeout=0.5)
+                return
+            except Full:
+                if not self.thr.is_alive():
+                    raise RuntimeError("the parse thread has exited")
+
+    def _control(self, name, arg):
+        """在之前的异常信息都统计完成后，执行MERGE（合并Counter）或SNAPSHOT（输出统计结果）"""
+        self._flush()
+        if self.pipeline == "thread":
+            self.put_control((name, arg))
+            return
+        if self.pipeline == "process":
+            self._drain(0)
+        if name == "SNAPSHOT":
+            arg(self.counter)
+        elif name == "MERGE":
+            self.counter.merge(arg)
+
+    def _search(self, fobj, callback, binary=False, source=None):
+        """在fobj中搜索bone，每找到一个bone，以(bone_text, taste)调用callback
+
+        指定了source（日志文件名）时以(bone_text, taste, source)调用callback．
+        binary为True时，fobj返回的是未解码的bytes行，只有组成bone的行才会被解码，
+        无法解码的字节会被替换，不会影响整个文件的扫描．指定了time_window时，只保留时间在范围内的bone．
+        demux为True时按pid/tid分别收集bone，见_search_demux．
+        """
+        if self.demux:
+            return self._search_demux(fobj, callback, binary, source)
+        if binary:
+            begin_matcher = self.begin_matcher_b
+            classifier = "line_classifier_b"
+            crlf, lf = b"\r\n", b"\n"
+        else:
+            begin_matcher = self.begin_matcher
+            classifier = "line_classifier"
+            crlf, lf = "\r\n", "\n"
+        # 按字节范围扫描时，只在范围内寻找新的bone，但bone的续行可以超出范围
+        bounded = getattr(fobj, "in_range", None) is not None
+        for line in fobj:
+            if bounded and not fobj.in_range:
+                break
+            line = line.replace(crlf, lf)
+            t = begin_matcher.search(line)
+            if t is None:
+                continue
+
+            bone_text = []
+            bone_text.append(line)
+            classify = t[classifier].classify
+            # 找到所有续行
+            for xline in fobj:
+                xline = xline.replace(crlf, lf)
+                if classify(xline) == LineClassifier.CONTINUE:
+                    bone_text.append(xline)
+                else:
+                    fobj.put(xline)
+                    break
 
-    def _search(self, fobj, callback):
-        tastes = self.config["tastes"]
+            if not (callback is None):
+                self._found(bone_text, t, callback, binary, source)
+
+    def _found(self, bone_text, t, callback, binary, source):
+        if binary:
+            bone_text = [x.decode("utf-8", "replace") for x in bone_text]
+        window = self.time_window
+        if window is not None and not window.contains(self._parse_bone_time(bone_text, self.detect_type(bone_text))):
+            return
+        callback((bone_text, t) if source is None else (bone_text, t, source))
+
+    def _search_demux(self, fobj, callback, binary=False, source=None):
+        """按发出日志的pid/tid分别收集bone的_search
+
+        繁忙的设备上，其他线程的日志会插入ANR、native crash等bone的行之间，_search遇到第一个不是续行的行时
+        就结束bone，使bone被截断．这里为每个pid/tid保存一个正在收集的bone，一行日志只影响同一个线程的bone：
+        是续行时加入该bone，否则结束该bone并判断是否是新bone的开始．超过DEMUX_TIMEOUT行没有续行的bone
+        也会结束．每行只读取一次，不需要放回迭代器．没有pid/tid的行作为同一个线程处理，
+        FollowIter在没有新数据时返回的空行结束所有正在收集的bone．
+        """
+        if binary:
+            begin_matcher = self.begin_matcher_b
+            classifier = "line_classifier_b"
+            crlf, lf, dash = b"\r\n", b"\n", b"-"
+            levels = frozenset(x.encode("ascii") for x in LEVELS)
+        else:
+            begin_matcher = self.begin_matcher
+            classifier = "line_classifier"
+            crlf, lf, dash = "\r\n", "\n", "-"
+            levels = LEVELS
+        timeout = self.DEMUX_TIMEOUT
+        bounded = getattr(fobj, "in_range", None) is not None
+        # pid/tid -> [bone的行, taste, 判定续行的函数, 最后一行的行号]，按最后一行的行号排序
+        bones = OrderedDict()
+
+        def thread_of(line):
+            # threadtime及经过转换的格式："日期 时间 pid tid level ..."，epoch格式："时间 pid tid level ..."
+            parts = line.split(None, 5)
+            if len(parts) == 6 and parts[0][2:3] == dash and parts[4] in levels:
+                return parts[2], parts[3]
+            if len(parts) >= 5 and parts[3] in levels:
+                return parts[1], parts[2]
+            return None
+
+        def close(key):
+            bone = bones.pop(key)
+            if not (callback is None):
+                self._found(bone[0], bone[1], callback, binary, source)
+
+        n = 0
         for line in fobj:
-            line = line.replace("\r\n", "\n")
-            for t in tastes:
-                if re.search(t["begin_tag_co"], line):
-                    bone_text = []
-                    bone_text.append(line)
-                    # 找到所有续行
-                    for xline in fobj:
-                        xline = xline.replace("\r\n", "\n")
-                        if self._is_tag_line(xline, t):
-                            bone_text.append(xline)
-                        else:
-                            fobj.put(xline)
-                            break
-
-                    if not (callback is None):
-                        callback((bone_text, t))
+            n += 1
+            # 每行都结束超时的bone，只与bone最后一行的相对位置有关，按字节范围扫描时结果也相同
+            while bones:
+                key = next(iter(bones))
+                if n - bones[key][3] <= timeout:
                     break
+                close(key)
+            # 按字节范围扫描时，范围之后的行只用于结束范围内开始的bone
+            in_range = not bounded or fobj.in_range
+            if not in_range and not bones:
+                break
+            if not line:
+                for key in list(bones):
+                    close(key)
+                continue
+            line = line.replace(crlf, lf)
+
+            # 没有正在收集的bone时，只有新bone的开始才需要pid/tid
+            key = unknown = ()
+            if bones:
+                key = thread_of(line)
+                bone = bones.get(key)
+                if bone is not None:
+                    if bone[2](line) == LineClassifier.CONTINUE:
+                        bone[0].append(line)
+                        bone[3] = n
+                        # 移到末尾，保持按最后一行的行号排序（Python 2的OrderedDict没有move_to_end）
+                        bones[key] = bones.pop(key)
+                        continue
+                    close(key)
+            if in_range:
+                t = begin_matcher.search(line)
+                if t is not None:
+                    if key is unknown:
+                        key = thread_of(line)
+                    bones[key] = [[line], t, t[classifier].classify, n]
+
+        for key in list(bones):
+            close(key)
 
     def search(self, fobj):
         callback = self.put_queue
 
-        if isinstance(fobj, str):
+        if isinstance(fobj, str) and (self.cache is not None or self.uploader is not None):
+            counter = self.cache.get(fobj) if self.cache is not None else None
+            if counter is None:
+                counter = self.scan_file(fobj)
+                # 跳过了重复部分的结果不完整，不能作为这个文件的缓存
+                if self.cache is not None and fobj not in self.skip_ranges:
+                    self.cache.put(fobj, counter)
+            # 每个文件的结果扫描完即开始上传，与之后的文件的扫描同时进行
+            if self.uploader is not None:
+                self.uploader.put(counter)
+            # 在之前的bone统计完成后再合并，保证与逐个bone统计的顺序一致
+            self._control("MERGE", counter)
+        elif isinstance(fobj, str):
             try:
-                with open(fobj, "r", encoding="utf-8") as f:
-                    self._search(WrapIter(f), callback)
+                self._search_file(fobj, callback)
             except Exception as ex:
                 print(ex, file=sys.stderr)
         else:
-            self._search(WrapIter(fobj), callback)
+            source = getattr(fobj, "name", None)
+            self._search_stream(fobj, callback, source if isinstance(source, str) else None)
+
+    def _search_stream(self, fobj, callback, source=None):
+        """扫描只能顺序读取的日志，由开头的若干行识别日志格式"""
+        fobj = iter(fobj)
+        sample = list(islice(fobj, SNIFF_LINES))
+        if sample:
+            binary = isinstance(sample[0], bytes)
+            fobj = WrapIter(chain(sample, fobj))
+            self._search(self._format_iter(fobj, (b"" if binary else "").join(sample)), callback, binary=binary,
+                         source=source)
+
+    def _search_file(self, fname, callback):
+        """扫描一个日志文件，指定了time_window且假定日志有序时，只扫描二分查找得到的字节范围
+
+        压缩的日志及归档边解压边扫描，见iter_archive，此时只能逐行过滤time_window．
+        skip_ranges中有这个文件时，只扫描其余的字节范围．
+        """
+        if archive_type(fname) is not None:
+            for source, f in iter_archive(fname):
+                self._search_stream(f, callback, source)
+            return
+        skips = self.skip_ranges.get(fname)
+        if skips:
+            start, end = 0, os.path.getsize(fname)
+            if self.time_window is not None:
+                start, end = file_time_range(fname, self.time_window, self.log_format) or (start, end)
+            for piece in _subtract_ranges(start, end, skips):
+                self._search_range(fname, piece[0], piece[1], callback)
+            return
+        if self.time_window is not None:
+            time_range = file_time_range(fname, self.time_window, self.log_format)
+            if time_range is not None:
+                self._search_range(fname, time_range[0], time_range[1], callback)
+                return
+        with open(fname, "rb") as f:
+            sample = f.read(SNIFF_SIZE)
+            f.seek(0)
+            self._search(self._format_iter(WrapIter(f), sample), callback, binary=True, source=fname)
+
+    def _is_boundary(self, line):
+        """line之后没有正在收集的bone：不是任何taste的续行，也不是新bone的开始"""
+        line = line.replace(b"\r\n", b"\n")
+        if self.begin_matcher_b.search(line) is not None:
+            return False
+        return all(t["line_classifier_b"].classify(line) != LineClassifier.CONTINUE for t in self.config["tastes"])
+
+    def find_overlaps(self, fnames):
+        """返回fnames中与之前的文件重复、可以跳过的字节范围，见find_overlaps
+
+        重复的bone时间戳也相同，Counter只统计一次，因此跳过重复部分不改变统计结果，只是bone的来源文件中
+        不再包含重复的文件．demux模式、压缩文件以及需要转换格式的日志（brief、long）不参与重复检测．
+        """
+        if self.demux:
+            return {}
+        candidates, seen = [], set()
+        for fname in fnames:
+            path = os.path.realpath(fname)
+            if archive_type(fname) is not None or path in seen:
+                continue
+            try:
+                with open(fname, "rb") as f:
+                    sample = f.read(SNIFF_SIZE)
+            except (IOError, OSError):
+                continue
+            if (self.log_format or sniff_format(sample) or LOG_FORMATS["threadtime"]).convert is None:
+                candidates.append(fname)
+                seen.add(path)
+        return find_overlaps(candidates, self._is_boundary)
+
+    def _search_range(self, fname, start, end, callback):
+        import mmap
+
+        if start >= end:
+            return
+        with open(fname, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                fobj = self._format_iter(RangeIter(mm, start, end), mm[:SNIFF_SIZE], _line_start(mm, start))
+                self._search(fobj, callback, binary=True, source=fname)
+            finally:
+                mm.close()
+
+    def _format_iter(self, fobj, sample, offset=0):
+        """按配置的或者从sample识别出的日志格式，需要时用FormatIter包装fobj"""
+        fmt = self.log_format or sniff_format(sample) or LOG_FORMATS["threadtime"]
+        if fmt.convert is None:
+            return fobj
+        return FormatIter(fobj, fmt, offset)
 
     def _is_tag_line(self, line, tast):
         '''
@@ -157,54 +2350,47 @@ class LogDog:
 
         如果tast.line_tag能够被line匹配，并且不能被所有tasts[x].line_tag匹配，则返回True，否则返回False
         '''
-        line_tag = None
-        for tag in tast["line_tag"]:
-            if re.search(tag, line):
-                line_tag = tag
-        if line_tag is None:
-            return False
-
-        if "end_tag_co" in tast and re.search(tast["end_tag_co"], line):
-            return False
-
-        tastes = self.config["tastes"]
-        for t in tastes:
-            if re.search(t["begin_tag_co"], line):
-                return False
-
-        return True
+        return tast["line_classifier"].classify(line) == LineClassifier.CONTINUE
 
     def put_queue(self, bone_info):
         # print("put_queue")
-        self.q.put(bone_info)
+        if self.pipeline == "inline":
+            self._count_bone(self.counter, bone_info)
+            return
+        self.batch.append(bone_info)
+        if len(self.batch) >= self.batch_size:
+            self._flush()
 
     def detect_type(self, text):
-        logtype = self.config["logtype"]
+        """识别bone的格式，返回LogFormat对象
+
+        每个bone分别识别，因此混合了多种格式的日志也能正确处理．
+        """
         for line in text:
-            if re.search(logtype["charact_co"], line):
-                return logtype
+            for fmt in BONE_FORMATS:
+                if fmt.split(line) is not None:
+                    return fmt
 
     def _parse_bone_time(self, text, logtype):
+        if logtype is None:
+            return None
         for line in text:
-            match = re.search(logtype["time_co"], line)
-            if match:
-                return match.group()
+            parts = logtype.split(line)
+            if parts is not None:
+                return None if parts[0] == BriefFormat.NO_STAMP else parts[0]
 
     def _remove_time_stamp(self, text, logtype):
-        new_text = [re.sub(logtype["charact_co"], "", line) for line in text]
+        if logtype is None:
+            return "".join(text)
+        split = logtype.split
+        new_text = []
+        for line in text:
+            parts = split(line)
+            new_text.append(line if parts is None else parts[1])
         return "".join(new_text)
 
     def _remove_text_chip(self, text, taste):
-        for x in taste["item_repl_co"]:
-            match = re.search(x, text)
-            if match:
-                arr_text = array.array("u", text)
-                spans = match.regs
-                groupdict = dict(zip(x.groupindex.values(), x.groupindex.keys()))
-                for i in range(len(spans) - 1, 0, -1):
-                    arr_text[slice(*spans[i])] = array.array("u", u"<" + groupdict[i] + u">")
-                text = arr_text.tounicode()
-        return text
+        return taste["chip_remover"].remove(text)
 
     def _parse_bone_item(self, text, taste):
         item = taste["item"]
@@ -219,42 +2405,28 @@ class LogDog:
     def native_crash_repl(self, text, taste):
         """处理native-crash日志中出现的内存地址等随机数字
 
-        目前处理方式是删除这些行
-        TODO(jinle): 将内存地址这样的随机数字替换为<addr>
+        寄存器、backtrace中的pc等替换为占位符，见NativeCrashNormalizer
         """
-        text_list = text.split("\n")
-        start_co = re.compile(r"signal.*, code.*, fault addr")
-        end_co = re.compile(r"backtrace:$")
-        start = 0
-        end = 0
-        for no, line in enumerate(text_list):
-            if start == 0 and re.search(start_co, line):
-                start = no
-            if end == 0 and re.search(end_co, line):
-                end = no
-            if start != 0 and end != 0:
-                break
-        for i in range(end - 1, start, -1):
-            if text_list[i].find("    ") > 0:
-                del text_list[i]
-
-        return "\n".join(text_list)
+        return taste["native_normalizer"].normalize(text)
 
-    def parse_bone(self, **kargs):
-        while True:
-            bone_info = self.q.get()
-            text = bone_info[0]
-            taste = bone_info[1]
+    def make_bone(self, bone_info):
+        """对搜索到的异常信息进行精确匹配，生成Bone对象
 
-            if text == "QUIT":
-                break
-
-            logtype = self.detect_type(text)
-            # print(logtype)
-            time_stamp = self._parse_bone_time(text, logtype)
-            # print(time_stamp)
-            notime_text = self._remove_time_stamp(text, logtype)
-            # print(notime_text)
+        bone_info为(bone_text, taste)或(bone_text, taste, 来源文件)．
+        去掉时间戳后相同的bone只规范化一次，结果保存在normalize_cache中．
+        """
+        text = bone_info[0]
+        taste = bone_info[1]
+
+        logtype = self.detect_type(text)
+        # print(logtype)
+        time_stamp = self._parse_bone_time(text, logtype)
+        # print(time_stamp)
+        notime_text = self._remove_time_stamp(text, logtype)
+        # print(notime_text)
+        key = taste["name"], notime_text
+        cached = self.normalize_cache.get(key)
+        if cached is None:
             new_text = self._remove_text_chip(notime_text, taste)
             # print(new_text)
             if "method_repl" in taste:
@@ -262,26 +2434,415 @@ class LogDog:
                     new_text = methodcaller("native_crash_repl", new_text, taste)(self)
 
             items = self._parse_bone_item(new_text, taste)
-            bone = Bone(new_text, time_stamp, **items)
-            self.counter.put(bone)
+            self.normalize_cache.put(key, (new_text, items))
+        else:
+            new_text, items = cached
+        source = bone_info[2] if len(bone_info) > 2 else None
+        return Bone(new_text, time_stamp, taste=taste["name"], source=source, **items)
+
+    def try_make_bone(self, bone_info):
+        """与make_bone相同，但一个bone无法解析（例如native crash缺少pid行）时输出错误并返回None
+
+        跳过这个bone，继续扫描之后的日志，分析统计线程和工作进程也不会因此退出．
+        """
+        try:
+            return self.make_bone(bone_info)
+        except Exception as ex:
+            print(ex, file=sys.stderr)
+            return None
+
+    def _count_bone(self, counter, bone_info):
+        bone = self.try_make_bone(bone_info)
+        if bone is not None:
+            counter.put(bone)
+
+    def parse_bone(self, **kargs):
+        while True:
+            name, arg = self.q.get()
+
+            if name == "QUIT":
+                break
+            elif name == "SNAPSHOT":
+                # 在分析统计线程中输出当前的统计结果
+                try:
+                    arg(self.counter)
+                except Exception as ex:
+                    print(ex, file=sys.stderr)
+            elif name == "MERGE":
+                self.counter.merge(arg)
+            else:
+                for bone_info in arg:
+                    self._count_bone(self.counter, bone_info)
         return 0
 
+    def follow(self, fobj, report, interval=None, every=None):
+        """持续扫描不断增长的日志（FollowIter或标准输入），直到读完或被中断
+
+        每隔interval秒，以及每找到every个bone，通过queue请求分析统计线程调用report输出统计结果．
+        需要使用thread模式的pipeline，并先调用start()启动分析统计线程．
+        不断增长的日志无法预先识别格式，brief和long格式的日志需要在config的logtype中指定．
+        """
+        found = [0]
+
+        def callback(bone_info):
+            self.put_queue(bone_info)
+            # 不等待凑满一批，使统计结果及时更新
+            self._flush()
+            found[0] += 1
+            if every and found[0] % every == 0:
+                self._control("SNAPSHOT", report)
+
+        stop = Event()
+
+        def timer():
+            while not stop.wait(interval):
+                self.put_control(("SNAPSHOT", report))
+
+        if interval:
+            thr = Thread(target=timer)
+            thr.daemon = True
+            thr.start()
+        try:
+            self._search(self._format_iter(WrapIter(fobj), b""), callback, binary=True,
+                         source=getattr(fobj, "fname", None))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stop.set()
+
+    def scan_file(self, fname):
+        """在当前线程中扫描一个日志文件，返回该文件的统计结果（Counter对象）
+
+        不经过queue和分析统计线程，供多进程扫描时在工作进程中使用．
+        """
+        counter = Counter()
+
+        def callback(bone_info):
+            self._count_bone(counter, bone_info)
+
+        try:
+            self._search_file(fname, callback)
+        except Exception as ex:
+            print(ex, file=sys.stderr)
+        return counter
+
+    def scan_member(self, fname, member):
+        """扫描zip文件中的一个文件，返回统计结果（Counter对象）"""
+        counter = Counter()
+
+        def callback(bone_info):
+            self._count_bone(counter, bone_info)
+
+        try:
+            z, f = open_zip_member(fname, member)
+            try:
+                self._search_stream(f, callback, _member_source(fname, member))
+            finally:
+                f.close()
+                z.close()
+        except Exception as ex:
+            print(ex, file=sys.stderr)
+        return counter
+
+    def scan_range(self, fname, start, end):
+        """扫描日志文件中[start, end)字节范围内开始的bone，返回统计结果（Counter对象）
+
+        起止位置会对齐到行首．开始于范围内的bone由本范围负责，即使其续行超出了范围；
+        范围开头属于上一个范围中bone的续行不会匹配任何begin_tag，因此会被直接跳过．
+        按顺序合并各个范围的结果，与整体扫描文件的结果完全相同．
+        """
+        counter = Counter()
+
+        def callback(bone_info):
+            self._count_bone(counter, bone_info)
+
+        try:
+            self._search_range(fname, start, end, callback)
+        except Exception as ex:
+            print(ex, file=sys.stderr)
+        return counter
+
     def print_result(self, fobj):
-        for key, value in self.counter.result().items():
-            print("=" * 100, file=fobj)
-            print("count =", value, "proc_name =", key.proc_name, "exception =", key.ex_name, file=fobj)
-            print("-" * 100, file=fobj)
-            print(key.text, file=fobj)
+        TextSink(fobj).write(self.counter)
+
+    def print_clusters(self, fobj, clusterer):
+        for bone, count, members in clusterer.cluster(self.counter.result()):
+            print_cluster(fobj, bone, count, members)
+        fobj.flush()
+
+
+class BoneScanner:
+    """由调用方逐行推入日志的_search
+
+    _search从迭代器中读取日志，读不到数据时只能阻塞；BoneScanner由feed()每次推入一行bytes，
+    不阻塞，因此可以在同一个线程（例如asyncio的事件循环）中交替扫描多个输入．
+    找到的bone与_search相同，以(bone_text, taste, source)调用callback，推入空行或者调用close()时
+    结束正在收集的bone．日志不经过FormatIter转换，只支持不需要转换的日志格式．
+    """
+
+    def __init__(self, logdog, callback, source=None):
+        self.begin_matcher = logdog.begin_matcher_b
+        self.logdog = logdog
+        self.callback = callback
+        self.source = source
+        self.bone_text = None
+        self.taste = None
+        self.classify = None
+
+    def feed(self, line):
+        line = line.replace(b"\r\n", b"\n")
+        if self.bone_text is not None:
+            if self.classify(line) == LineClassifier.CONTINUE:
+                self.bone_text.append(line)
+                return
+            self.close()
+        t = self.begin_matcher.search(line)
+        if t is not None:
+            self.bone_text = [line]
+            self.taste = t
+            self.classify = t["line_classifier_b"].classify
+
+    def close(self):
+        if self.bone_text is None:
+            return
+        bone_text = [x.decode("utf-8", "replace") for x in self.bone_text]
+        self.bone_text = None
+        window = self.logdog.time_window
+        if window is not None and not window.contains(self.logdog._parse_bone_time(
+                bone_text, self.logdog.detect_type(bone_text))):
+            return
+        self.callback((bone_text, self.taste, self.source))
+
+
+try:
+    _wall_clock = time.perf_counter
+    _cpu_clock = getattr(time, "thread_time", time.process_time)
+except AttributeError:
+    _wall_clock = time.time
+    _cpu_clock = time.clock
+
+
+class _CountingRegex(object):
+    """记录search调用次数的正则表达式包装"""
+
+    def __init__(self, co, counts, name):
+        self.co = co
+        self.pattern = co.pattern
+        self.counts = counts
+        self.name = name
+
+    def search(self, *args):
+        self.counts[self.name] += 1
+        return self.co.search(*args)
+
+
+class _CountingMatcher(object):
+    """记录搜索线程调用次数的TasteMatcher包装，调用次数用于计算扫描的行数"""
+
+    def __init__(self, matcher, stats):
+        self.matcher = matcher
+        self.stats = stats
+
+    def search(self, line):
+        self.stats.idle_lines += 1
+        return self.matcher.search(line)
+
+
+class Stats:
+    """记录各个处理阶段的耗时及扫描统计信息，用于--stats
+
+    instrument()只替换LogDog对象的方法和正则表达式对象，不使用--stats时没有任何额外开销．
+    使用多进程（--jobs或process模式的pipeline）时，工作进程同样记录，每个任务之后由take()取出交给主进程，
+    主进程用merge()合并．
+    """
+
+    STAGES = ("_search", "detect_type", "_parse_bone_time", "_remove_time_stamp",
+              "_remove_text_chip", "native_crash_repl", "_parse_bone_item")
+
+    def __init__(self):
+        # 阶段名 -> [调用次数, 墙上时间, CPU时间]
+        self.stages = {}
+        self.regex = {"begin_tag": 0, "line_tag": 0, "end_tag": 0}
+        # taste名 -> [bone个数, bone的总行数]
+        self.bones = {}
+        self.idle_lines = 0
+        self.queue_high = 0
+        self.normalize_cache = None
+        # 工作进程中规范化缓存的命中及未命中次数
+        self.worker_cache = [0, 0]
+
+    def take(self):
+        """返回可以在进程间传递的统计数据，并把已经取出的部分清零"""
+        cache = self.normalize_cache
+        data = {
+            "stages": {k: list(v) for k, v in self.stages.items()},
+            "regex": dict(self.regex),
+            "bones": {k: list(v) for k, v in self.bones.items()},
+            "idle_lines": self.idle_lines,
+            "cache": [0, 0] if cache is None else [cache.hits, cache.misses],
+        }
+        # 各个包装函数持有stages和regex中的对象，只能原地清零
+        for v in self.stages.values():
+            v[:] = [0, 0.0, 0.0]
+        for k in self.regex:
+            self.regex[k] = 0
+        self.bones.clear()
+        self.idle_lines = 0
+        if cache is not None:
+            cache.hits = cache.misses = 0
+        return data
+
+    def merge(self, data):
+        """合并工作进程中take()取出的统计数据"""
+        for k, v in data["stages"].items():
+            entry = self.stages.setdefault(k, [0, 0.0, 0.0])
+            for i in range(3):
+                entry[i] += v[i]
+        for k, v in data["regex"].items():
+            self.regex[k] = self.regex.get(k, 0) + v
+        for k, v in data["bones"].items():
+            entry = self.bones.setdefault(k, [0, 0])
+            entry[0] += v[0]
+            entry[1] += v[1]
+        self.idle_lines += data["idle_lines"]
+        self.worker_cache[0] += data["cache"][0]
+        self.worker_cache[1] += data["cache"][1]
+
+    def _timed(self, name, func):
+        entry = self.stages.setdefault(name, [0, 0.0, 0.0])
+
+        def wrapper(*args, **kwargs):
+            wall, cpu = _wall_clock(), _cpu_clock()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                entry[0] += 1
+                entry[1] += _wall_clock() - wall
+                entry[2] += _cpu_clock() - cpu
+        return wrapper
+
+    def instrument(self, logdog):
+        logdog.stats = self
+        for name in self.STAGES[1:]:
+            setattr(logdog, name, self._timed(name, getattr(logdog, name)))
+        self._instrument_search(logdog)
+        self.normalize_cache = logdog.normalize_cache
+
+        for matcher in (logdog.begin_matcher, logdog.begin_matcher_b):
+            matcher.begin_cos = [_CountingRegex(co, self.regex, "begin_tag") for co in matcher.begin_cos]
+            if matcher.combined_co is not None:
+                matcher.combined_co = _CountingRegex(matcher.combined_co, self.regex, "begin_tag")
+        logdog.begin_matcher = _CountingMatcher(logdog.begin_matcher, self)
+        logdog.begin_matcher_b = _CountingMatcher(logdog.begin_matcher_b, self)
+        for t in logdog.config["tastes"]:
+            for classifier in (t["line_classifier"], t["line_classifier_b"]):
+                classifier.line_co = _CountingRegex(classifier.line_co, self.regex, "line_tag")
+                if classifier.end_co is not None:
+                    classifier.end_co = _CountingRegex(classifier.end_co, self.regex, "end_tag")
+
+        flush = logdog._flush
+
+        def _flush():
+            flush()
+            depth = logdog.q.qsize() if logdog.pipeline == "thread" else len(logdog.pending)
+            self.queue_high = max(self.queue_high, depth)
+        logdog._flush = _flush
+
+    def _instrument_search(self, logdog):
+        search = logdog._search
+        entry = self.stages.setdefault("_search", [0, 0.0, 0.0])
+
+        def _search(fobj, callback, binary=False, source=None):
+            # callback（交给分析统计）的耗时不计入_search
+            def counting_callback(bone_info):
+                bones = self.bones.setdefault(bone_info[1]["name"], [0, 0])
+                bones[0] += 1
+                bones[1] += len(bone_info[0])
+                wall, cpu = _wall_clock(), _cpu_clock()
+                try:
+                    if callback is not None:
+                        callback(bone_info)
+                finally:
+                    entry[1] -= _wall_clock() - wall
+                    entry[2] -= _cpu_clock() - cpu
+
+            return self._timed("_search", search)(fobj, counting_callback, binary, source)
+        logdog._search = _search
+
+    def instrument_counter(self, counter):
+        counter.result = self._timed("Counter.result", counter.result)
+        # 文本输出使用生成器items()，计时时一次取出全部结果
+        items = self._timed("Counter.result", lambda items=counter.items: list(items()))
+        counter.items = lambda: iter(items())
+
+    @property
+    def lines(self):
+        # 每个bone的续行不经过搜索线程的begin_tag匹配，结束bone的行则会被重新匹配一次
+        return self.idle_lines + sum(x[1] - x[0] for x in self.bones.values())
+
+    def to_dict(self):
+        return {
+            "stages": {k: {"calls": v[0], "wall": round(v[1], 6), "cpu": round(v[2], 6)}
+                       for k, v in self.stages.items()},
+            "lines": self.lines,
+            "regex_calls": dict(self.regex),
+            "bones": {k: {"count": v[0], "avg_lines": round(float(v[1]) / v[0], 2)} for k, v in self.bones.items()},
+            "queue_high_water": self.queue_high,
+            "normalize_cache": None if self.normalize_cache is None and not any(self.worker_cache) else
+            {"hits": self.worker_cache[0] + getattr(self.normalize_cache, "hits", 0),
+             "misses": self.worker_cache[1] + getattr(self.normalize_cache, "misses", 0)},
+        }
+
+    def report(self, fobj):
+        data = self.to_dict()
+        print("%-24s %10s %12s %12s" % ("stage", "calls", "wall(s)", "cpu(s)"), file=fobj)
+        for name in self.STAGES + ("Counter.result",):
+            if name in data["stages"]:
+                x = data["stages"][name]
+                print("%-24s %10d %12.6f %12.6f" % (name, x["calls"], x["wall"], x["cpu"]), file=fobj)
+        print("lines scanned: %d" % data["lines"], file=fobj)
+        print("regex calls: " + ", ".join("%s = %d" % x for x in sorted(data["regex_calls"].items())), file=fobj)
+        for name, x in sorted(data["bones"].items()):
+            print("taste %-20s bones = %-8d avg lines = %.2f" % (name, x["count"], x["avg_lines"]), file=fobj)
+        print("queue high-water mark: %d" % data["queue_high_water"], file=fobj)
+        if data["normalize_cache"] is not None:
+            print("normalize cache: hits = %(hits)d, misses = %(misses)d" % data["normalize_cache"], file=fobj)
+
+
+def print_bone(fobj, bone, count, delta=None, source=None):
+    print("=" * 100, file=fobj)
+    prefix = [] if source is None else ["source =", source]
+    if delta is None:
+        print(*(prefix + ["count =", count, "proc_name =", bone.proc_name, "exception =", bone.ex_name]), file=fobj)
+    else:
+        print(*(prefix + ["count =", count, "delta = %+d" % delta, "proc_name =", bone.proc_name,
+                          "exception =", bone.ex_name]), file=fobj)
+    print("-" * 100, file=fobj)
+    print(bone.text, file=fobj)
+
+
+def print_cluster(fobj, bone, count, members):
+    print_bone(fobj, bone, count)
+    if len(members) > 1:
+        print("-" * 100, file=fobj)
+        print("similar bones =", len(members) - 1, file=fobj)
+        for x, n in members[1:]:
+            print("    count =", n, "proc_name =", x.proc_name, "exception =", x.ex_name, file=fobj)
 
 
 class Bone(object):
 
-    def __init__(self, text, time_stamp, proc_name, ex_name, ex_desc):
+    __slots__ = ("text", "time_stamp", "proc_name", "ex_name", "ex_desc", "taste", "source")
+
+    def __init__(self, text, time_stamp, proc_name, ex_name, ex_desc, taste=None, source=None):
         self.text = text
         self.time_stamp = time_stamp
         self.proc_name = proc_name
         self.ex_name = ex_name
         self.ex_desc = ex_desc
+        # taste的名字及bone所在的日志文件
+        self.taste = taste
+        self.source = source
 
     def __repr__(self):
         return 'Bone(proc_name={0.proc_name!r}, ex_name={0.ex_name!r})'.format(self)
@@ -296,19 +2857,300 @@ class Bone(object):
         return self.text != other.text
 
 
+# 多进程扫描时，每个工作进程持有一个独立的LogDog对象，使用--stats时还有一个Stats对象
+_worker_logdog = None
+_worker_stats = None
+
+
+def _init_worker(time_window=None, demux=False, stats=False):
+    global _worker_logdog, _worker_stats
+    _worker_logdog = LogDog()
+    _worker_logdog.load_config()
+    _worker_logdog.time_window = time_window
+    _worker_logdog.demux = demux
+    if stats:
+        _worker_stats = Stats()
+        _worker_stats.instrument(_worker_logdog)
+
+
+def _take_worker_stats():
+    return None if _worker_stats is None else _worker_stats.take()
+
+
+def _make_bones_worker(batch):
+    """返回(Bone对象的列表, 统计信息)，无法解析的bone为None，由主进程跳过"""
+    tastes = _worker_logdog.config["tastes"]
+    bones = [_worker_logdog.try_make_bone((info[0], tastes[info[1]]) + tuple(info[2:])) for info in batch]
+    return bones, _take_worker_stats()
+
+
+def _scan_file_worker(task):
+    """返回(Counter对象, 统计信息)"""
+    if len(task) == 2:
+        # (zip文件, 其中的一个文件)
+        counter = _worker_logdog.scan_member(*task)
+    else:
+        fname, start, end = task
+        if start is None:
+            counter = _worker_logdog.scan_file(fname)
+        else:
+            counter = _worker_logdog.scan_range(fname, start, end)
+    return counter, _take_worker_stats()
+
+
+# 大于此大小的文件会被切分为多个字节范围并行扫描
+CHUNK_SIZE = 64 << 20
+
+
+def _split_tasks(fnames, chunk_size, time_window=None, log_format=None, skip_ranges=None):
+    for fname in fnames:
+        kind = archive_type(fname)
+        if kind == "zip":
+            try:
+                members = zip_members(fname)
+            except (IOError, OSError, zipfile.BadZipfile):
+                members = None
+            if members is not None:
+                for member in members:
+                    yield fname, member
+                continue
+        if kind is not None:
+            # gzip和tar只能从头顺序解压，不能切分
+            yield fname, None, None
+            continue
+        skips = skip_ranges.get(fname) if skip_ranges else None
+        try:
+            start, end = 0, os.path.getsize(fname)
+            if time_window is not None:
+                time_range = file_time_range(fname, time_window, log_format)
+                if time_range is not None:
+                    start, end = time_range
+                elif not skips:
+                    # 日志不是按时间排序时由工作进程逐行扫描并过滤
+                    start, end = None, None
+        except (OSError, ValueError):
+            start, end, skips = None, None, None
+        if skips:
+            for piece_start, piece_end in _subtract_ranges(start, end, skips):
+                for pos in range(piece_start, piece_end, chunk_size):
+                    yield fname, pos, min(pos + chunk_size, piece_end)
+            continue
+        if start is None or (time_window is None and end <= chunk_size):
+            yield fname, None, None
+            continue
+        for pos in range(start, end, chunk_size):
+            yield fname, pos, min(pos + chunk_size, end)
+
+
+def scan_files_parallel(fnames, jobs, chunk_size=CHUNK_SIZE, cache=None, uploader=None,
+                        time_window=None, log_format=None, demux=False, skip_ranges=None, stats=None):
+    """使用jobs个进程并行扫描多个日志文件，返回合并后的Counter对象
+
+    每个工作进程对分配到的文件分别统计，超过chunk_size的文件会按字节范围切分后分别统计，
+    zip文件中的各个文件也分别统计，主进程按文件及范围的顺序合并各部分结果．指定了cache（ResultCache对象）时，
+    有缓存的文件不再扫描，新扫描的文件的结果会写入缓存．指定了uploader（Uploader对象）时，
+    每个文件的结果统计完成后即放入上传队列．指定了time_window（TimeWindow对象）时，
+    只切分和扫描二分查找得到的字节范围，log_format为配置的日志格式．demux为True时按pid/tid分别收集bone．
+    skip_ranges为LogDog.find_overlaps的结果，其中的字节范围不扫描．
+    指定了stats（Stats对象）时，工作进程中的统计信息合并到stats中．
+    """
+    from multiprocessing import Pool
+
+    cached = {}
+    if cache is not None:
+        for fname in fnames:
+            partial = cache.get(fname)
+            if partial is not None:
+                cached[fname] = partial
+
+    file_tasks = [[] if x in cached else list(_split_tasks([x], chunk_size, time_window, log_format, skip_ranges))
+                  for x in fnames]
+    counter = Counter()
+    pool = Pool(jobs, initializer=_init_worker, initargs=(time_window, demux, stats is not None))
+    try:
+        results = pool.imap(_scan_file_worker, [task for tasks in file_tasks for task in tasks])
+        for fname, tasks in zip(fnames, file_tasks):
+            partial = cached.get(fname)
+            if partial is None:
+                partial = Counter()
+                for task in tasks:
+                    result, worker_stats = next(results)
+                    partial.merge(result)
+                    if worker_stats is not None:
+                        stats.merge(worker_stats)
+                if cache is not None and not (skip_ranges and fname in skip_ranges):
+                    cache.put(fname, partial)
+            if uploader is not None:
+                uploader.put(partial)
+            counter.merge(partial)
+    finally:
+        pool.close()
+        pool.join()
+    return counter
+
+
 def parse_args():
-    parser = OptionParser(usage="%prog [optinos] [logcat.txt ...]")
+    parser = OptionParser(usage="%prog [optinos] [logcat.txt ...]\n       %prog merge [options] partial.json.gz ...")
     parser.add_option("-u", "--upload-result",
                       dest="upload_result",
                       action="store_true",
                       default=False,
-                      help="Upload result to server after scan over"
+                      help="Upload the result of each log file to the server in config.py while scanning"
                       )
     parser.add_option("-o", "--outfile",
                       action="store",
                       dest="outfile",
                       help="Write result to OUTFILE, default is stdout"
                       )
+    parser.add_option("-j", "--jobs",
+                      action="store",
+                      type="int",
+                      dest="jobs",
+                      default=1,
+                      help="Scan log files with JOBS processes, default is 1"
+                      )
+    parser.add_option("--pipeline",
+                      action="store",
+                      type="choice",
+                      choices=LogDog.PIPELINES,
+                      default="thread",
+                      help="How found bones are parsed: inline (no thread), thread (a parse thread) "
+                           "or process (a pool of --jobs processes), default is %default"
+                      )
+    parser.add_option("--batch-size",
+                      action="store",
+                      type="int",
+                      dest="batch_size",
+                      default=64,
+                      help="Hand found bones to the parse thread or processes in batches of BATCH_SIZE, "
+                           "default is %default"
+                      )
+    parser.add_option("--chunk-size",
+                      action="store",
+                      type="int",
+                      dest="chunk_size",
+                      default=CHUNK_SIZE >> 20,
+                      help="With --jobs, split files larger than CHUNK_SIZE MiB into chunks "
+                           "scanned in parallel, default is %default"
+                      )
+    parser.add_option("--cache-dir",
+                      action="store",
+                      dest="cache_dir",
+                      help="Cache the scan result of each log file in CACHE_DIR"
+                      )
+    parser.add_option("--cache-max-size",
+                      action="store",
+                      type="int",
+                      dest="cache_max_size",
+                      default=1024,
+                      help="Evict cached results when CACHE_DIR grows over CACHE_MAX_SIZE MiB, default is %default"
+                      )
+    parser.add_option("--cache-max-age",
+                      action="store",
+                      type="int",
+                      dest="cache_max_age",
+                      default=30,
+                      help="Evict cached results unused for CACHE_MAX_AGE days, default is %default"
+                      )
+    parser.add_option("--cache-content-hash",
+                      action="store_true",
+                      dest="cache_content_hash",
+                      default=False,
+                      help="Identify cached files by a hash of their content instead of size, mtime and inode"
+                      )
+    parser.add_option("--sink",
+                      action="append",
+                      dest="sinks",
+                      default=[],
+                      metavar="FORMAT:PATH",
+                      help="Also write the result as FORMAT (text, jsonl or sqlite) to PATH, '-' for stdout "
+                           "(not for sqlite); "
+                           "may be given more than once"
+                      )
+    parser.add_option("-f", "--follow",
+                      action="store_true",
+                      default=False,
+                      help="Keep scanning a growing log file (or stdin) and report results periodically"
+                      )
+    parser.add_option("--interval",
+                      action="store",
+                      type="float",
+                      default=60,
+                      help="With --follow, report results every INTERVAL seconds, default is %default"
+                      )
+    parser.add_option("--every",
+                      action="store",
+                      type="int",
+                      help="With --follow, also report results after every EVERY new bones"
+                      )
+    parser.add_option("--delta",
+                      action="store_true",
+                      default=False,
+                      help="With --follow, report only the bones whose count changed"
+                      )
+    parser.add_option("--save-partial",
+                      action="store",
+                      dest="save_partial",
+                      help="Also write the result as a mergeable partial result file to SAVE_PARTIAL, "
+                           "see the merge subcommand"
+                      )
+    parser.add_option("--since",
+                      action="store",
+                      help="Only count bones logged at or after SINCE, written like the log's time stamps "
+                           "(MM-DD[ HH:MM[:SS[.mmm]]], or seconds for epoch logs)"
+                      )
+    parser.add_option("--until",
+                      action="store",
+                      help="Only count bones logged at or before UNTIL, written like --since"
+                      )
+    parser.add_option("--assume-sorted",
+                      action="store_true",
+                      default=False,
+                      help="Assume the time stamps of each log file never go backwards (except for local "
+                           "reordering), and binary-search --since/--until instead of filtering every line"
+                      )
+    parser.add_option("--demux",
+                      action="store_true",
+                      default=False,
+                      help="Collect bones per pid/tid, so that lines of other threads interleaved with a bone "
+                           "do not truncate it"
+                      )
+    parser.add_option("--skip-overlap",
+                      action="store_true",
+                      default=False,
+                      help="Find the parts of each log file that repeat an earlier log file (e.g. rotated logcat "
+                           "files) and scan them only once"
+                      )
+    parser.add_option("--normalize-cache",
+                      action="store",
+                      type="int",
+                      default=LogDog.NORMALIZE_CACHE_SIZE,
+                      help="Remember the normalized text of up to NORMALIZE_CACHE bones, so that repeated crashes "
+                           "are normalized only once, 0 disables it, default is %default"
+                      )
+    parser.add_option("--cluster",
+                      action="store_true",
+                      default=False,
+                      help="Group similar bones (e.g. differing only in line numbers) in the text result"
+                      )
+    parser.add_option("--cluster-threshold",
+                      action="store",
+                      dest="cluster_threshold",
+                      type="float",
+                      default=0.8,
+                      help="With --cluster, minimum estimated similarity of two bones in a group, "
+                           "default is %default"
+                      )
+    parser.add_option("--stats",
+                      action="store_true",
+                      default=False,
+                      help="Print per-stage timing and scan statistics to stderr"
+                      )
+    parser.add_option("--stats-file",
+                      action="store",
+                      dest="stats_file",
+                      help="Write per-stage timing and scan statistics as JSON to STATS_FILE"
+                      )
     parser.add_option("-V", "--version",
                       action="store_true",
                       default=False,
@@ -318,6 +3160,9 @@ def parse_args():
 
 
 def main():
+    if sys.argv[1:2] == ["merge"]:
+        merge_main(sys.argv[2:])
+        return
     options, args = parse_args()
     if options.version:
         print("0.1.0")
@@ -330,20 +3175,114 @@ def main():
     except Exception as ex:
         print(ex, file=sys.stderr)
         exit(1)
+    try:
+        sinks = [open_sink(x) for x in options.sinks]
+    except Exception as ex:
+        print(ex, file=sys.stderr)
+        exit(1)
 
-    logdog = LogDog()
+    if options.follow:
+        # --follow需要分析统计线程定期输出统计结果
+        logdog = LogDog("thread", 1)
+    elif options.pipeline == "process":
+        logdog = LogDog("process", options.batch_size, options.jobs if options.jobs > 1 else None)
+    else:
+        logdog = LogDog(options.pipeline, options.batch_size)
     logdog.load_config()
-    logdog.start()
-
-    if len(args) == 0:
-        logdog.search(sys.stdin)
+    logdog.demux = options.demux
+    logdog.normalize_cache = NormalizeCache(options.normalize_cache)
+    if options.since or options.until:
+        try:
+            logdog.time_window = TimeWindow(options.since, options.until, options.assume_sorted)
+        except ValueError as ex:
+            print(ex, file=sys.stderr)
+            exit(1)
+    if options.cache_dir:
+        logdog.cache = ResultCache(options.cache_dir, logdog.fingerprint(),
+                                   options.cache_max_size << 20, options.cache_max_age * 86400,
+                                   options.cache_content_hash)
+    if options.skip_overlap and not options.follow:
+        logdog.skip_ranges = logdog.find_overlaps(args)
+    # 在查找重复部分之后才开始记录，不计入这一步的行数和正则匹配次数
+    stats = None
+    if options.stats or options.stats_file:
+        stats = Stats()
+        stats.instrument(logdog)
+    if options.upload_result:
+        from config import config
+        logdog.uploader = Uploader.from_config(config["server"])
+        logdog.uploader.start()
+
+    if options.follow:
+        if options.save_partial:
+            print("--save-partial cannot be used with --follow", file=sys.stderr)
+            exit(1)
+        if len(args) > 1:
+            print("--follow accepts at most one log file", file=sys.stderr)
+            exit(1)
+        logdog.counter = WindowCounter()
+        logdog.start()
+        if len(args) == 0:
+            fobj = getattr(sys.stdin, "buffer", sys.stdin)
+        else:
+            fobj = FollowIter(args[0])
+        reporter = SnapshotReporter(outfobj, options.delta)
+
+        def report(counter):
+            reporter(counter)
+            for sink in sinks:
+                sink.write(counter)
+
+        logdog.follow(fobj, report, options.interval, options.every)
+        logdog.stop()
+    elif options.jobs > 1 and len(args) > 0 and options.pipeline != "process":
+        logdog.counter = scan_files_parallel(args, options.jobs, options.chunk_size << 20, logdog.cache,
+                                             logdog.uploader, logdog.time_window, logdog.log_format,
+                                             logdog.demux, logdog.skip_ranges, stats)
     else:
-        for fname in args:
-            logdog.search(fname)
+        logdog.start()
 
-    logdog.stop()
-    # 输出结果
-    logdog.print_result(outfobj)
+        if len(args) == 0:
+            logdog.search(getattr(sys.stdin, "buffer", sys.stdin))
+        else:
+            for fname in args:
+                logdog.search(fname)
+
+        logdog.stop()
+
+    if logdog.uploader is not None:
+        # 标准输入和--follow没有按文件统计的结果，上传最终的结果
+        if options.follow or len(args) == 0:
+            logdog.uploader.put(logdog.counter)
+        logdog.uploader.close()
+        if logdog.uploader.spooled:
+            print("%d batches are saved to %s and will be uploaded next time"
+                  % (logdog.uploader.spooled, logdog.uploader.spool_dir), file=sys.stderr)
+        if logdog.uploader.rejected:
+            print("%d batches are rejected by the server and kept in %s as *%s"
+                  % (logdog.uploader.rejected, logdog.uploader.spool_dir, Uploader.REJECTED_SUFFIX), file=sys.stderr)
+    if logdog.cache is not None:
+        logdog.cache.evict()
+    if stats is not None:
+        stats.instrument_counter(logdog.counter)
+    # 输出结果，有输出到标准输出的sink时不再输出文本格式的结果
+    if any(getattr(x, "fobj", None) is sys.stdout for x in sinks):
+        pass
+    elif options.cluster:
+        logdog.print_clusters(outfobj, BoneClusterer(options.cluster_threshold))
+    else:
+        logdog.print_result(outfobj)
+    for sink in sinks:
+        sink.write(logdog.counter)
+        sink.close()
+    if options.save_partial:
+        write_partial(options.save_partial, partial_records(logdog.counter), logdog.fingerprint())
+
+    if options.stats:
+        stats.report(sys.stderr)
+    if options.stats_file:
+        with open(options.stats_file, "w", encoding="utf-8") as f:
+            json.dump(stats.to_dict(), f, indent=4, sort_keys=True)
 
 
 if __name__ == "__main__":
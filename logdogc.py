@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""logdogd.py的客户端
+
+只使用标准库，不导入logdog和config，把扫描请求交给常驻的logdogd.py并输出其结果，
+因此每次运行的开销只有解释器的启动．
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import socket
+from optparse import OptionParser
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser("~"), ".logdog", "daemon.sock")
+
+
+def request(path, req, timeout=None):
+    """向logdogd发送一个请求，返回(响应的JSON对象, 输出的内容)"""
+    s = socket.socket(socket.AF_UNIX)
+    s.settimeout(timeout)
+    try:
+        s.connect(path)
+        s.sendall((json.dumps(req) + "\n").encode("utf-8"))
+        s.shutdown(socket.SHUT_WR)
+        f = s.makefile("rb")
+        response = json.loads(f.readline().decode("utf-8"))
+        body = f.read().decode("utf-8")
+        f.close()
+    finally:
+        s.close()
+    return response, body
+
+
+def parse_args():
+    parser = OptionParser(usage="%prog [options] logcat.txt ...")
+    parser.add_option("-s", "--socket",
+                      action="store",
+                      default=DEFAULT_SOCKET,
+                      help="Connect to logdogd on the unix socket SOCKET, default is %default"
+                      )
+    parser.add_option("-o", "--outfile",
+                      action="store",
+                      dest="outfile",
+                      help="Write result to OUTFILE, default is stdout"
+                      )
+    parser.add_option("--jsonl",
+                      action="store_true",
+                      default=False,
+                      help="Write the result as JSON Lines instead of text"
+                      )
+    parser.add_option("--since",
+                      action="store",
+                      help="Only count bones logged at or after SINCE"
+                      )
+    parser.add_option("--until",
+                      action="store",
+                      help="Only count bones logged at or before UNTIL"
+                      )
+    parser.add_option("--status",
+                      action="store_true",
+                      default=False,
+                      help="Print the status of logdogd"
+                      )
+    parser.add_option("--stop",
+                      action="store_true",
+                      default=False,
+                      help="Stop logdogd"
+                      )
+    return parser.parse_args()
+
+
+def main():
+    options, args = parse_args()
+    if options.status:
+        req = {"command": "status"}
+    elif options.stop:
+        req = {"command": "stop"}
+    elif args:
+        # logdogd的工作目录与客户端不同
+        req = {"command": "scan", "files": [os.path.abspath(x) for x in args], "since": options.since,
+               "until": options.until, "format": "jsonl" if options.jsonl else "text"}
+    else:
+        print("no log files", file=sys.stderr)
+        exit(2)
+
+    try:
+        response, body = request(options.socket, req)
+    except socket.error as ex:
+        print("cannot connect to logdogd on %s (%s), start it with logdogd.py" % (options.socket, ex),
+              file=sys.stderr)
+        exit(2)
+    if not response.get("ok"):
+        print(response.get("error"), file=sys.stderr)
+        exit(1)
+    if "status" in response:
+        body = json.dumps(response["status"], indent=4, sort_keys=True) + "\n"
+    if options.outfile:
+        with open(options.outfile, "wb") as f:
+            f.write(body.encode("utf-8"))
+    else:
+        sys.stdout.write(body)
+
+
+if __name__ == "__main__":
+    main()
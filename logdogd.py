@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""logdog的常驻进程
+
+每次运行logdog.py都要启动解释器、导入模块、在load_config中编译所有taste的正则表达式，
+对于只有几KB的日志文件，这些开销远大于扫描本身．logdogd.py常驻后台，保存编译好的配置，
+通过unix socket接受logdogc.py发来的扫描请求，在请求的线程中扫描并返回统计结果．
+config.py的修改时间或大小改变时，在下一个请求到来时重新加载配置．
+
+请求和响应的第一行都是一个JSON对象，响应的第一行之后是输出的内容．
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import copy
+import json
+import time
+import socket
+import threading
+from optparse import OptionParser
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+try:
+    from importlib import reload
+except ImportError:
+    pass
+try:
+    # Python 2中TextSink等以print写入str
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import config as config_module
+from logdog import LogDog, Counter, NormalizeCache, TimeWindow, TextSink, JsonLinesSink
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser("~"), ".logdog", "daemon.sock")
+
+
+class ScanService:
+    """保存编译好的taste配置并处理扫描请求，可以被多个线程同时调用"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.config_file = os.path.splitext(config_module.__file__)[0] + ".py"
+        self.config_stamp = None
+        self.template = None
+        self.started = time.time()
+        self.requests = 0
+        self.reloads = 0
+        self.errors = 0
+        self.logdog()
+
+    def logdog(self):
+        """返回按当前配置编译好的LogDog，config.py改变时重新加载，加载失败时继续使用原来的配置"""
+        with self.lock:
+            st = os.stat(self.config_file)
+            stamp = st.st_mtime, st.st_size
+            if stamp != self.config_stamp:
+                # 无论是否加载成功，config.py再次改变之前都不再重新加载
+                self.config_stamp = stamp
+                try:
+                    if self.template is not None:
+                        reload(config_module)
+                    logdog = LogDog("inline")
+                    logdog.load_config()
+                except Exception as ex:
+                    if self.template is None:
+                        raise
+                    print("cannot reload %s, keep using the old config: %s" % (self.config_file, ex), file=sys.stderr)
+                    self.errors += 1
+                else:
+                    self.template = logdog
+                    self.reloads += 1
+            return self.template
+
+    def scan(self, request):
+        """扫描request["files"]中的日志文件，返回合并后的Counter"""
+        for fname in request["files"]:
+            if not os.path.isfile(fname):
+                raise IOError("No such file: %s" % fname)
+        # 各个请求共享编译好的配置，只有time_window、normalize_cache等属性是各自的
+        logdog = copy.copy(self.logdog())
+        logdog.normalize_cache = NormalizeCache(logdog.normalize_cache.size)
+        if request.get("since") or request.get("until"):
+            logdog.time_window = TimeWindow(request.get("since"), request.get("until"))
+        with self.lock:
+            self.requests += 1
+        counter = Counter()
+        for fname in request["files"]:
+            counter.merge(logdog.scan_file(fname))
+        return counter
+
+    def status(self):
+        return {"pid": os.getpid(), "uptime": round(time.time() - self.started, 3), "requests": self.requests,
+                "reloads": self.reloads, "reload_errors": self.errors, "config": self.config_file}
+
+
+class RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        service = self.server.service
+        body = u""
+        try:
+            request = json.loads(self.rfile.readline().decode("utf-8"))
+            command = request.get("command", "scan")
+            if command == "scan":
+                out = StringIO()
+                sink = JsonLinesSink(out) if request.get("format") == "jsonl" else TextSink(out)
+                sink.write(service.scan(request))
+                body = out.getvalue()
+                response = {"ok": True}
+            elif command == "status":
+                response = {"ok": True, "status": service.status()}
+            elif command == "stop":
+                response = {"ok": True}
+                # shutdown()会等待serve_forever()返回，不能在处理请求的线程中直接调用
+                threading.Thread(target=self.server.shutdown).start()
+            else:
+                response = {"ok": False, "error": "unknown command: %s" % command}
+        except Exception as ex:
+            response = {"ok": False, "error": str(ex)}
+        self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+        self.wfile.write(body.encode("utf-8"))
+
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, path, service=None):
+        _remove_stale_socket(path)
+        socketserver.UnixStreamServer.__init__(self, path, RequestHandler)
+        # 只允许当前用户连接
+        os.chmod(path, 0o600)
+        self.service = service or ScanService()
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+
+
+def _remove_stale_socket(path):
+    """删除上次没有正常退出留下的socket文件，已经有进程在监听时报错"""
+    if not os.path.exists(path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        return
+    s = socket.socket(socket.AF_UNIX)
+    try:
+        s.connect(path)
+    except socket.error:
+        os.remove(path)
+        return
+    finally:
+        s.close()
+    raise IOError("logdogd is already running on %s" % path)
+
+
+def parse_args():
+    parser = OptionParser(usage="%prog [options]")
+    parser.add_option("-s", "--socket",
+                      action="store",
+                      default=DEFAULT_SOCKET,
+                      help="Listen on the unix socket SOCKET, default is %default"
+                      )
+    return parser.parse_args()
+
+
+def main():
+    options, args = parse_args()
+    try:
+        server = DaemonServer(options.socket)
+    except Exception as ex:
+        print(ex, file=sys.stderr)
+        exit(1)
+    print("logdogd is listening on", options.socket, file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
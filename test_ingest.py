@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding:utf-8 -*-
+
+# ingest.py只支持asyncio（Python 3.5及以上），因此它的测试不放在test_main.py中
+
+import io
+import os
+import time
+import asyncio
+import unittest
+from logdog import *
+from ingest import IngestServer, run
+
+
+class IngestServerTest(unittest.TestCase):
+
+    files = ["extras/log/app-anr-mtk-2.txt", "extras/log/app-anr-google-1.txt", "extras/log/app-jvm-crash-qcom-1.txt",
+             "extras/log/app-native-crash-google-x86-1.txt", "extras/log/app-native-crash-google-x86-2.txt"]
+    unix_path = "test_ingest.sock"
+
+    def tearDown(self):
+        if os.path.exists(self.unix_path):
+            os.remove(self.unix_path)
+
+    def expected(self):
+        logdog = LogDog("inline")
+        logdog.load_config()
+        for fname in self.files:
+            logdog.search(fname)
+        return {bone.text: n for bone, n in logdog.counter.result().items()}
+
+    async def send(self, open_connection, fname, device, burst):
+        reader, writer = await open_connection()
+        with open(fname, "rb") as f:
+            data = f.read()
+        if device is not None:
+            data = b"logdog-device: " + device.encode("utf-8") + b"\n" + data
+        # 每次发送burst字节，模拟缓慢的和突发的发送方
+        for i in range(0, len(data), burst):
+            writer.write(data[i:i + burst])
+            await writer.drain()
+            await asyncio.sleep(0)
+        writer.close()
+
+    async def run_server(self, server):
+        tcp = await server.start_tcp("127.0.0.1", 0)
+        port = tcp.sockets[0].getsockname()[1]
+        await server.start_unix(self.unix_path)
+        clients = []
+        for i in range(20):
+            fname = self.files[i % len(self.files)]
+            if i % 2:
+                connect = lambda: asyncio.open_unix_connection(self.unix_path)
+            else:
+                connect = lambda: asyncio.open_connection("127.0.0.1", port)
+            device = "device-%d" % i if i % 5 != 3 else None
+            clients.append(self.send(connect, fname, device, [7, 100, 1 << 16][i % 3]))
+        await asyncio.gather(*clients)
+        await server.close(grace=10)
+
+    def test_ingest(self):
+        # 很小的queue使分析统计线程成为瓶颈，连接的处理需要等待
+        logdog = LogDog("thread", max_pending=1)
+        logdog.load_config()
+        logdog.start()
+        server = IngestServer(logdog, idle=5)
+        try:
+            run(self.run_server(server))
+        finally:
+            logdog.stop()
+
+        self.assertEqual(server.connections, 20)
+        self.assertEqual({bone.text: n for bone, n in logdog.counter.result().items()}, self.expected())
+        sources = set(s for _, _, entry_sources in logdog.counter.dict.values() for s in entry_sources)
+        self.assertIn("device-0", sources)
+        self.assertNotIn("device-3", sources)
+        self.assertTrue(any(s.startswith("127.0.0.1:") for s in sources))
+        self.assertTrue(any(s.startswith("unix-") for s in sources))
+
+    async def run_idle(self, server, data):
+        tcp = await server.start_tcp("127.0.0.1", 0)
+        reader, writer = await asyncio.open_connection("127.0.0.1", tcp.sockets[0].getsockname()[1])
+        writer.write(b"logdog-device: idle\n" + data)
+        await writer.drain()
+        await asyncio.sleep(0.2)
+        # 发送方没有断开连接，close()也要关闭连接并返回
+        started = time.time()
+        await server.close()
+        self.assertTrue(time.time() - started < 2)
+        writer.close()
+
+    def test_close(self):
+        logdog = LogDog("thread")
+        logdog.load_config()
+        logdog.start()
+        server = IngestServer(logdog, idle=30)
+        try:
+            with open(self.files[2], "rb") as f:
+                run(self.run_idle(server, f.read()))
+        finally:
+            logdog.stop()
+        self.assertEqual(len(logdog.counter.result()), 1)
+
+    async def run_devices(self, server, fname):
+        tcp = await server.start_tcp("127.0.0.1", 0)
+        port = tcp.sockets[0].getsockname()[1]
+        connect = lambda: asyncio.open_connection("127.0.0.1", port)
+        await asyncio.gather(*[self.send(connect, fname, device, 100) for device in ("device-a", "device-b")])
+        await server.close(grace=10)
+
+    def test_devices(self):
+        # 两台设备的日志完全相同，时间戳也相同，也要按设备分别统计
+        logdog = LogDog("thread")
+        logdog.load_config()
+        logdog.counter = WindowCounter(by_source=True)
+        logdog.start()
+        server = IngestServer(logdog)
+        try:
+            run(self.run_devices(server, self.files[2]))
+        finally:
+            # 分析统计线程不是daemon线程，测试失败时也要结束它，否则进程不会退出
+            logdog.stop()
+
+        records = sorted(logdog.counter.to_records(), key=lambda r: r["sources"])
+        self.assertEqual([r["sources"] for r in records], [["device-a"], ["device-b"]])
+        self.assertEqual(records[0]["text"], records[1]["text"])
+        self.assertEqual([r["count"] for r in records], [1, 1])
+        out = io.StringIO()
+        SnapshotReporter(out)(logdog.counter)
+        self.assertIn("bones = 2", out.getvalue())
+        self.assertIn("source = device-a count = 1", out.getvalue())
+
+    def test_long_format(self):
+        logdog = LogDog("thread")
+        logdog.log_format = LOG_FORMATS["long"]
+        self.assertRaises(ValueError, IngestServer, logdog)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,38 @@
 #!/usr/bin/env python
 # -*- coding:utf-8 -*-
 
+import io
+import gzip
+import json
 import os
+import sys
+import re
+import time
+import shutil
+import tarfile
+import zipfile
+import threading
 import unittest
+import logdog
+import benchmark
 from logdog import *
+from logdogd import DaemonServer
+import logdogc
+try:
+    # Python 2中print写入的是str，io.StringIO只接受unicode
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    pass
 
 
 class WrapIterTest(unittest.TestCase):
@@ -57,6 +86,30 @@ class CounterTest(unittest.TestCase):
         self.assertTrue(result[bone2_1] == 2)
         self.assertTrue(result[bone2_1] == 2)
 
+    def test_compact(self):
+        counter = Counter()
+        for i in range(1000):
+            counter.put(Bone("text" * 100, "01-01 00:00:00.%03d" % (i % 10), "proc_name", "reason", "reason_detail"))
+        # 只保存一个代表bone，时间戳在放入时去重
+        self.assertEqual(len(counter.dict), 1)
+        key, (bone, stamps, sources) = list(counter.dict.items())[0]
+        self.assertEqual(len(key), 16)
+        self.assertEqual(len(stamps), 10)
+        self.assertEqual(list(counter.result().values()), [10])
+
+    def test_merge(self):
+        counter1 = Counter()
+        counter1.put(Bone("text1", "01-01 00:00:00.000", "proc_name", "reason", "reason_detail"))
+        counter1.put(Bone("text2", "01-01 00:00:00.001", "proc_name", "reason", "reason_detail"))
+        counter2 = Counter()
+        # 重复的日志（时间戳相同）合并后只统计1次
+        counter2.put(Bone("text1", "01-01 00:00:00.000", "proc_name", "reason", "reason_detail"))
+        counter2.put(Bone("text2", "01-01 00:00:00.002", "proc_name", "reason", "reason_detail"))
+
+        counter1.merge(counter2)
+        result = {k.text: v for k, v in counter1.result().items()}
+        self.assertEqual(result, {"text1": 1, "text2": 2})
+
 
 class BoneTest(unittest.TestCase):
 
@@ -71,6 +124,326 @@ class BoneTest(unittest.TestCase):
         bone2_2 = Bone("text2-2", "01-01 00:00:00.001", "proc_name", "reason", "reason_detail")
         self.assertNotEqual(bone2_1, bone2_2)
 
+    def test_slots(self):
+        bone = Bone("text1", "01-01 00:00:00.001", "proc_name", "reason", "reason_detail")
+        self.assertFalse(hasattr(bone, "__dict__"))
+
+
+class ChipRemoverTest(unittest.TestCase):
+
+    def remove_each(self, text, patterns):
+        # 逐个正则依次替换的原始方法
+        for x in patterns:
+            match = re.search(x, text)
+            if match:
+                names = dict(zip(x.groupindex.values(), x.groupindex.keys()))
+                for i in range(len(match.regs) - 1, 0, -1):
+                    text = text[:match.regs[i][0]] + "<" + names[i] + ">" + text[match.regs[i][1]:]
+        return text
+
+    def check(self, text, *patterns):
+        patterns = [re.compile(x) for x in patterns]
+        self.assertEqual(ChipRemover(patterns).remove(text), self.remove_each(text, patterns))
+
+    def test_remove(self):
+        text = "pid: 123, tid: 456, name: ps\nsignal 13 (SIGPIPE), code 0 (SI_USER), fault addr 0x1f\n"
+        remover = ChipRemover([re.compile(r"pid: (?P<pid>\d+), tid: (?P<tid>\d+), name:.*"),
+                               re.compile(r"signal .*, code .*, fault addr (?P<addr>\w+)"),
+                               re.compile(r"NOT_FOUND (?P<x>\d+)")])
+        self.assertEqual(remover.remove(text),
+                         "pid: <pid>, tid: <tid>, name: ps\nsignal 13 (SIGPIPE), code 0 (SI_USER), fault addr <addr>\n")
+
+    def test_same_as_remove_each(self):
+        self.check("PID: 5237\nReason: Input (Waiting)\n", r"PID: (?P<pid>\d+)", r"Reason: Input .*\((?P<reason_detail>.*)\)")
+        # 匹配范围重叠或分组嵌套时退化为依次替换
+        self.check("PID: 5237 5238\n", r"PID: (?P<pid>\d+)", r"(?P<num>\d+)")
+        self.check("PID: 5237\n", r"PID: (?P<all>(?P<first>\d)\d+)")
+
+    def test_samples(self):
+        logdog = LogDog("inline")
+        logdog.load_config()
+        for fname in sorted(os.listdir("extras/log")):
+            bones = []
+            with open(os.path.join("extras/log", fname), "rb") as f:
+                logdog._search(WrapIter(f), bones.append, binary=True)
+            for text, taste in bones:
+                text = logdog._remove_time_stamp(text, logdog.detect_type(text))
+                self.assertEqual(logdog._remove_text_chip(text, taste), self.remove_each(text, taste["item_repl_co"]))
+
+
+class NativeCrashNormalizerTest(unittest.TestCase):
+
+    def test_normalize(self):
+        text = ("DEBUG   : signal 6 (SIGABRT), code -6 (SI_TKILL), fault addr --------\n"
+                "DEBUG   : Abort message: 'Tried to mark 0xe7c8b690 not contained by any spaces'\n"
+                "DEBUG   :     r0 00000000  r1 000043fb  r2 00000006  r3 00000008\n"
+                "DEBUG   :     sp   0000007febd44490  pc   0000007fb1e526ec  pstate 0000000020000000\n"
+                "DEBUG   : \n"
+                "DEBUG   : backtrace:\n"
+                "DEBUG   :     #00 pc ffffe424  [vdso:a82db000] (__kernel_vsyscall+16)\n"
+                "DEBUG   :     #01 pc e659cf0c  <unknown>\n"
+                "DEBUG   :     #02 pc 0013a4d5  /system/app/a.odex (offset 0x1585000)\n"
+                "DEBUG   : stack:\n"
+                "DEBUG   :          bfb815d0  00000000  [anon:libc_malloc]\n")
+        self.assertEqual(NativeCrashNormalizer().normalize(text),
+                         "DEBUG   : signal 6 (SIGABRT), code -6 (SI_TKILL), fault addr --------\n"
+                         "DEBUG   : Abort message: 'Tried to mark <addr> not contained by any spaces'\n"
+                         "DEBUG   :     r0 <reg>  r1 <reg>  r2 <reg>  r3 <reg>\n"
+                         "DEBUG   :     sp   <reg>  pc   <reg>  pstate <reg>\n"
+                         "DEBUG   : \n"
+                         "DEBUG   : backtrace:\n"
+                         "DEBUG   :     #00 pc <pc>  [vdso:<addr>] (__kernel_vsyscall+16)\n"
+                         "DEBUG   :     #01 pc <pc>  <unknown>\n"
+                         "DEBUG   :     #02 pc <pc>  /system/app/a.odex (offset <addr>)\n"
+                         "DEBUG   : stack:\n"
+                         "DEBUG   :          <addr>  <addr>  [anon:libc_malloc]\n")
+
+    def test_keep_lines(self):
+        logdog = LogDog("inline")
+        logdog.load_config()
+        with open("extras/log/app-native-crash-mtk-1.txt", "rb") as f:
+            bones = []
+            logdog._search(WrapIter(f), bones.append, binary=True)
+        bone = logdog.make_bone(bones[0])
+        self.assertEqual(bone.text.count("\n"), len(bones[0][0]))
+        self.assertIn("AEE/AED :     x28  <reg>  x29  <reg>  x30  <reg>\n", bone.text)
+        self.assertIn("AEE/AED :     #10 pc <pc>  /system/bin/toolbox\n", bone.text)
+
+
+class LogFormatTest(unittest.TestCase):
+
+    fname = "extras/log/app-jvm-crash-qcom-1.txt"
+
+    def setUp(self):
+        self.logdog = LogDog("inline")
+        self.logdog.load_config()
+
+    def tearDown(self):
+        if os.path.exists("test.txt"):
+            os.remove("test.txt")
+
+    def convert(self, fmt):
+        # 把threadtime格式的样例日志转换为其他格式
+        with io.open(self.fname, encoding="utf-8") as f:
+            lines = f.readlines()
+        out = []
+        for no, line in enumerate(lines):
+            date, tm, pid, tid, level, rest = line.split(None, 5)
+            tag, _, msg = rest.rstrip("\n").partition(": ")
+            if fmt == "brief":
+                out.append("%s/%-8s(%5s): %s\n" % (level, tag.strip(), pid, msg))
+            elif fmt == "long":
+                out.append("[ %s %s %5s:%5s %s/%s ]\n%s\n\n" % (date, tm, pid, tid, level, tag.strip(), msg))
+            elif fmt == "epoch":
+                out.append("%d.%03d %5s %5s %s %s" % (1500000000 + no, no % 1000, pid, tid, level, rest))
+            else:
+                out.append("%s %s%03d %5s %5s %s %s" % (date, tm, no % 1000, pid, tid, level, rest))
+        with io.open("test.txt", "w", encoding="utf-8") as f:
+            f.write(u"".join(out))
+
+    def result(self, fname):
+        self.logdog.counter = Counter()
+        self.logdog.search(fname)
+        return sorted((bone.text, bone.proc_name, bone.ex_name, count) for bone, count in self.logdog.counter.result().items())
+
+    def test_split(self):
+        line = u"11-17 16:27:00.050  1519  1519 D SettingsInterface:  from settings cache\n"
+        self.assertEqual(LOG_FORMATS["threadtime"].split(line), (u"11-17 16:27:00.050", u"SettingsInterface:  from settings cache\n"))
+        self.assertEqual(LOG_FORMATS["epoch"].split(u"1479371220.050  1519  1519 D Tag: msg\n"), (u"1479371220.050", u"Tag: msg\n"))
+        self.assertIsNone(LOG_FORMATS["threadtime"].split(u"1479371220.050  1519  1519 D Tag: msg\n"))
+        self.assertIsNone(LOG_FORMATS["epoch"].split(line))
+        self.assertIsNone(LOG_FORMATS["threadtime"].split(u"--------- beginning of main\n"))
+
+    def test_sniff(self):
+        for fmt in ["brief", "long", "epoch", "usec"]:
+            self.convert(fmt)
+            with open("test.txt", "rb") as f:
+                self.assertEqual(sniff_format(f.read()).name, fmt)
+        with open(self.fname, "rb") as f:
+            self.assertEqual(sniff_format(f.read()).name, "threadtime")
+        self.assertIsNone(sniff_format(b"hello\nworld\n"))
+
+    def test_formats(self):
+        expected = self.result(self.fname)
+        for fmt in ["brief", "long", "epoch", "usec"]:
+            self.convert(fmt)
+            self.assertEqual(self.result("test.txt"), expected)
+            with io.open("test.txt", encoding="utf-8") as f:
+                self.assertEqual(self.result(f), expected)
+
+    def test_brief_stamp(self):
+        # brief格式没有时间戳，相同的bone只计数一次，与在文件中的位置无关
+        self.convert("brief")
+        with open("test.txt", "rb") as f:
+            data = f.read()
+        expected = [x[:-1] + (1,) for x in self.result(self.fname)]
+        self.assertEqual(self.result("test.txt"), expected)
+        with open("test.txt", "wb") as f:
+            f.write(b"\n" + data * 3)
+        self.assertEqual(self.result("test.txt"), expected)
+        stamps = [r["stamps"] for r in self.logdog.counter.to_records()]
+        self.assertEqual(stamps, [[None]] * len(stamps))
+
+    def test_config_type(self):
+        import config
+        logtype = dict(config.config["logtype"])
+        stderr = sys.stderr
+        try:
+            # 旧版本的配置
+            config.config["logtype"].update(type="logcat-printable", charact=r"^\d", time=r"^\d")
+            sys.stderr = StringIO()
+            self.logdog.load_config()
+            self.assertIs(self.logdog.log_format, LOG_FORMATS["threadtime"])
+            self.assertIn("charact/time", sys.stderr.getvalue())
+        finally:
+            sys.stderr = stderr
+            config.config["logtype"].clear()
+            config.config["logtype"].update(logtype)
+
+    def test_long_chunks(self):
+        self.convert("long")
+        expected = self.logdog.scan_file("test.txt")
+        size = os.path.getsize("test.txt")
+        for chunk_size in [50, 333, 4096]:
+            counter = Counter()
+            for start in range(0, size, chunk_size):
+                counter.merge(self.logdog.scan_range("test.txt", start, start + chunk_size))
+            self.assertEqual(list(counter.dict.items()), list(expected.dict.items()))
+
+    def test_mixed(self):
+        # 同一个输入中threadtime和epoch格式的bone分别识别
+        with open(self.fname, "rb") as f:
+            data = f.read()
+        self.convert("epoch")
+        with open("test.txt", "rb") as f:
+            data += f.read()
+        with open("test.txt", "wb") as f:
+            f.write(data)
+        self.assertEqual(self.result("test.txt"), [x[:-1] + (x[-1] * 2,) for x in self.result(self.fname)])
+
+
+class PipelineTest(unittest.TestCase):
+
+    def test_batch(self):
+        logdog = LogDog("thread", batch_size=2, max_pending=1)
+        logdog.load_config()
+        taste = logdog.config["tastes"][0]
+        logdog.put_queue((["line1\n"], taste))
+        self.assertTrue(logdog.q.empty())
+        logdog.put_queue((["line2\n"], taste))
+        # 凑满一批后放入queue，queue已满时再放入会等待分析统计线程
+        self.assertTrue(logdog.q.full())
+        self.assertEqual(logdog.q.get(), ("BONES", [(["line1\n"], taste), (["line2\n"], taste)]))
+
+
+    def test_bad_bone(self):
+        # 没有pid行的native crash无法生成Bone，跳过它，不能使分析统计线程退出
+        logdog = LogDog("thread", batch_size=1, max_pending=1)
+        logdog.load_config()
+        taste = [t for t in logdog.config["tastes"] if "method_repl" in t][0]
+        logdog.start()
+        for i in range(20):
+            logdog.put_queue((["signal 11 (SIGSEGV)\n"], taste))
+        logdog.search("extras/log/app-native-crash-qcom-1.txt")
+        logdog.stop()
+        self.assertEqual(list(logdog.counter.result().values()), [1])
+
+    def test_bad_bone_pipelines(self):
+        # 没有pid行的native crash之后是一个jvm crash，各种pipeline都只跳过前者
+        with open("extras/log/app-native-crash-qcom-1.txt", "rb") as f:
+            data = b"".join(x for x in f if b" pid: " not in x)
+        with open("extras/log/app-jvm-crash-qcom-1.txt", "rb") as f:
+            data += f.read()
+        with open("test_bad_bone.txt", "wb") as f:
+            f.write(data)
+        stderr = sys.stderr
+        try:
+            sys.stderr = StringIO()
+            results = []
+            for pipeline in ["inline", "thread", "process"]:
+                logdog = LogDog(pipeline)
+                logdog.load_config()
+                logdog.start()
+                logdog.search("test_bad_bone.txt")
+                logdog.stop()
+                results.append(logdog.counter.result())
+            results.append(scan_files_parallel(["test_bad_bone.txt"], 2, 1000).result())
+        finally:
+            sys.stderr = stderr
+            os.remove("test_bad_bone.txt")
+        for result in results:
+            self.assertEqual([(b.taste, n) for b, n in result.items()], [("app-crash", 1)])
+
+    def test_dead_thread(self):
+        logdog = LogDog("thread", batch_size=1, max_pending=1)
+        logdog.load_config()
+        # MERGE失败时分析统计线程退出，之后放入queue不能永远等待
+        logdog.counter = None
+        logdog.start()
+        logdog.put_control(("MERGE", Counter()))
+        logdog.thr.join()
+        logdog.put_control(("BONES", []))
+        self.assertRaises(RuntimeError, logdog.put_control, ("BONES", []))
+
+
+class TasteMatcherTest(unittest.TestCase):
+
+    def make_tastes(self, *tags):
+        return [{"name": "taste-%d" % i, "begin_tag": x, "begin_tag_co": re.compile(x)} for i, x in enumerate(tags)]
+
+    def test_required_literal(self):
+        self.assertEqual(logdog._required_literal(re.compile(r"ActivityManager: ANR in ")), "ActivityManager: ANR in ")
+        self.assertEqual(logdog._required_literal(re.compile(r"(\*\*\* ){3}\*\*\*")), "*** *** *** ***")
+        self.assertEqual(logdog._required_literal(re.compile(r"^ab[cd]efgh\d+")), "efgh")
+        self.assertIsNone(logdog._required_literal(re.compile(r"abc|def")))
+        self.assertIsNone(logdog._required_literal(re.compile(r"abc", re.I)))
+
+    def test_search(self):
+        tastes = self.make_tastes(r"FATAL EXCEPTION IN SYSTEM PROCESS:", r"FATAL EXCEPTION:", r"ANR in ")
+        matcher = TasteMatcher(tastes)
+        self.assertEqual(matcher.literals, ("ANR in ", "FATAL EXCEPTION"))
+        self.assertIsNone(matcher.search("E AndroidRuntime: Shutting down VM\n"))
+        self.assertIs(matcher.search("E AndroidRuntime: FATAL EXCEPTION: main\n"), tastes[1])
+        self.assertIs(matcher.search("E AndroidRuntime: FATAL EXCEPTION IN SYSTEM PROCESS: main\n"), tastes[0])
+
+    def test_search_order(self):
+        # 一行同时匹配多个taste时，以tastes中的顺序为准，而不是匹配的位置
+        tastes = self.make_tastes(r"Load: \d+", r"ANR in ")
+        matcher = TasteMatcher(tastes)
+        self.assertIs(matcher.search("ANR in com.example Load: 18\n"), tastes[0])
+        self.assertIs(matcher.search("ANR in com.example\n"), tastes[1])
+
+
+class LineClassifierTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logdog = LogDog()
+        self.logdog.load_config()
+
+    def is_tag_line(self, line, taste):
+        # 逐个line_tag/end_tag/begin_tag进行匹配的原始判定方法
+        if not any(re.search(tag, line) for tag in taste["line_tag"]):
+            return False
+        if "end_tag_co" in taste and re.search(taste["end_tag_co"], line):
+            return False
+        return not any(re.search(t["begin_tag_co"], line) for t in self.logdog.config["tastes"])
+
+    def test_classify(self):
+        taste = [t for t in self.logdog.config["tastes"] if t["name"] == "app-anr"][0]
+        classify = taste["line_classifier"].classify
+        self.assertEqual(classify("E ActivityManager: PID: 5237\n"), LineClassifier.CONTINUE)
+        self.assertEqual(classify("E ActivityManager: Load: 18.55 / 10.13 / 4.29\n"), LineClassifier.END)
+        self.assertEqual(classify("E ActivityManager: ANR in com.qiku.eyemode\n"), LineClassifier.NEW)
+        self.assertEqual(classify("I sn      : Fail to access err=2\n"), LineClassifier.NONE)
+
+    def test_same_as_rescan(self):
+        for fname in sorted(os.listdir("extras/log")):
+            with open(os.path.join("extras/log", fname)) as f:
+                lines = f.readlines()
+            for t in self.logdog.config["tastes"]:
+                for line in lines:
+                    self.assertEqual(self.logdog._is_tag_line(line, t), self.is_tag_line(line, t))
+
 
 def sessin(*files):
     def deco(func):
@@ -207,5 +580,1161 @@ class LogDogTest(unittest.TestCase):
         self.assertEqual(v, 2)
 
 
+class InlineLogDogTest(LogDogTest):
+
+    def setUp(self):
+        self.logdog = LogDog("inline")
+        self.logdog.load_config()
+
+
+class BatchLogDogTest(LogDogTest):
+
+    def setUp(self):
+        self.logdog = LogDog("thread", batch_size=3, max_pending=2)
+        self.logdog.load_config()
+
+
+class ProcessLogDogTest(LogDogTest):
+
+    def setUp(self):
+        self.logdog = LogDog("process", batch_size=2, jobs=2, max_pending=2)
+        self.logdog.load_config()
+
+
+class BinarySearchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.logdog = LogDog()
+        self.logdog.load_config()
+        with open("extras/log/app-jvm-crash-qcom-1.txt", "rb") as f:
+            self.data = f.read()
+
+    def tearDown(self):
+        os.remove("test.txt")
+
+    def scan(self, data):
+        with open("test.txt", "wb") as f:
+            f.write(data)
+        return self.logdog.scan_file("test.txt").result()
+
+    def test_invalid_utf8(self):
+        expected = self.scan(self.data)
+        # 非法的UTF-8字节不影响整个文件的扫描
+        result = self.scan(b"\xff\xfe invalid\n" + self.data.replace(b"Shutting down VM", b"Shutting \xc3 VM"))
+        self.assertEqual(result, expected)
+
+        result = self.scan(self.data.replace(b"(View.java:5706)", b"(View.java:\xe4\xb8)"))
+        self.assertEqual(len(result), 1)
+        k, v = list(result.items())[0]
+        self.assertIn(u"(View.java:\ufffd)", k.text)
+        self.assertEqual(k.ex_name, "java.lang.NullPointerException")
+
+    def test_crlf(self):
+        expected = self.scan(self.data)
+        result = self.scan(self.data.replace(b"\n", b"\r\n"))
+        self.assertEqual([k.text for k in result], [k.text for k in expected])
+
+
+class FollowTest(unittest.TestCase):
+
+    def setUp(self):
+        with open("extras/log/app-jvm-crash-qcom-1.txt", "rb") as f:
+            self.lines = f.readlines()
+        open("test.txt", "wb").close()
+
+    def tearDown(self):
+        os.remove("test.txt")
+
+    def append(self, data):
+        with open("test.txt", "ab") as f:
+            f.write(data)
+
+    def wait_for(self, cond):
+        for i in range(500):
+            if cond():
+                return
+            time.sleep(0.01)
+        self.fail("timeout")
+
+    def test_follow_iter(self):
+        fobj = FollowIter("test.txt", poll=0.01, idle=0.05)
+        self.append(b"line1\nli")
+        self.assertEqual(next(fobj), b"line1\n")
+        self.append(b"ne2\n")
+        self.assertEqual(next(fobj), b"line2\n")
+        # 没有新数据时返回一个空行，且只返回一次
+        self.assertEqual(next(fobj), b"")
+        self.append(b"line3\n")
+        self.assertEqual(next(fobj), b"line3\n")
+        # 文件被截断后从头读取
+        with open("test.txt", "wb") as f:
+            f.write(b"new\n")
+        self.assertEqual(next(fobj), b"new\n")
+        fobj.close()
+        self.assertRaises(StopIteration, next, fobj)
+
+    def test_follow(self):
+        logdog = LogDog()
+        logdog.load_config()
+        logdog.counter = WindowCounter()
+        logdog.start()
+        out = StringIO()
+        fobj = FollowIter("test.txt", poll=0.01, idle=0.05)
+        thr = threading.Thread(target=logdog.follow, args=(fobj, SnapshotReporter(out, delta=True), None, 1))
+        thr.start()
+
+        self.append(b"".join(self.lines))
+        self.wait_for(lambda: "delta = +1" in out.getvalue())
+        # 同样的日志（时间戳相同）不重复计数
+        self.append(b"".join(self.lines))
+        self.append(b"".join(self.lines).replace(b"04-16 17:40:26.003", b"04-16 17:50:26.003"))
+        self.wait_for(lambda: out.getvalue().count("delta = +1") == 2)
+
+        fobj.close()
+        thr.join()
+        logdog.stop()
+        result = logdog.counter.result()
+        self.assertEqual(list(result.values()), [2])
+        self.assertIn("count = 2 delta = +1 proc_name = com.example.company.test_exception", out.getvalue())
+
+    def test_window_counter(self):
+        counter = WindowCounter(window=2)
+        for t in ["01", "02", "02", "03", "01"]:
+            counter.put(Bone("text1", t, "proc_name", "reason", "reason_detail"))
+        # 超出窗口的时间戳不再用于去重
+        self.assertEqual(list(counter.result().values()), [4])
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    cache_dir = "test_cache"
+    files = ["extras/log/app-anr-mtk-2.txt", "extras/log/app-jvm-crash-qcom-2.txt"]
+
+    def setUp(self):
+        self.logdog = LogDog()
+        self.logdog.load_config()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def scan(self):
+        self.logdog.counter = Counter()
+        self.logdog.start()
+        for f in self.files:
+            self.logdog.search(f)
+        self.logdog.stop()
+        return self.logdog.counter
+
+    def test_cache(self):
+        expected = self.scan()
+        self.logdog.cache = ResultCache(self.cache_dir, self.logdog.fingerprint())
+        self.assertIsNone(self.logdog.cache.get(self.files[0]))
+        self.assertEqual(list(self.scan().dict.items()), list(expected.dict.items()))
+
+        cached = self.logdog.cache.get(self.files[1])
+        self.assertEqual(list(cached.dict.items()), list(self.logdog.scan_file(self.files[1]).dict.items()))
+        # 从缓存中读取的结果与扫描的结果相同
+        self.logdog.scan_file = None
+        self.assertEqual(list(self.scan().dict.items()), list(expected.dict.items()))
+
+    def test_fingerprint(self):
+        fingerprint = self.logdog.fingerprint()
+        other = LogDog()
+        other.load_config()
+        self.assertEqual(other.fingerprint(), fingerprint)
+        self.logdog.config["tastes"][0]["line_tag"].append("NEW_TAG")
+        try:
+            self.assertNotEqual(self.logdog.fingerprint(), fingerprint)
+        finally:
+            self.logdog.config["tastes"][0]["line_tag"].pop()
+
+    def test_evict(self):
+        cache = ResultCache(self.cache_dir, "fingerprint", max_size=0)
+        for f in self.files:
+            cache.put(f, self.logdog.scan_file(f))
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+        cache.max_size = sum(os.path.getsize(os.path.join(self.cache_dir, x)) for x in os.listdir(self.cache_dir)) - 1
+        cache.evict()
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        cache.max_age = -1
+        cache.evict()
+        self.assertEqual(len(os.listdir(self.cache_dir)), 0)
+
+    def test_archive_sources(self):
+        # 缓存的结果与扫描的结果有相同的来源，内容相同的副本以副本的文件名作为来源
+        with zipfile.ZipFile("test_cache.zip", "w") as z:
+            for f in self.files:
+                z.write(f, "FS/" + os.path.basename(f))
+        shutil.copy("test_cache.zip", "test_cache_copy.zip")
+        try:
+            cache = ResultCache(self.cache_dir, "fingerprint", content_hash=True)
+            counter = self.logdog.scan_file("test_cache.zip")
+            cache.put("test_cache.zip", counter)
+            expected = sorted(r["sources"] for r in counter.to_records())
+            self.assertTrue(all(x.startswith("test_cache.zip!FS/") for x in sum(expected, [])))
+            self.assertEqual(sorted(r["sources"] for r in cache.get("test_cache.zip").to_records()), expected)
+            self.assertEqual(sorted(r["sources"] for r in cache.get("test_cache_copy.zip").to_records()),
+                             [[x.replace("test_cache.zip", "test_cache_copy.zip") for x in y] for y in expected])
+        finally:
+            os.remove("test_cache.zip")
+            os.remove("test_cache_copy.zip")
+
+    def test_write_error(self):
+        # 写入缓存失败时不影响扫描，也不留下临时文件
+        cache = ResultCache(self.cache_dir, "fingerprint")
+        counter = self.logdog.scan_file(self.files[0])
+        os.mkdir(cache._file(cache._key(self.files[0])))
+        cache.put(self.files[0], counter)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+        self.assertIsNone(cache.get(self.files[0]))
+        shutil.rmtree(self.cache_dir)
+        cache.put(self.files[0], counter)
+        cache.evict()
+        self.assertIsNone(cache.get(self.files[0]))
+
+
+class SinkTest(unittest.TestCase):
+
+    files = ["extras/log/app-jvm-crash-qcom-1.txt", "extras/log/app-jvm-crash-qcom-2.txt",
+             "extras/log/app-native-crash-google-x86-1.txt", "extras/log/app-native-crash-google-x86-2.txt"]
+
+    def setUp(self):
+        self.logdog = LogDog("inline")
+        self.logdog.load_config()
+        for fname in self.files:
+            self.logdog.search(fname)
+
+    def test_sources(self):
+        records = {r["proc_name"]: r for r in self.logdog.counter.to_records()}
+        native = records["com.android.development"]
+        self.assertEqual(native["taste"], "native-crash")
+        self.assertEqual(native["count"], 2)
+        self.assertEqual(native["sources"], self.files[2:])
+        # 从缓存还原时来源文件替换为新的文件名
+        counter = Counter.from_records([native], "other.txt")
+        self.assertEqual(list(counter.to_records())[0]["sources"], ["other.txt"])
+
+    def test_jsonl(self):
+        out = StringIO()
+        JsonLinesSink(out).write(self.logdog.counter)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), len(self.logdog.counter.result()))
+        records = [json.loads(x) for x in lines]
+        self.assertEqual(sorted(r["text"] for r in records), sorted(b.text for b in self.logdog.counter.result()))
+        self.assertTrue(all(r["sources"] and r["stamps"] and r["time"] for r in records))
+
+    def test_sqlite(self):
+        sink = SqliteSink(":memory:")
+        sink.write(self.logdog.counter)
+        sink.write(self.logdog.counter)
+        db = sink.db
+        self.assertEqual(db.execute("SELECT COUNT(*) FROM runs").fetchone()[0], 2)
+        rows = db.execute("SELECT id, count FROM bones WHERE proc_name = ? AND run_id = 2",
+                          ("com.android.development",)).fetchall()
+        self.assertEqual(len(rows), 1)
+        bone_id, count = rows[0]
+        self.assertEqual(count, 2)
+        self.assertEqual(db.execute("SELECT COUNT(*) FROM stamps WHERE bone_id = ?", (bone_id,)).fetchone()[0], 2)
+        self.assertEqual(sorted(x[0] for x in db.execute("SELECT source FROM sources WHERE bone_id = ?", (bone_id,))),
+                         self.files[2:])
+        indexes = [x[0] for x in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+        for name in ["bones_proc_name", "bones_ex_name", "bones_taste"]:
+            self.assertIn(name, indexes)
+        sink.close()
+
+    def test_open_sink(self):
+        self.assertRaises(ValueError, open_sink, "csv:out.csv")
+        self.assertRaises(ValueError, open_sink, "jsonl")
+        self.assertRaises(ValueError, open_sink, "sqlite:-")
+        self.assertFalse(os.path.exists("-"))
+        self.assertIsInstance(open_sink("text:-"), TextSink)
+
+
+class PartialTest(unittest.TestCase):
+
+    files = ["extras/log/app-anr-mtk-2.txt", "extras/log/app-anr-google-1.txt",
+             "extras/log/app-native-crash-google-x86-1.txt", "extras/log/app-native-crash-google-x86-2.txt"]
+
+    def setUp(self):
+        self.logdog = LogDog("inline")
+        self.logdog.load_config()
+
+    def tearDown(self):
+        for fname in ["test_p1.json.gz", "test_p2.json.gz", "test_p3.json.gz", "test_merge.txt"]:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    def save(self, fname, files):
+        self.logdog.counter = Counter()
+        for f in files:
+            self.logdog.search(f)
+        write_partial(fname, partial_records(self.logdog.counter), self.logdog.fingerprint())
+        return self.logdog.counter
+
+    def test_round_trip(self):
+        counter = self.save("test_p1.json.gz", self.files)
+        header, records = read_partial("test_p1.json.gz")
+        self.assertEqual(header["version"], PARTIAL_VERSION)
+        self.assertEqual(header["fingerprint"], self.logdog.fingerprint())
+        records = list(records)
+        self.assertEqual([r["digest"] for r in records], sorted(r["digest"] for r in records))
+        restored = Counter.from_records(records)
+        self.assertEqual(list(sorted(restored.to_records(), key=lambda r: r["text"])),
+                         list(sorted(counter.to_records(), key=lambda r: r["text"])))
+
+    def test_merge(self):
+        expected = self.save("test_p3.json.gz", self.files)
+        # 两个节点都扫描了app-anr-google-1.txt，合并后只计数一次
+        self.save("test_p1.json.gz", self.files[:2])
+        self.save("test_p2.json.gz", self.files[1:])
+        fingerprint, merged = merge_partials(["test_p1.json.gz", "test_p2.json.gz"])
+        self.assertEqual(fingerprint, self.logdog.fingerprint())
+        merged = list(merged)
+        self.assertEqual({r["text"]: len(r["stamps"]) for r in merged},
+                         {bone.text: n for bone, n in expected.result().items()})
+        self.assertEqual(merged, list(read_partial("test_p3.json.gz")[1]))
+
+        merge_main(["-o", "test_merge.txt", "test_p1.json.gz", "test_p2.json.gz"])
+        with io.open("test_merge.txt", encoding="utf-8") as f:
+            self.assertEqual(f.read().count("count = "), len(expected.result()))
+        # 合并的结果仍然可以继续合并
+        merge_main(["--save-partial", "test_p3.json.gz", "test_p1.json.gz", "test_p2.json.gz"])
+        self.assertEqual(list(merge_partials(["test_p3.json.gz", "test_p1.json.gz"])[1]), merged)
+
+    def test_version(self):
+        with gzip.open("test_p1.json.gz", "wb") as f:
+            f.write(json.dumps({"format": PARTIAL_FORMAT, "version": PARTIAL_VERSION + 1}).encode("utf-8"))
+        self.assertRaises(ValueError, read_partial, "test_p1.json.gz")
+        with gzip.open("test_p1.json.gz", "wb") as f:
+            f.write(b"{}\n")
+        self.assertRaises(ValueError, read_partial, "test_p1.json.gz")
+
+
+class BoneScannerTest(unittest.TestCase):
+
+    def test_scan(self):
+        logdog = LogDog("inline")
+        logdog.load_config()
+        for fname in sorted(os.listdir("extras/log")):
+            fname = os.path.join("extras/log", fname)
+            expected = []
+            with open(fname, "rb") as f:
+                logdog._search(WrapIter(f), expected.append, binary=True, source=fname)
+            result = []
+            scanner = BoneScanner(logdog, result.append, fname)
+            with open(fname, "rb") as f:
+                for line in f:
+                    scanner.feed(line)
+            scanner.close()
+            self.assertEqual([(x[0], x[1]["name"], x[2]) for x in result],
+                             [(x[0], x[1]["name"], x[2]) for x in expected])
+
+    def test_empty_line(self):
+        logdog = LogDog("inline")
+        logdog.load_config()
+        with open("extras/log/app-jvm-crash-qcom-1.txt", "rb") as f:
+            lines = f.readlines()
+        result = []
+        scanner = BoneScanner(logdog, result.append)
+        for line in lines[:5]:
+            scanner.feed(line)
+        # 空行结束正在收集的bone
+        scanner.feed(b"")
+        self.assertEqual(len(result), 1)
+        scanner.close()
+        self.assertEqual(len(result), 1)
+
+
+class DaemonTest(unittest.TestCase):
+
+    path = "test_daemon.sock"
+    files = ["extras/log/app-anr-mtk-2.txt", "extras/log/app-jvm-crash-qcom-1.txt",
+             "extras/log/app-native-crash-google-x86-1.txt"]
+
+    def setUp(self):
+        self.server = DaemonServer(self.path)
+        self.thr = threading.Thread(target=self.server.serve_forever)
+        self.thr.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thr.join()
+        self.server.server_close()
+
+    def test_scan(self):
+        logdog = LogDog("inline")
+        logdog.load_config()
+        for fname in self.files:
+            logdog.search(os.path.abspath(fname))
+        out = StringIO()
+        logdog.print_result(out)
+
+        response, body = logdogc.request(self.path, {"files": [os.path.abspath(x) for x in self.files]})
+        self.assertEqual(response, {"ok": True})
+        self.assertEqual(body, out.getvalue())
+        response, body = logdogc.request(self.path, {"files": [os.path.abspath(self.files[0])], "format": "jsonl"})
+        self.assertEqual([json.loads(x)["sources"] for x in body.splitlines()], [[os.path.abspath(self.files[0])]])
+
+        response, body = logdogc.request(self.path, {"files": ["no-such-file.txt"]})
+        self.assertFalse(response["ok"])
+        self.assertIn("no-such-file.txt", response["error"])
+
+    def test_reload(self):
+        service = self.server.service
+        status = logdogc.request(self.path, {"command": "status"})[0]["status"]
+        self.assertEqual(status["reloads"], 1)
+        st = os.stat(service.config_file)
+        try:
+            os.utime(service.config_file, (st.st_atime, st.st_mtime + 10))
+            logdogc.request(self.path, {"files": [os.path.abspath(self.files[0])]})
+            logdogc.request(self.path, {"files": [os.path.abspath(self.files[0])]})
+        finally:
+            os.utime(service.config_file, (st.st_atime, st.st_mtime))
+        status = logdogc.request(self.path, {"command": "status"})[0]["status"]
+        # 配置改变后只重新加载一次
+        self.assertEqual(status["reloads"], 2)
+        self.assertEqual(status["requests"], 2)
+
+    def test_reload_error(self):
+        service = self.server.service
+        st = os.stat(service.config_file)
+        load_config = LogDog.load_config
+
+        def broken(self):
+            raise ValueError("bad config")
+        try:
+            LogDog.load_config = broken
+            os.utime(service.config_file, (st.st_atime, st.st_mtime + 10))
+            # 加载失败时继续使用原来的配置
+            response, body = logdogc.request(self.path, {"files": [os.path.abspath(self.files[0])]})
+        finally:
+            LogDog.load_config = load_config
+            os.utime(service.config_file, (st.st_atime, st.st_mtime))
+        self.assertEqual(response, {"ok": True})
+        self.assertIn("count = 1", body)
+        status = logdogc.request(self.path, {"command": "status"})[0]["status"]
+        self.assertEqual((status["reloads"], status["reload_errors"]), (1, 1))
+
+    def test_running(self):
+        self.assertRaises(IOError, DaemonServer, self.path)
+
+
+class BoneClustererTest(unittest.TestCase):
+
+    def setUp(self):
+        logdog = LogDog("inline")
+        logdog.load_config()
+        logdog.search("extras/log/app-jvm-crash-qcom-1.txt")
+        logdog.search("extras/log/app-native-crash-google-x86-1.txt")
+        self.java, self.native = sorted(logdog.counter.result(), key=lambda x: x.taste)
+
+    def variant(self, bone, text, taste=None):
+        return Bone(text, None, bone.proc_name, bone.ex_name, bone.ex_desc, taste or bone.taste)
+
+    def test_cluster(self):
+        java = self.java
+        lines = java.text.splitlines()
+        frame = next(i for i, x in enumerate(lines) if "\tat " in x)
+        # 只有行号不同
+        moved = self.variant(java, re.sub(r":\d+\)", ":1)", java.text))
+        # 一个方法名被混淆
+        obfuscated = self.variant(java, "\n".join(lines[:frame] + ["AndroidRuntime: \tat a.b.c(Unknown Source)"]
+                                                  + lines[frame + 1:]))
+        result = {java: 3, moved: 5, obfuscated: 1, self.native: 2}
+        clusters = BoneClusterer().cluster(result)
+        self.assertEqual(len(clusters), 2)
+        bone, count, members = clusters[0]
+        self.assertIs(bone, moved)
+        self.assertEqual(count, 9)
+        self.assertEqual([x[1] for x in members], [5, 3, 1])
+        self.assertEqual(clusters[1], (self.native, 2, [(self.native, 2)]))
+
+        # 相似度阈值为1时只合并归一化后完全相同的bone
+        self.assertEqual(len(BoneClusterer(1.0).cluster(result)), 3)
+
+    def test_taste(self):
+        other = self.variant(self.java, self.java.text + "\n", "system-crash")
+        self.assertEqual(len(BoneClusterer().cluster({self.java: 1, other: 1})), 2)
+
+    def test_signature(self):
+        clusterer = BoneClusterer()
+        sig = clusterer.signature(self.native.text)
+        self.assertEqual(len(sig), clusterer.num_bins)
+        self.assertEqual(clusterer.signature(self.native.text), sig)
+        self.assertEqual(clusterer.similarity(clusterer.pack(sig), clusterer.pack(sig)), 1.0)
+        # 短文本的signature中有空的bin
+        self.assertEqual(len(set(clusterer.signature("a b c d"))), clusterer.num_bins)
+        self.assertTrue(clusterer.similarity(clusterer.pack(sig),
+                                             clusterer.pack(clusterer.signature(self.java.text))) < 0.5)
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        server = self.server
+        server.connections.add(self.client_address)
+        if server.failures > 0:
+            server.failures -= 1
+            status = 500
+        elif server.rejects > 0:
+            server.rejects -= 1
+            status = 400
+        else:
+            status = 200
+            server.payloads.append(json.loads(gzip.GzipFile(fileobj=io.BytesIO(data)).read().decode("utf-8")))
+            server.keys.append(self.headers["X-Auth-Key"])
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class UploaderTest(unittest.TestCase):
+
+    files = SinkTest.files
+    spool_dir = "test_spool"
+
+    def setUp(self):
+        self.server = None
+        logdog = LogDog("inline")
+        logdog.load_config()
+        for fname in self.files:
+            logdog.search(fname)
+        self.counter = logdog.counter
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        shutil.rmtree(self.spool_dir, ignore_errors=True)
+
+    def start_server(self, port=0, failures=0, rejects=0):
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), UploadHandler)
+        self.server.daemon_threads = True
+        self.server.payloads = []
+        self.server.keys = []
+        self.server.connections = set()
+        self.server.failures = failures
+        self.server.rejects = rejects
+        thr = threading.Thread(target=self.server.serve_forever)
+        thr.daemon = True
+        thr.start()
+        return self.server.server_address[1]
+
+    def uploader(self, port, **kwargs):
+        kwargs.setdefault("backoff", 0.01)
+        return Uploader("127.0.0.1", port, auth_key="key", spool_dir=self.spool_dir, **kwargs)
+
+    def records(self):
+        return [r for p in self.server.payloads for r in p["records"]]
+
+    def test_batch(self):
+        port = self.start_server()
+        uploader = self.uploader(port, batch_size=2)
+        uploader.start()
+        uploader.put(self.counter)
+        uploader.put(self.counter)
+        uploader.close()
+        total = len(self.counter.result()) * 2
+        self.assertEqual(sorted(json.dumps(r, sort_keys=True) for r in self.records()),
+                         sorted(json.dumps(r, sort_keys=True) for r in list(self.counter.to_records()) * 2))
+        self.assertTrue(all(len(p["records"]) <= 2 for p in self.server.payloads))
+        self.assertEqual(uploader.uploaded, (total + 1) // 2)
+        self.assertEqual(self.server.keys, ["key"] * uploader.uploaded)
+        # 所有的批次使用同一个连接
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_retry(self):
+        port = self.start_server(failures=2)
+        uploader = self.uploader(port)
+        uploader.start()
+        uploader.put(self.counter)
+        uploader.close()
+        self.assertEqual(len(self.records()), len(self.counter.result()))
+        self.assertEqual((uploader.uploaded, uploader.spooled), (1, 0))
+
+    def test_spool(self):
+        port = self.start_server()
+        self.server.shutdown()
+        self.server.server_close()
+        self.server = None
+
+        uploader = self.uploader(port, retries=1)
+        uploader.start()
+        uploader.put(self.counter)
+        uploader.put(self.counter)
+        uploader.close()
+        self.assertTrue(uploader.offline)
+        self.assertEqual(uploader.uploaded, 0)
+        self.assertEqual(len(os.listdir(self.spool_dir)), uploader.spooled)
+
+        # 服务器恢复后，先补传暂存的数据
+        self.start_server(port)
+        uploader = self.uploader(port)
+        uploader.start()
+        uploader.put(self.counter)
+        uploader.close()
+        self.assertEqual(os.listdir(self.spool_dir), [])
+        self.assertEqual(len(self.records()), len(self.counter.result()) * 3)
+
+    def test_rejected(self):
+        # 被服务器拒绝的一批数据不再补传，也不影响之后的上传
+        port = self.start_server(rejects=1)
+        uploader = self.uploader(port)
+        records = list(self.counter.to_records())
+        self.assertTrue(uploader._spool(uploader._payload(records)))
+        self.assertTrue(uploader._spool(uploader._payload(records)))
+        uploader.start()
+        uploader.put(self.counter)
+        uploader.close()
+        self.assertFalse(uploader.offline)
+        self.assertEqual((uploader.uploaded, uploader.spooled, uploader.rejected), (2, 0, 1))
+        self.assertEqual(len(self.records()), len(records) * 2)
+        self.assertEqual([x.endswith(".json.gz" + Uploader.REJECTED_SUFFIX) for x in os.listdir(self.spool_dir)], [True])
+
+        self.server.rejects = 1
+        uploader = self.uploader(port)
+        uploader.start()
+        uploader.put(self.counter)
+        uploader.close()
+        self.assertEqual((uploader.uploaded, uploader.spooled, uploader.rejected), (0, 0, 1))
+        uploader = self.uploader(port)
+        uploader.start()
+        uploader.put(self.counter)
+        uploader.close()
+        self.assertEqual((uploader.uploaded, uploader.spooled, uploader.rejected), (1, 0, 0))
+        self.assertEqual(len(os.listdir(self.spool_dir)), 2)
+
+    def test_logdog(self):
+        port = self.start_server()
+        logdog = LogDog("thread")
+        logdog.load_config()
+        logdog.uploader = self.uploader(port)
+        logdog.uploader.start()
+        logdog.start()
+        for fname in self.files:
+            logdog.search(fname)
+        logdog.stop()
+        logdog.uploader.close()
+        # 每个文件的结果分别上传
+        sources = sorted(s for r in self.records() for s in r["sources"])
+        expected = sorted(s for r in self.counter.to_records() for s in r["sources"])
+        self.assertEqual(sources, expected)
+        self.assertEqual(sorted(b.text for b in logdog.counter.result()),
+                         sorted(b.text for b in self.counter.result()))
+
+
+class StatsTest(unittest.TestCase):
+
+    def test_stats(self):
+        logdog = LogDog("inline")
+        logdog.load_config()
+        stats = Stats()
+        stats.instrument(logdog)
+        files = ["extras/log/app-anr-mtk-1.txt", "extras/log/app-native-crash-qcom-1.txt"]
+        for f in files:
+            logdog.search(f)
+        stats.instrument_counter(logdog.counter)
+        self.assertEqual(len(logdog.counter.result()), 2)
+
+        data = stats.to_dict()
+        lines = 0
+        for f in files:
+            with open(f, "rb") as fobj:
+                lines += len(fobj.readlines())
+        self.assertEqual(data["lines"], lines)
+        self.assertEqual(data["stages"]["_search"]["calls"], 2)
+        self.assertEqual(data["stages"]["_remove_text_chip"]["calls"], 2)
+        self.assertEqual(data["stages"]["native_crash_repl"]["calls"], 1)
+        self.assertEqual(data["stages"]["Counter.result"]["calls"], 1)
+        self.assertEqual(data["bones"]["app-anr"], {"count": 1, "avg_lines": 3})
+        self.assertEqual(data["bones"]["native-crash"]["count"], 1)
+        self.assertTrue(data["regex_calls"]["begin_tag"] > 0)
+        self.assertTrue(data["regex_calls"]["line_tag"] > 0)
+
+    def test_workers(self):
+        # 工作进程中的统计信息合并到主进程，与在一个进程中扫描相同
+        files = ["extras/log/app-anr-mtk-1.txt", "extras/log/app-native-crash-qcom-1.txt"]
+        logdog = LogDog("inline")
+        logdog.load_config()
+        stats = Stats()
+        stats.instrument(logdog)
+        for f in files:
+            logdog.search(f)
+        expected = stats.to_dict()
+
+        stats = Stats()
+        scan_files_parallel(files, 2, stats=stats)
+        data = stats.to_dict()
+        for key in ["lines", "bones", "regex_calls"]:
+            self.assertEqual(data[key], expected[key])
+        self.assertEqual(data["stages"]["_search"]["calls"], 2)
+        self.assertEqual(data["stages"]["native_crash_repl"]["calls"], 1)
+        self.assertEqual(data["normalize_cache"], {"hits": 0, "misses": 2})
+
+        # process模式的pipeline中，规范化在工作进程中进行
+        logdog = LogDog("process", jobs=2)
+        logdog.load_config()
+        stats = Stats()
+        stats.instrument(logdog)
+        logdog.start()
+        for f in files:
+            logdog.search(f)
+        logdog.stop()
+        data = stats.to_dict()
+        self.assertEqual(data["stages"]["_remove_text_chip"]["calls"], 2)
+        self.assertEqual(data["bones"], expected["bones"])
+
+
+class NormalizeCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # 除了时间戳以外完全相同的native crash重复出现20次
+        with open("extras/log/app-native-crash-qcom-1.txt", "r") as f:
+            text = f.read()
+        with open("test.txt", "w") as f:
+            for i in range(20):
+                f.write(re.sub(r"(?m)^(\d\d-\d\d \d\d):\d\d", r"\g<1>:%02d" % i, text))
+
+    def tearDown(self):
+        os.remove("test.txt")
+
+    def test_lru(self):
+        cache = NormalizeCache(2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        # b最久未使用，被淘汰
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        self.assertEqual((cache.hits, cache.misses), (3, 1))
+
+        cache = NormalizeCache(0)
+        cache.put("a", 1)
+        self.assertEqual(cache.get("a"), None)
+
+    def scan(self, size):
+        logdog = LogDog("inline")
+        logdog.load_config()
+        logdog.normalize_cache = NormalizeCache(size)
+        return logdog.scan_file("test.txt"), logdog.normalize_cache
+
+    def test_scan(self):
+        counter, cache = self.scan(LogDog.NORMALIZE_CACHE_SIZE)
+        expected, _ = self.scan(0)
+        self.assertEqual((cache.hits, cache.misses), (19, 1))
+        result = counter.result()
+        self.assertEqual(list(result.values()), [20])
+        self.assertEqual([(b.text, b.proc_name, b.ex_name, n) for b, n in result.items()],
+                         [(b.text, b.proc_name, b.ex_name, n) for b, n in expected.result().items()])
+
+
+class ArchiveTest(unittest.TestCase):
+
+    names = sorted(os.listdir("extras/log"))
+
+    def setUp(self):
+        with gzip.open("test.gz", "wb") as out:
+            for name in self.names:
+                with open(os.path.join("extras/log", name), "rb") as f:
+                    out.write(f.read())
+        # 模拟bugreport：包含目录，其中一个日志单独压缩过
+        with zipfile.ZipFile("test.zip", "w", zipfile.ZIP_DEFLATED) as z:
+            z.writestr("FS/", b"")
+            for name in self.names:
+                with open(os.path.join("extras/log", name), "rb") as f:
+                    data = f.read()
+                if name == self.names[0]:
+                    buf = io.BytesIO()
+                    with gzip.GzipFile(fileobj=buf, mode="wb") as g:
+                        g.write(data)
+                    z.writestr("FS/" + name + ".gz", buf.getvalue())
+                else:
+                    z.writestr("FS/" + name, data)
+        with tarfile.open("test.tar.gz", "w:gz") as t:
+            for name in self.names:
+                t.add(os.path.join("extras/log", name), "FS/" + name)
+
+    def tearDown(self):
+        for fname in ("test.gz", "test.zip", "test.tar.gz"):
+            os.remove(fname)
+
+    def expected(self):
+        logdog = LogDog("inline")
+        logdog.load_config()
+        counter = Counter()
+        for name in self.names:
+            counter.merge(logdog.scan_file(os.path.join("extras/log", name)))
+        return [(b.text, n) for b, n in counter.result().items()]
+
+    def test_archive_type(self):
+        self.assertEqual([archive_type(x) for x in ("a.txt", "a.gz", "a.ZIP", "a.tgz", "a.tar.gz", "logcat.1")],
+                         [None, "gzip", "zip", "tar", "tar", None])
+
+    def test_scan(self):
+        expected = self.expected()
+        logdog = LogDog("inline")
+        logdog.load_config()
+        for fname in ("test.gz", "test.zip", "test.tar.gz"):
+            counter = logdog.scan_file(fname)
+            self.assertEqual([(b.text, n) for b, n in counter.result().items()], expected, fname)
+
+        sources = set(s for _, _, entry_sources in logdog.scan_file("test.zip").dict.values() for s in entry_sources)
+        self.assertIn("test.zip!FS/" + self.names[0] + ".gz", sources)
+        self.assertTrue(all(s.startswith("test.zip!FS/") for s in sources))
+
+    def test_parallel(self):
+        self.assertEqual(len(list(logdog._split_tasks(["test.zip"], CHUNK_SIZE))), len(self.names))
+        expected = self.expected()
+        for fname in ("test.zip", "test.tar.gz"):
+            counter = scan_files_parallel([fname], 2)
+            self.assertEqual([(b.text, n) for b, n in counter.result().items()], expected, fname)
+
+
+class OverlapTest(unittest.TestCase):
+
+    files = ["test_overlap.1", "test_overlap.0", "test_overlap.copy"]
+
+    def setUp(self):
+        out = io.BytesIO()
+        benchmark.LogGenerator(seed=3, density=0.2).write(out, 1 << 20)
+        lines = out.getvalue().splitlines(True)
+        n = len(lines)
+        # 轮转的日志：test_overlap.1在bone的中间结束，test_overlap.0从其中间开始；另有一个副本．
+        # 生成的日志与Python版本有关，在一个ANR的中间截断
+        cut = next(i for i in range(n * 2 // 3, n) if b"ANR in" in lines[i]) + 2
+        contents = [lines[:cut], lines[n // 3:], lines[n // 4:n // 2]]
+        for fname, content in zip(self.files, contents):
+            with open(fname, "wb") as f:
+                f.write(b"".join(content))
+
+    def tearDown(self):
+        for fname in self.files:
+            os.remove(fname)
+
+    def scan(self, skip_ranges):
+        logdog = LogDog("inline")
+        logdog.load_config()
+        logdog.skip_ranges = skip_ranges
+        counter = Counter()
+        for fname in self.files:
+            counter.merge(logdog.scan_file(fname))
+        return sorted((b.text, n) for b, n in counter.result().items())
+
+    def find_overlaps(self):
+        logdog = LogDog("inline")
+        logdog.load_config()
+        return logdog.find_overlaps(self.files + self.files[:1])
+
+    def test_find_overlaps(self):
+        skip_ranges = self.find_overlaps()
+        self.assertEqual(sorted(skip_ranges), self.files[1:])
+        # 副本完全包含在test_overlap.1中，只保留两端的不完整的bone
+        skipped = sum(e - s for s, e in skip_ranges["test_overlap.copy"])
+        self.assertTrue(skipped > os.path.getsize("test_overlap.copy") * 0.9)
+        self.assertTrue(sum(e - s for s, e in skip_ranges["test_overlap.0"]) > os.path.getsize("test_overlap.0") / 3)
+        self.assertEqual(find_overlaps(self.files[:1]), {})
+
+    def test_scan(self):
+        skip_ranges = self.find_overlaps()
+        self.assertEqual(self.scan(skip_ranges), self.scan({}))
+
+    def test_parallel(self):
+        skip_ranges = self.find_overlaps()
+        expected = self.scan({})
+        counter = scan_files_parallel(self.files, 2, 10000, skip_ranges=skip_ranges)
+        self.assertEqual(sorted((b.text, n) for b, n in counter.result().items()), expected)
+
+    def test_boundary(self):
+        # 不收缩时，test_overlap.1末尾不完整的bone会使test_overlap.0中完整的bone被跳过
+        self.assertNotEqual(self.scan(find_overlaps(self.files)), self.scan({}))
+
+
+class LogGeneratorTest(unittest.TestCase):
+
+    def generate(self, **kwargs):
+        out = io.BytesIO()
+        generator = benchmark.LogGenerator(seed=1, density=0.05, **kwargs)
+        generator.write(out, 200000)
+        return generator, out.getvalue()
+
+    def test_generate(self):
+        generator, data = self.generate()
+        self.assertEqual(self.generate()[1], data)
+        self.assertEqual(generator.lines, data.count(b"\n"))
+
+        logdog = LogDog("inline")
+        logdog.load_config()
+        with open("test.txt", "wb") as f:
+            f.write(data)
+        try:
+            result, bones = benchmark.bench_search(logdog, "test.txt", len(data), generator.lines)
+        finally:
+            os.remove("test.txt")
+        self.assertEqual(result["bones"], sum(generator.bones.values()))
+        self.assertEqual(benchmark.bench_parse_bone(logdog, bones)["distinct_bones"], len(logdog.counter.result()))
+
+        crlf_data = self.generate(crlf=True)[1]
+        self.assertTrue(data.startswith(crlf_data.replace(b"\r\n", b"\n")))
+
+    def test_printable(self):
+        generator, data = self.generate(fmt="printable")
+        # 不可打印的字符都被转义
+        self.assertFalse(b"\t" in data or b"\x1b" in data)
+        self.assertIn(b"\\tat ", data)
+        self.assertIn(b"\\033[1m", data)
+        self.assertEqual(sniff_format(data).name, "threadtime")
+        logdog = LogDog("inline")
+        logdog.load_config()
+        with open("test.txt", "wb") as f:
+            f.write(data)
+        try:
+            result, _ = benchmark.bench_search(logdog, "test.txt", len(data), generator.lines)
+        finally:
+            os.remove("test.txt")
+        self.assertEqual(result["bones"], sum(generator.bones.values()))
+
+
+class ParallelScanTest(unittest.TestCase):
+
+    files = ["extras/log/app-anr-mtk-2.txt", "extras/log/app-anr-google-1.txt", "extras/log/app-anr-google-1.txt",
+             "extras/log/app-native-crash-google-x86-1.txt", "extras/log/app-native-crash-google-x86-2.txt"]
+
+    def test_scan_files_parallel(self):
+        logdog = LogDog()
+        logdog.load_config()
+        logdog.start()
+        for f in self.files:
+            logdog.search(f)
+        logdog.stop()
+        expected = logdog.counter.result()
+
+        result = scan_files_parallel(self.files, 2).result()
+        self.assertEqual(result, expected)
+        self.assertEqual(list(result), list(expected))
+
+    def test_scan_chunks(self):
+        # 小的chunk_size会让范围边界落在bone中间
+        with open("test_chunks.txt", "wb") as out:
+            for fname in sorted(os.listdir("extras/log")) * 2:
+                with open(os.path.join("extras/log", fname), "rb") as f:
+                    out.write(f.read())
+        try:
+            logdog = LogDog()
+            logdog.load_config()
+            expected = logdog.scan_file("test_chunks.txt")
+            for chunk_size in [100, 4096]:
+                counter = scan_files_parallel(["test_chunks.txt"], 2, chunk_size)
+                # Python 2的dict没有顺序，只比较内容
+                self.assertEqual(counter.dict, expected.dict)
+        finally:
+            os.remove("test_chunks.txt")
+
+
+class DemuxTest(unittest.TestCase):
+
+    fname = "test_demux.txt"
+
+    def setUp(self):
+        self.logdog = LogDog("inline")
+        self.logdog.load_config()
+
+    def tearDown(self):
+        for fname in [self.fname, "test_clean.txt"]:
+            if os.path.exists(fname):
+                os.remove(fname)
+
+    def scan(self, fname, demux):
+        self.logdog.demux = demux
+        return {bone.text: n for bone, n in self.logdog.scan_file(fname).result().items()}
+
+    def test_sample(self):
+        # BootReceiver的一行日志插入了native crash的行之间
+        fname = "extras/log/app-native-crash-mtk-1.txt"
+        expected = self.scan(fname, False)
+        self.assertTrue(any("request.action" in x for x in expected))
+        # AEE之后输出的Count、Last exception time每次都不同，不属于bone
+        self.assertFalse(any("Count:" in x or "Last exception time" in x for x in expected))
+        self.assertEqual(self.scan(fname, True), expected)
+
+    def test_interleave(self):
+        generator = benchmark.LogGenerator(seed=3, density=0.05, interleave=0.3)
+        with open(self.fname, "wb") as f:
+            generator.write(f, 128 << 10)
+        # 去掉其他线程的日志后，按顺序扫描的结果就是正确的结果
+        with open(self.fname, "rb") as f, open("test_clean.txt", "wb") as out:
+            for line in f:
+                if line.split()[5].rstrip(b":").decode("ascii") not in benchmark.NOISE_TAGS:
+                    out.write(line)
+        expected = self.scan("test_clean.txt", False)
+        self.assertEqual(sum(expected.values()), sum(generator.bones.values()))
+        self.assertNotEqual(self.scan(self.fname, False), expected)
+        self.assertEqual(self.scan(self.fname, True), expected)
+
+        counter = scan_files_parallel([self.fname], 2, 4096, demux=True)
+        self.assertEqual({bone.text: n for bone, n in counter.result().items()}, expected)
+
+    def test_timeout(self):
+        with open("extras/log/app-jvm-crash-qcom-1.txt", "rb") as f:
+            lines = f.readlines()
+        noise = b"11-17 16:27:00.050  1519  1519 D SettingsInterface:  from settings cache\n"
+        with open(self.fname, "wb") as f:
+            f.write(b"".join(lines[:5] + [noise] * 20 + lines[5:]))
+        complete = self.scan("extras/log/app-jvm-crash-qcom-1.txt", False)
+        self.assertEqual(self.scan(self.fname, True), complete)
+        # 超过DEMUX_TIMEOUT行没有续行，bone被拆开
+        self.logdog.DEMUX_TIMEOUT = 10
+        self.assertNotEqual(self.scan(self.fname, True), complete)
+
+
+    def test_timeout_chunks(self):
+        # bone中间有超过DEMUX_TIMEOUT行其他线程的日志，是否超时与扫描的起点无关，按字节范围并行扫描的结果与整体扫描相同
+        with open("extras/log/app-jvm-crash-qcom-1.txt", "rb") as f:
+            lines = f.readlines()
+        noise = b"11-17 16:27:00.050  1519  1519 D SettingsInterface:  from settings cache\n"
+        timeout = LogDog.DEMUX_TIMEOUT
+        with open(self.fname, "wb") as f:
+            for i in range(8):
+                # 每次的日期不同，不会被当作重复的日志
+                crash = [("%02d" % (i + 1)).encode("ascii") + x[2:] for x in lines]
+                f.write(noise * (i * timeout // 8) + b"".join(crash[:5]) + noise * (timeout * 3 // 2) + b"".join(crash[5:]))
+        expected = self.scan(self.fname, True)
+        self.assertNotEqual(expected, self.scan("extras/log/app-jvm-crash-qcom-1.txt", False))
+        counter = scan_files_parallel([self.fname], 2, 50000, demux=True)
+        self.assertEqual({bone.text: n for bone, n in counter.result().items()}, expected)
+
+
+class TimeWindowTest(unittest.TestCase):
+
+    fname = "test_window.txt"
+
+    def setUp(self):
+        self.logdog = LogDog()
+        self.logdog.load_config()
+        out = io.BytesIO()
+        benchmark.LogGenerator(seed=1, density=0.05).write(out, 256 << 10)
+        self.data = out.getvalue()
+
+    def tearDown(self):
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def write(self, data):
+        with open(self.fname, "wb") as f:
+            f.write(data)
+
+    def expected(self, window):
+        # 扫描整个文件，再按时间过滤
+        self.logdog.time_window = None
+        counter = self.logdog.scan_file(self.fname)
+        result = {}
+        for bone, stamps, _ in counter.dict.values():
+            n = len([x for x in stamps if window.contains(x)])
+            if n:
+                result[bone.text] = n
+        return result
+
+    def scan(self, window):
+        self.logdog.time_window = window
+        return {bone.text: n for bone, n in self.logdog.scan_file(self.fname).result().items()}
+
+    def test_key(self):
+        self.assertEqual(TimeWindow.key("11-17 16:27"), "11-17 16:27:00.000000")
+        self.assertEqual(TimeWindow.key("11-17 16:27:00.050"), "11-17 16:27:00.050000")
+        self.assertEqual(TimeWindow.key("1479371220.050"), 1479371220.05)
+        self.assertIsNone(TimeWindow.key(BriefFormat.NO_STAMP))
+        self.assertRaises(ValueError, TimeWindow, "yesterday")
+        self.assertRaises(ValueError, TimeWindow, "11-17", "1479371220")
+
+        window = TimeWindow("11-17 16:27", "11-17 16:28")
+        self.assertTrue(window.contains("11-17 16:27:00.000"))
+        self.assertTrue(window.contains("11-17 16:28:00.000"))
+        self.assertFalse(window.contains("11-17 16:28:00.001"))
+        self.assertFalse(window.contains("11-17 16:26:59.999999"))
+        # 无法比较的时间戳总是保留
+        self.assertTrue(window.contains(BriefFormat.NO_STAMP))
+        self.assertTrue(window.contains("1479371220.050"))
+
+    def test_sorted(self):
+        self.write(self.data)
+        window = TimeWindow("01-01 00:00:01", "01-01 00:00:02.5", assume_sorted=True)
+        start, end = file_time_range(self.fname, window)
+        self.assertTrue(0 < start < end < len(self.data))
+        self.assertTrue(self.data[start - 1:start] == b"\n" and self.data[end - 1:end] == b"\n")
+        expected = self.expected(window)
+        self.assertTrue(expected)
+        self.assertEqual(self.scan(window), expected)
+        self.assertEqual(self.scan(TimeWindow("01-01 00:00:02", assume_sorted=True)), self.expected(TimeWindow("01-01 00:00:02")))
+        self.assertEqual(self.scan(TimeWindow(until="01-01 00:00:01", assume_sorted=True)),
+                         self.expected(TimeWindow(until="01-01 00:00:01")))
+        self.assertEqual(file_time_range(self.fname, TimeWindow("02-01", assume_sorted=True)), (len(self.data), len(self.data)))
+
+    def test_local_disorder(self):
+        # 范围开始处的bone之后有30行时间稍早的行（logcat -b all中各个缓冲区交错），二分查找会越过这个bone
+        lines = ["01-01 00:16:%02d.%03d  100  100 I Noise   : line %d\n" % (i // 1000 % 60, i % 1000, i)
+                 for i in range(39000, 41000)]
+        crash = ["01-01 00:16:40.005  200  200 E AndroidRuntime: FATAL EXCEPTION: main\n",
+                 "01-01 00:16:40.005  200  200 E AndroidRuntime: Process: com.example, PID: 200\n",
+                 "01-01 00:16:40.005  200  200 E AndroidRuntime: java.lang.RuntimeException: boom\n"]
+        late = ["01-01 00:16:39.990  300  300 I Other   : line %d\n" % i for i in range(30)]
+        self.write("".join(lines[:1000] + crash + late + lines[1005:]).encode("utf-8"))
+        window = TimeWindow("01-01 00:16:40.000", assume_sorted=True)
+        self.assertEqual(len(self.expected(window)), 1)
+        self.assertEqual(self.scan(window), self.expected(window))
+        with open(self.fname, "rb") as f:
+            data = f.read()
+        self.assertEqual(file_time_range(self.fname, window)[0], data.index(crash[0].encode("utf-8")))
+
+    def test_unsorted(self):
+        # 两段日志交换顺序后时间不再单调，回退到逐行扫描并过滤
+        middle = self.data.index(b"\n", len(self.data) // 2) + 1
+        self.write(self.data[middle:] + self.data[:middle])
+        window = TimeWindow("01-01 00:00:01", "01-01 00:00:02.5", assume_sorted=True)
+        self.assertIsNone(file_time_range(self.fname, window))
+        self.assertEqual(self.scan(window), self.expected(window))
+
+    def test_unsorted_tail(self):
+        # 有序的日志之后拼接了一小段时间更早的日志，只在最后一个有时间戳的行才能发现乱序
+        tail = self.data[:self.data.index(b"\n", len(self.data) // 64) + 1]
+        self.write(self.data + tail)
+        window = TimeWindow("01-01 00:00:00", "01-01 00:00:00.5", assume_sorted=True)
+        self.assertIsNone(file_time_range(self.fname, window))
+        expected = self.expected(window)
+        self.assertTrue(sum(expected.values()) > 1)
+        self.assertEqual(self.scan(window), expected)
+
+    def test_not_assumed(self):
+        # 没有指定assume_sorted时总是逐行扫描并过滤
+        self.write(self.data)
+        window = TimeWindow("01-01 00:00:01", "01-01 00:00:02.5")
+        self.assertIsNone(file_time_range(self.fname, window))
+        self.assertEqual(self.scan(window), self.expected(window))
+
+    def test_long(self):
+        out = []
+        for line in self.data.decode("utf-8").splitlines():
+            date, tm, pid, tid, level, rest = line.split(None, 5)
+            tag, _, msg = rest.partition(": ")
+            out.append("[ %s %s %5s:%5s %s/%s ]\n%s\n\n" % (date, tm, pid, tid, level, tag.strip(), msg))
+        self.write("".join(out).encode("utf-8"))
+        window = TimeWindow("01-01 00:00:01", "01-01 00:00:02.5", assume_sorted=True)
+        self.assertIsNotNone(file_time_range(self.fname, window))
+        expected = self.expected(window)
+        self.assertTrue(expected)
+        self.assertEqual(self.scan(window), expected)
+
+    def test_parallel(self):
+        self.write(self.data)
+        window = TimeWindow("01-01 00:00:01", "01-01 00:00:02.5", assume_sorted=True)
+        counter = scan_files_parallel([self.fname], 2, 4096, time_window=window)
+        self.assertEqual({bone.text: n for bone, n in counter.result().items()}, self.expected(window))
+
+
 if __name__ == "__main__":
     unittest.main()